@@ -0,0 +1,24 @@
+"""add user version
+
+Revision ID: 3f1a9c2d7b84
+Revises: 6c8d355ed777
+Create Date: 2026-10-18 09:12:41.512304
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3f1a9c2d7b84"
+down_revision = "6c8d355ed777"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("users", sa.Column("version", sa.Integer(), server_default="0", nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column("users", "version")
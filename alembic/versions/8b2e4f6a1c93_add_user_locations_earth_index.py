@@ -0,0 +1,63 @@
+"""add user_locations earth index
+
+Revision ID: 8b2e4f6a1c93
+Revises: 3f1a9c2d7b84
+Create Date: 2026-10-18 13:40:07.218316
+
+"""
+import logging
+
+import sqlalchemy as sa
+
+from alembic import context, op
+
+# revision identifiers, used by Alembic.
+revision = "8b2e4f6a1c93"
+down_revision = "3f1a9c2d7b84"
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+
+def _create_extensions() -> bool:
+    # contrib extensions shipped with postgres, creating them needs the CREATE privilege on the
+    # database since postgres 13, superuser before
+    if context.is_offline_mode():
+        op.execute("CREATE EXTENSION IF NOT EXISTS cube")
+        op.execute("CREATE EXTENSION IF NOT EXISTS earthdistance")
+        return True
+
+    try:
+        # a failed statement would abort the whole migration's transaction
+        with op.get_bind().begin_nested():
+            op.execute("CREATE EXTENSION IF NOT EXISTS cube")
+            op.execute("CREATE EXTENSION IF NOT EXISTS earthdistance")
+    except sa.exc.DBAPIError as exc:
+        logger.warning(
+            "Skipping ix_user_locations_earth, the cube and earthdistance extensions couldn't be "
+            "created, GEO_SEARCH_STRATEGY=earthdistance can't be used: %s",
+            exc.orig,
+        )
+        return False
+    return True
+
+
+def upgrade() -> None:
+    # only GEO_SEARCH_STRATEGY=earthdistance uses them
+    if not _create_extensions():
+        return
+    op.create_index(
+        "ix_user_locations_earth",
+        "user_locations",
+        [sa.text("ll_to_earth(latitude, longitude)")],
+        unique=False,
+        postgresql_using="gist",
+    )
+
+
+def downgrade() -> None:
+    # left out when the extensions couldn't be created
+    op.execute("DROP INDEX IF EXISTS ix_user_locations_earth")
+    op.execute("DROP EXTENSION IF EXISTS earthdistance")
+    op.execute("DROP EXTENSION IF EXISTS cube")
@@ -0,0 +1,59 @@
+"""add location_density_cells
+
+Revision ID: a7c3e5f9b214
+Revises: e91b3c5d7a28
+Create Date: 2026-10-18 21:03:27.184409
+
+"""
+import math
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a7c3e5f9b214"
+down_revision = "e91b3c5d7a28"
+branch_labels = None
+depends_on = None
+
+# DENSITY_GRID_CELL_DEGREES when this revision was written, the periodic check repairs the grid
+# of other levels
+CELL_DEGREES = [1.0, 0.1, 0.01]
+
+
+def upgrade() -> None:
+    op.create_table(
+        "location_density_cells",
+        sa.Column("zoom", sa.SmallInteger(), nullable=False),
+        sa.Column("lat_index", sa.Integer(), nullable=False),
+        sa.Column("lon_index", sa.Integer(), nullable=False),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("zoom", "lat_index", "lon_index"),
+    )
+
+    # the cells of DensityGrid's GridCells, coordinates are turned into doubles first like it does
+    for zoom, degrees in enumerate(CELL_DEGREES):
+        rows, columns = math.ceil(180 / degrees), math.ceil(360 / degrees)
+        op.execute(
+            f"""
+            INSERT INTO location_density_cells (zoom, lat_index, lon_index, count)
+            SELECT {zoom}, lat_index, lon_index, count(*)
+            FROM (
+                SELECT
+                    CAST(
+                        least(floor((CAST(latitude AS FLOAT) + 90.0) / {degrees!r}), {rows - 1})
+                        AS INTEGER
+                    ) AS lat_index,
+                    CAST(floor((CAST(longitude AS FLOAT) + 180.0) / {degrees!r}) AS INTEGER)
+                    % {columns} AS lon_index
+                FROM user_locations
+                WHERE latitude IS NOT NULL
+            ) AS located
+            GROUP BY lat_index, lon_index
+            """
+        )
+
+
+def downgrade() -> None:
+    op.drop_table("location_density_cells")
@@ -0,0 +1,37 @@
+"""add user_locations unit vectors
+
+Revision ID: c4d7a9e2f015
+Revises: 8b2e4f6a1c93
+Create Date: 2026-10-18 15:02:51.604417
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c4d7a9e2f015"
+down_revision = "8b2e4f6a1c93"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    for axis in ("x", "y", "z"):
+        op.add_column("user_locations", sa.Column(axis, sa.Float(), nullable=True))
+    op.execute(
+        """
+        UPDATE user_locations SET
+            x = cos(radians(latitude)) * cos(radians(longitude)),
+            y = cos(radians(latitude)) * sin(radians(longitude)),
+            z = sin(radians(latitude))
+        """
+    )
+    for axis in ("x", "y", "z"):
+        op.create_index(op.f(f"ix_user_locations_{axis}"), "user_locations", [axis], unique=False)
+
+
+def downgrade() -> None:
+    for axis in ("x", "y", "z"):
+        op.drop_index(op.f(f"ix_user_locations_{axis}"), table_name="user_locations")
+        op.drop_column("user_locations", axis)
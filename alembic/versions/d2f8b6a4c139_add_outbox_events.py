@@ -0,0 +1,48 @@
+"""add outbox_events
+
+Revision ID: d2f8b6a4c139
+Revises: a7c3e5f9b214
+Create Date: 2026-10-18 23:12:41.508213
+
+"""
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "d2f8b6a4c139"
+down_revision = "a7c3e5f9b214"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "outbox_events",
+        sa.Column("id", sa.BigInteger(), autoincrement=True, nullable=False),
+        sa.Column("event_type", sa.String(), nullable=False),
+        sa.Column("payload", postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column(
+            "available_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.Column("attempts", sa.Integer(), server_default="0", nullable=False),
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_outbox_events_available_at", "outbox_events", ["available_at", "id"], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_outbox_events_available_at", table_name="outbox_events")
+    op.drop_table("outbox_events")
@@ -0,0 +1,92 @@
+"""add user_locations geohash
+
+Revision ID: e91b3c5d7a28
+Revises: c4d7a9e2f015
+Create Date: 2026-10-18 16:47:12.930145
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e91b3c5d7a28"
+down_revision = "c4d7a9e2f015"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10_000
+# GEOHASH_PRECISION when this revision was written, rows are backfilled again after changing it
+PRECISION = 8
+ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def _geohash(latitude: float, longitude: float) -> str:
+    # a copy of GeoLocationHelper.geohash, migrations don't depend on the app's code
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bit = 0
+    char = 0
+    even = True  # longitude bits go first
+    while len(chars) < PRECISION:
+        value, value_range = (longitude, lon_range) if even else (latitude, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        char <<= 1
+        if value >= middle:
+            char |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even = not even
+        bit += 1
+        if bit == 5:
+            chars.append(ALPHABET[char])
+            bit = 0
+            char = 0
+    return "".join(chars)
+
+
+def upgrade() -> None:
+    op.add_column(
+        "user_locations", sa.Column("geohash", sa.String(length=12, collation="C"), nullable=True)
+    )
+
+    connection = op.get_bind()
+    locations = sa.table(
+        "user_locations",
+        sa.column("id", sa.Integer),
+        sa.column("latitude", sa.Numeric),
+        sa.column("longitude", sa.Numeric),
+        sa.column("geohash", sa.String),
+    )
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(locations.c.id, locations.c.latitude, locations.c.longitude)
+            .where(locations.c.id > last_id, locations.c.latitude.is_not(None))
+            .order_by(locations.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        connection.execute(
+            sa.update(locations)
+            .where(locations.c.id == sa.bindparam("location_id"))
+            .values(geohash=sa.bindparam("location_geohash")),
+            [
+                {
+                    "location_id": row.id,
+                    "location_geohash": _geohash(float(row.latitude), float(row.longitude)),
+                }
+                for row in rows
+            ],
+        )
+        last_id = rows[-1].id
+
+    op.create_index(op.f("ix_user_locations_geohash"), "user_locations", ["geohash"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_user_locations_geohash"), table_name="user_locations")
+    op.drop_column("user_locations", "geohash")
@@ -1 +1,2 @@
-from .repositories.users.models import *  # noqa: F403
+from .repositories.outbox.models import *  # noqa: F401, F403
+from .repositories.users.models import *  # noqa: F401, F403
@@ -1,7 +1,12 @@
 import pytest
 from mimesis import Person
+from sqlalchemy import func, select
 
+from app.config import settings
 from app.domain.auth.dtos import RegisterPayload
+from app.domain.auth.services.token_cache import token_cache
+from app.domain.auth.services.user_service import UserService
+from app.repositories.outbox.models import OutboxEvent
 
 pytestmark = pytest.mark.anyio
 person = Person()
@@ -54,3 +59,76 @@ async def test_register(client):
     response = response.json()
     assert response.get("access_token") is not None
     assert response.get("refresh_token") is not None
+
+
+async def test_register_writes_the_confirmation_email_to_the_outbox(client, session_maker):
+    user_data = RegisterPayload(
+        email=person.email(),
+        password=person.password(),
+        username=person.username(),
+    )
+    response = await client.post("api/v1/register/", json=user_data.model_dump())
+    assert response.status_code == 201
+
+    async with session_maker() as session:
+        events = (await session.scalars(select(OutboxEvent))).all()
+    assert [(event.event_type, event.payload["email"]) for event in events] == [
+        ("ConfirmationEmailEvent", user_data.email)
+    ]
+
+    # rejected with the user
+    response = await client.post("api/v1/register/", json=user_data.model_dump())
+    assert response.status_code == 400
+    async with session_maker() as session:
+        assert await session.scalar(select(func.count()).select_from(OutboxEvent)) == 1
+
+
+async def test_me_is_served_from_token_cache(logged_in_client):
+    client = logged_in_client.client
+
+    response = await client.get("api/v1/me/")
+    assert response.status_code == 200
+    hits, misses = token_cache.hits, token_cache.misses
+
+    response = await client.get("api/v1/me/")
+    assert response.status_code == 200
+    assert response.json()["id"] == logged_in_client.user.id
+    assert token_cache.hits == hits + 1
+    assert token_cache.misses == misses
+
+
+async def test_claims_only_tokens(logged_in_client, monkeypatch):
+    monkeypatch.setattr(settings, "AUTH_CLAIMS_ONLY", True)
+    user = logged_in_client.user
+    client = logged_in_client.client
+
+    response = await client.post(
+        "api/v1/login/", json={"username": user.username, "password": user.password}
+    )
+    access_token = response.json()["access_token"]
+    client.headers = {"Authorization": f"Bearer {access_token}"}
+
+    async def fail(*args, **kwargs):
+        raise AssertionError("claims-only authentication shouldn't load the user")
+
+    with monkeypatch.context() as m:
+        m.setattr(UserService, "get_user_with_id", fail)
+        response = await client.get("api/v1/me/")
+    assert response.status_code == 200
+    assert response.json()["id"] == user.id
+
+    payload = {"first_name": person.first_name(), "last_name": None, "birthday": None}
+    response = await client.put("api/v1/users/me/profile/", json=payload)
+    assert response.status_code == 201
+
+    # the profile changed, the token issued before that is stale now
+    response = await client.get("api/v1/me/")
+    assert response.status_code == 401
+
+    response = await client.post(
+        "api/v1/refresh-token/", json={"refresh_token": user.refresh_token}
+    )
+    client.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    response = await client.get("api/v1/me/")
+    assert response.status_code == 200
+    assert response.json()["profile"]["first_name"] == payload["first_name"]
@@ -11,8 +11,9 @@ from app.domain.auth.dtos import (
 )
 from app.domain.auth.services.auth_service import AuthService
 from app.domain.common.services.token_decode_service import TokenDecodeService
+from app.infrastructure.services.session_service import UnitOfWorkRoute
 
-router = APIRouter()
+router = APIRouter(route_class=UnitOfWorkRoute)
 
 
 @router.get("/me/")
@@ -53,4 +54,4 @@ async def refresh_token(
     refresh_token_payload: RefreshTokenPayload,
     service: AuthService = Depends(AuthService),
 ) -> TokenDto:
-    return service.refresh_token(refresh_token_payload.refresh_token)
+    return await service.refresh_token(refresh_token_payload.refresh_token)
@@ -0,0 +1,112 @@
+import pytest
+from pydantic import SecretStr
+
+from app.config import settings
+from app.domain.users.density_grid import density_grid
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture()
+def internal_client(client, monkeypatch):
+    monkeypatch.setattr(settings, "INTERNAL_API_TOKEN", SecretStr("internal-token"))
+    client.headers = {"Authorization": "Bearer internal-token"}
+    return client
+
+
+@pytest.mark.parametrize(
+    "token, headers, status_code",
+    [
+        (None, {"Authorization": "Bearer internal-token"}, 404),
+        ("internal-token", {}, 401),
+        ("internal-token", {"Authorization": "Bearer other-token"}, 401),
+        ("internal-token", {"Authorization": "Bearer internal-token"}, 200),
+    ],
+)
+async def test_internal_token_is_required(client, monkeypatch, token, headers, status_code):
+    monkeypatch.setattr(settings, "INTERNAL_API_TOKEN", token and SecretStr(token))
+    response = await client.get("api/v1/internal/caches/", headers=headers)
+    assert response.status_code == status_code
+
+
+async def test_pool_stats(internal_client):
+    response = await internal_client.get("api/v1/internal/pool/")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["checked_out"] >= 0
+    assert "+Inf" in stats["wait_time_ms"]["buckets"]
+
+
+async def test_spatial_index_stats(internal_client):
+    response = await internal_client.get("api/v1/internal/spatial-index/")
+    assert response.status_code == 200
+    stats = response.json()
+    # the test client doesn't run the lifespan, nothing loads the index
+    assert stats["warm"] is False
+    assert stats["size"] == 0
+    assert stats["rebuild_seconds"] is None
+
+
+async def test_cache_stats(internal_client):
+    response = await internal_client.get("api/v1/internal/caches/")
+    assert response.status_code == 200
+    stats = response.json()
+    assert set(stats) == {"tokens", "pagination_counts", "geo_search"}
+    assert 0 <= stats["geo_search"]["hit_rate"] <= 1
+
+
+async def test_location_coalescer_stats(internal_client):
+    response = await internal_client.get("api/v1/internal/location-coalescer/")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["pending"] >= 0
+    assert stats["failed_flushes"] >= 0
+
+
+async def test_nearby_feed_stats(internal_client):
+    response = await internal_client.get("api/v1/internal/nearby-feed/")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["subscribers"] == 0
+    assert stats["listening"] is False
+
+
+async def test_density_grid_stats(internal_client):
+    response = await internal_client.get("api/v1/internal/density-grid/")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["cell_degrees"] == settings.DENSITY_GRID_CELL_DEGREES
+    assert stats["applied"] >= 0
+
+
+async def test_event_stats(internal_client):
+    response = await internal_client.get("api/v1/internal/events/")
+    assert response.status_code == 200
+    stats = response.json()["ConfirmationEmailEvent"]
+    assert stats["max_queued"] == settings.MEDIATOR_QUEUE_SIZE
+    assert stats["failed"] >= 0
+
+
+async def test_outbox_stats(internal_client):
+    response = await internal_client.get("api/v1/internal/outbox/")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["dispatching"] is False
+    assert stats["dispatched"] >= 0
+
+
+async def test_email_sender_stats(internal_client):
+    response = await internal_client.get("api/v1/internal/email-sender/")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["max_queued"] == settings.EMAIL_QUEUE_SIZE
+    assert stats["sent"] >= 0
+
+
+async def test_density_grid_checks_are_debounced(internal_client, monkeypatch):
+    monkeypatch.setattr(density_grid, "_check_started", None)
+    response = await internal_client.post("api/v1/internal/density-grid/check/")
+    assert response.status_code == 200
+    response = await internal_client.post("api/v1/internal/density-grid/check/?repair=true")
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
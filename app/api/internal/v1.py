@@ -0,0 +1,125 @@
+import hmac
+from typing import Dict, List
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+
+from app.config import settings
+from app.domain.auth.services.token_cache import token_cache
+from app.domain.users.density_grid import density_grid
+from app.domain.users.dtos import (
+    DensityCheckDto,
+    DensityGridStatsDto,
+    LocationCoalescerStatsDto,
+    NearbyFeedStatsDto,
+    SpatialIndexStatsDto,
+)
+from app.domain.users.geo_search_cache import geo_search_cache
+from app.domain.users.location_coalescer import location_coalescer
+from app.domain.users.nearby_feed import nearby_feed
+from app.domain.users.spatial_index import spatial_index
+from app.infrastructure.dtos import (
+    CacheStatsDto,
+    EmailSenderStatsDto,
+    EventStatsDto,
+    OutboxStatsDto,
+    PoolStatsDto,
+)
+from app.infrastructure.services.db_pool import pool_metrics
+from app.infrastructure.services.email_sender import email_sender
+from app.infrastructure.services.mediator import Mediator
+from app.infrastructure.services.outbox import outbox
+from app.infrastructure.services.paginator import count_cache
+from app.infrastructure.services.session_service import (
+    SessionMaker,
+    UnitOfWorkRoute,
+    engine,
+)
+
+
+async def verify_internal_token(
+    authorization: HTTPAuthorizationCredentials | None = Depends(HTTPBearer(auto_error=False)),
+) -> None:
+    """
+    Lets through the requests bearing INTERNAL_API_TOKEN
+    """
+    token = settings.INTERNAL_API_TOKEN
+    if token is None or not token.get_secret_value():
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if authorization is None or not hmac.compare_digest(
+        authorization.credentials.encode(), token.get_secret_value().encode()
+    ):
+        raise HTTPException(
+            status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid internal API token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+# operational endpoints, for the deployment's own tooling only
+router = APIRouter(
+    prefix="/internal",
+    route_class=UnitOfWorkRoute,
+    dependencies=[Depends(verify_internal_token)],
+)
+
+
+@router.get("/pool/")
+async def get_pool_stats() -> PoolStatsDto:
+    return pool_metrics.stats(engine.pool)
+
+
+@router.get("/spatial-index/")
+async def get_spatial_index_stats() -> SpatialIndexStatsDto:
+    return spatial_index.stats()
+
+
+@router.get("/location-coalescer/")
+async def get_location_coalescer_stats() -> LocationCoalescerStatsDto:
+    return location_coalescer.stats()
+
+
+@router.get("/nearby-feed/")
+async def get_nearby_feed_stats() -> NearbyFeedStatsDto:
+    return nearby_feed.stats()
+
+
+@router.get("/density-grid/")
+async def get_density_grid_stats() -> DensityGridStatsDto:
+    return density_grid.stats()
+
+
+@router.post("/density-grid/check/")
+async def check_density_grid(
+    repair: bool = False, unit_of_work: SessionMaker = Depends(SessionMaker)
+) -> List[DensityCheckDto]:
+    """
+    Compares the density grid against user_locations, and repairs it with repair=true.
+    Empty if the periodic check of a worker is running, 429 if this worker checked it recently.
+    """
+    async with unit_of_work as session:
+        return await density_grid.check_on_demand(session, repair=repair)
+
+
+@router.get("/events/")
+async def get_event_stats() -> Dict[str, EventStatsDto]:
+    return Mediator.stats()
+
+
+@router.get("/outbox/")
+async def get_outbox_stats() -> OutboxStatsDto:
+    return outbox.stats()
+
+
+@router.get("/email-sender/")
+async def get_email_sender_stats() -> EmailSenderStatsDto:
+    return email_sender.stats()
+
+
+@router.get("/caches/")
+async def get_cache_stats() -> Dict[str, CacheStatsDto]:
+    return {
+        "tokens": token_cache.stats(),
+        "pagination_counts": count_cache.stats(),
+        "geo_search": geo_search_cache.stats(),
+    }
@@ -1,10 +1,25 @@
+import asyncio
 import json
+from decimal import Decimal
 
 import pytest
 from mimesis import Address, Person
 from mimesis.locales import Locale
+from sqlalchemy import select
 
+from app.config import settings
+from app.domain.common import util
+from app.domain.common.util import GeoLocationHelper
+from app.domain.users import service as user_service
+from app.domain.users import spatial_index as spatial_index_module
+from app.domain.users.density_grid import density_grid
 from app.domain.users.dtos import LocationBase
+from app.domain.users.geo_search_cache import geo_search_cache
+from app.domain.users.location_coalescer import LocationCoalescer
+from app.domain.users.location_snapshot import LocationSnapshot
+from app.domain.users.nearby_feed import nearby_feed
+from app.domain.users.spatial_index import spatial_index
+from app.infrastructure.services.paginator import encode_cursor
 from app.repositories.users.models import User, UserLocation, UserProfile
 
 pytestmark = pytest.mark.anyio
@@ -20,6 +35,36 @@ async def _update_location_of_user(client, user_id: int, location: LocationBase)
     return resp
 
 
+@pytest.fixture()
+async def rebuild_spatial_index(session_maker):
+    async def rebuild():
+        async with session_maker() as session:
+            await spatial_index.rebuild(session)
+
+    yield rebuild
+    spatial_index.clear()
+
+
+async def _create_users_at(session_maker, locations):
+    async with session_maker() as session:
+        for lat, lon in locations:
+            username = person.username()
+            email = person.email()
+            password = person.password()
+            is_active = True
+            user = User(username=username, email=email, password=password, is_active=is_active)
+            latitude = lat
+            longitude = lon
+            x, y, z = GeoLocationHelper.to_unit_vector(float(lat), float(lon))
+            geohash = GeoLocationHelper.geohash(float(lat), float(lon), settings.GEOHASH_PRECISION)
+            user.location = UserLocation(
+                latitude=latitude, longitude=longitude, x=x, y=y, z=z, geohash=geohash
+            )
+            user.profile = UserProfile()
+            session.add(user)
+        await session.commit()
+
+
 async def test_update_user_location(logged_in_client):
     longitude = address.longitude()
     latitude = address.latitude()
@@ -51,19 +96,7 @@ async def test_getting_users_within_distance(session_maker, logged_in_client):
     ]
 
     # create users within 100 kms in distance to logged_in_client
-    async with session_maker() as session:
-        for lat, lon in distances_within_100kms:
-            username = person.username()
-            email = person.email()
-            password = person.password()
-            is_active = True
-            user = User(username=username, email=email, password=password, is_active=is_active)
-            latitude = lat
-            longitude = lon
-            user.location = UserLocation(latitude=latitude, longitude=longitude)
-            user.profile = UserProfile()
-            session.add(user)
-        await session.commit()
+    await _create_users_at(session_maker, distances_within_100kms)
 
     resp = await client.get("api/v1/users/?distance=100")
     assert resp.json()["total"] == 5
@@ -79,3 +112,629 @@ async def test_getting_users_within_distance(session_maker, logged_in_client):
 
     resp = await client.get("api/v1/users/?distance=5")
     assert resp.json()["total"] == 0
+
+
+async def test_paginating_users_with_cursor(session_maker, logged_in_client):
+    location = LocationBase(longitude="50.000000", latitude="50.000000")
+    client = logged_in_client.client
+    resp = await _update_location_of_user(client, logged_in_client.user.id, location)
+    assert resp.status_code == 201
+
+    # two users at the same distance, ties are broken by id
+    await _create_users_at(
+        session_maker,
+        [
+            ("50.100000", "50.000000"),
+            ("49.900000", "50.000000"),
+            ("50.200000", "50.000000"),
+            ("50.300000", "50.000000"),
+            ("50.400000", "50.000000"),
+        ],
+    )
+
+    resp = await client.get("api/v1/users/?limit=5")
+    expected = [user["id"] for user in resp.json()["results"]]
+    assert len(expected) == 5
+    assert resp.json()["next_cursor"] is None
+
+    resp = await client.get("api/v1/users/?limit=2")
+    assert resp.json()["page"] == 1
+    ids = [user["id"] for user in resp.json()["results"]]
+    while cursor := resp.json()["next_cursor"]:
+        resp = await client.get("api/v1/users/", params={"limit": 2, "cursor": cursor})
+        assert resp.json()["page"] is None
+        ids += [user["id"] for user in resp.json()["results"]]
+    assert ids == expected
+
+    resp = await client.get("api/v1/users/?cursor=invalid")
+    assert resp.status_code == 400
+    # well formed, but the values don't match the (distance, id) sort keys
+    for values in (["abc", "x"], [1.5, 2.5], [1.5, True], [1.5, None]):
+        resp = await client.get("api/v1/users/", params={"cursor": encode_cursor(values)})
+        assert resp.status_code == 400
+
+
+async def test_exporting_users_within_distance(session_maker, logged_in_client):
+    location = LocationBase(longitude="50.000000", latitude="50.000000")
+    client = logged_in_client.client
+    resp = await _update_location_of_user(client, logged_in_client.user.id, location)
+    assert resp.status_code == 201
+    await _create_users_at(
+        session_maker,
+        [("50.100000", "50.000000"), ("50.200000", "50.000000"), ("51.000000", "50.000000")],
+    )
+
+    resp = await client.get("api/v1/users/export/?distance=50")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/x-ndjson"
+    exported = [json.loads(line) for line in resp.text.splitlines()]
+
+    resp = await client.get("api/v1/users/?distance=50")
+    assert exported == resp.json()["results"]
+    assert len(exported) == 2
+
+
+async def test_exporting_users_without_a_location(logged_in_client):
+    # raised before the response starts
+    resp = await logged_in_client.client.get("api/v1/users/export/")
+    assert resp.status_code == 404
+
+
+async def test_getting_nearest_users(session_maker, logged_in_client):
+    location = LocationBase(longitude="50.000000", latitude="50.000000")
+    client = logged_in_client.client
+    resp = await _update_location_of_user(client, logged_in_client.user.id, location)
+    assert resp.status_code == 201
+    # the nearest users regardless of distance, the last one is ~1100 kms away
+    await _create_users_at(
+        session_maker,
+        [("60.000000", "50.000000"), ("50.100000", "50.000000"), ("50.200000", "50.000000")],
+    )
+
+    resp = await client.get("api/v1/users/nearest/?k=2")
+    assert resp.status_code == 200
+    distances = [user["distance"] for user in resp.json()]
+    assert [round(d) for d in distances] == [11, 22]
+
+    resp = await client.get("api/v1/users/nearest/?k=3")
+    assert round(resp.json()[-1]["distance"]) == 1112
+
+
+async def test_users_at_the_same_location_are_found(session_maker, logged_in_client):
+    location = LocationBase(longitude="50.000000", latitude="50.000000")
+    client = logged_in_client.client
+    resp = await _update_location_of_user(client, logged_in_client.user.id, location)
+    assert resp.status_code == 201
+    await _create_users_at(session_maker, [("50.000000", "50.000000")])
+
+    # only the user themselves is left out
+    resp = await client.get("api/v1/users/?distance=1")
+    assert resp.json()["total"] == 1
+    assert resp.json()["results"][0]["distance"] == pytest.approx(0, abs=1e-3)
+
+
+@pytest.mark.parametrize("strategy", ["great_circle", "unit_vector", "geohash"])
+@pytest.mark.parametrize(
+    "location, other",
+    [
+        # across the antimeridian
+        (("0.000000", "179.950000"), ("0.000000", "-179.950000")),
+        # across the north pole
+        (("89.950000", "0.000000"), ("89.950000", "180.000000")),
+    ],
+    ids=["antimeridian", "north_pole"],
+)
+async def test_searching_across_the_antimeridian_and_poles(
+    session_maker, logged_in_client, monkeypatch, strategy, location, other
+):
+    monkeypatch.setattr(settings, "GEO_SEARCH_STRATEGY", strategy)
+    lat, lon = location
+    client = logged_in_client.client
+    resp = await _update_location_of_user(
+        client, logged_in_client.user.id, LocationBase(latitude=lat, longitude=lon)
+    )
+    assert resp.status_code == 201
+    await _create_users_at(session_maker, [other])
+
+    # ~11 kms apart
+    resp = await client.get("api/v1/users/?distance=20")
+    assert resp.json()["total"] == 1
+    assert round(resp.json()["results"][0]["distance"]) == 11
+
+
+@pytest.mark.parametrize("numpy", [True, False], ids=["numpy", "python"])
+async def test_searching_the_spatial_index(
+    session_maker, logged_in_client, rebuild_spatial_index, monkeypatch, numpy
+):
+    if not numpy:
+        monkeypatch.setattr(spatial_index_module, "np", None)
+        monkeypatch.setattr(util, "np", None)
+    monkeypatch.setattr(settings, "GEO_SEARCH_STRATEGY", "unit_vector")
+    location = LocationBase(longitude="179.950000", latitude="0.000000")
+    client = logged_in_client.client
+    resp = await _update_location_of_user(client, logged_in_client.user.id, location)
+    assert resp.status_code == 201
+    await _create_users_at(
+        session_maker,
+        [
+            ("0.000000", "-179.950000"),  # across the antimeridian
+            ("0.100000", "179.950000"),
+            ("-0.100000", "179.950000"),  # same distance, ties are broken by id
+            ("0.300000", "179.800000"),
+            ("0.000000", "179.000000"),  # ~105 kms
+        ],
+    )
+    from_postgres = (await client.get("api/v1/users/?distance=100")).json()
+
+    await rebuild_spatial_index()
+    assert spatial_index.stats().size >= 6
+    resp = await client.get("api/v1/users/?distance=100")
+    assert resp.status_code == 200
+    from_index = resp.json()
+    assert from_index["total"] == from_postgres["total"] == 4
+    assert [user["id"] for user in from_index["results"]] == [
+        user["id"] for user in from_postgres["results"]
+    ]
+    for user, expected in zip(from_index["results"], from_postgres["results"]):
+        assert user["profile"] == expected["profile"]
+        assert user["distance"] == pytest.approx(expected["distance"], abs=1e-3)
+
+    resp = await client.get("api/v1/users/?distance=100&limit=3")
+    ids = [user["id"] for user in resp.json()["results"]]
+    while cursor := resp.json()["next_cursor"]:
+        resp = await client.get("api/v1/users/", params={"limit": 3, "cursor": cursor})
+        ids += [user["id"] for user in resp.json()["results"]]
+    assert ids == [user["id"] for user in from_postgres["results"]]
+
+    resp = await client.get("api/v1/users/?distance=100&limit=3&page=2")
+    assert [user["id"] for user in resp.json()["results"]] == ids[3:]
+    assert resp.json()["has_more"] is False
+
+    resp = await client.get("api/v1/users/", params={"cursor": encode_cursor(["abc", "x"])})
+    assert resp.status_code == 400
+
+
+async def test_location_updates_are_indexed(session_maker, logged_in_client, rebuild_spatial_index):
+    await _create_users_at(session_maker, [("10.000000", "10.000000")])
+    await rebuild_spatial_index()
+    user_id = logged_in_client.user.id
+    # not indexed yet, searched in postgres
+    resp = await logged_in_client.client.get("api/v1/users/?distance=100")
+    assert resp.status_code == 404
+
+    location = LocationBase(latitude="10.100000", longitude="10.000000")
+    resp = await _update_location_of_user(logged_in_client.client, user_id, location)
+    assert resp.status_code == 201
+    assert spatial_index.location_of(user_id) == (10.1, 10.0)
+    resp = await logged_in_client.client.get("api/v1/users/?distance=100")
+    assert resp.json()["total"] >= 1
+
+    location = LocationBase(latitude="-10.000000", longitude="10.000000")
+    resp = await _update_location_of_user(logged_in_client.client, user_id, location)
+    assert spatial_index.location_of(user_id) == (-10.0, 10.0)
+    resp = await logged_in_client.client.get("api/v1/users/?distance=100")
+    assert resp.json()["total"] == 0
+
+
+async def test_searching_a_shared_snapshot(
+    session_maker, logged_in_client, rebuild_spatial_index, monkeypatch, tmp_path
+):
+    snapshot = LocationSnapshot(str(tmp_path / "locations"), spatial_index.cell_degrees)
+    monkeypatch.setattr(spatial_index, "_snapshot", snapshot)
+    client = logged_in_client.client
+    location = LocationBase(latitude="50.000000", longitude="50.000000")
+    resp = await _update_location_of_user(client, logged_in_client.user.id, location)
+    assert resp.status_code == 201
+    await _create_users_at(session_maker, [("50.100000", "50.000000"), ("50.300000", "50.000000")])
+    from_postgres = (await client.get("api/v1/users/?distance=50")).json()
+
+    await rebuild_spatial_index()
+    assert spatial_index.stats().shared is True
+    from_index = (await client.get("api/v1/users/?distance=50")).json()
+    assert from_index["total"] == from_postgres["total"] == 2
+    assert [user["id"] for user in from_index["results"]] == [
+        user["id"] for user in from_postgres["results"]
+    ]
+
+    # written to the delta log, searched right away
+    location = LocationBase(latitude="10.000000", longitude="10.000000")
+    resp = await _update_location_of_user(client, logged_in_client.user.id, location)
+    assert snapshot.location_of(logged_in_client.user.id) == (10.0, 10.0)
+    resp = await client.get("api/v1/users/?distance=50")
+    assert resp.json()["total"] == 0
+
+
+@pytest.fixture()
+def cached_geo_search(monkeypatch):
+    monkeypatch.setattr(geo_search_cache, "cell_degrees", 0.01)
+    geo_search_cache.clear()
+    yield geo_search_cache
+    geo_search_cache.clear()
+
+
+async def test_nearby_users_are_cached_per_cell(session_maker, logged_in_client, cached_geo_search):
+    client = logged_in_client.client
+    user_id = logged_in_client.user.id
+    location = LocationBase(latitude="50.001000", longitude="50.001000")
+    resp = await _update_location_of_user(client, user_id, location)
+    assert resp.status_code == 201
+    # the first one is in the same cell
+    await _create_users_at(
+        session_maker,
+        [("50.008000", "50.008000"), ("50.100000", "50.000000"), ("50.200000", "50.000000")],
+    )
+
+    resp = await client.get("api/v1/users/?distance=50")
+    assert resp.status_code == 200
+    first = resp.json()
+    assert first["total"] == 3
+    assert user_id not in [user["id"] for user in first["results"]]
+    stats = cached_geo_search.stats()
+    assert (stats.hits, stats.misses, stats.size) == (0, 1, 1)
+
+    resp = await client.get("api/v1/users/?distance=50")
+    assert resp.json() == first
+    assert cached_geo_search.stats().hits == 1
+    # searched from the cell's center, the user is left out of the shared candidates afterwards
+    (candidates,) = [candidates for _, candidates in cached_geo_search._entries.values()]
+    assert user_id in candidates.ids
+
+    # moving within the radius evicts the page
+    location = LocationBase(latitude="50.002000", longitude="50.002000")
+    resp = await _update_location_of_user(client, user_id, location)
+    assert len(cached_geo_search) == 0
+    resp = await client.get("api/v1/users/?distance=50")
+    assert resp.json()["total"] == 3
+    assert cached_geo_search.stats().misses == 2
+
+
+async def test_cached_totals_leave_out_the_user(session_maker, logged_in_client, cached_geo_search):
+    client = logged_in_client.client
+    location = LocationBase(latitude="50.001000", longitude="50.001000")
+    await _update_location_of_user(client, logged_in_client.user.id, location)
+    # nearer to the cell's center than the user
+    await _create_users_at(session_maker, [("50.005000", "50.005000"), ("50.100000", "50.000000")])
+
+    # the user isn't on the first page of the search from the center
+    resp = await client.get("api/v1/users/?distance=50&limit=1")
+    assert resp.json()["total"] == 2
+    hits = cached_geo_search.stats().hits
+    resp = await client.get("api/v1/users/?distance=50&limit=1")
+    assert resp.json()["total"] == 2
+    assert cached_geo_search.stats().hits == hits + 1
+
+
+async def test_cached_users_are_measured_from_the_user(
+    session_maker, logged_in_client, cached_geo_search
+):
+    client = logged_in_client.client
+    user_id = logged_in_client.user.id
+    location = LocationBase(latitude="50.001000", longitude="50.001000")
+    await _update_location_of_user(client, user_id, location)
+    # at the user's location, within 1 km of the cell's center but not of the user,
+    # within 1 km of the user but not of the cell's center
+    await _create_users_at(
+        session_maker,
+        [("50.001000", "50.001000"), ("50.011000", "50.011000"), ("49.995000", "49.995000")],
+    )
+
+    for _ in range(2):
+        resp = await client.get("api/v1/users/?distance=1")
+        users = resp.json()
+        assert users["total"] == 2
+        same, near = users["results"]
+        assert same["distance"] == pytest.approx(0, abs=1e-6)
+        assert near["distance"] == pytest.approx(
+            GeoLocationHelper.haversine_distance(50.001, 50.001, 49.995, 49.995), abs=1e-6
+        )
+        assert user_id not in [user["id"] for user in users["results"]]
+    assert cached_geo_search.stats().hits >= 1
+
+
+@pytest.fixture()
+def location_coalescer(monkeypatch):
+    coalescer = LocationCoalescer(flush_seconds=1, batch_size=2, min_distance=10)
+    monkeypatch.setattr(user_service, "location_coalescer", coalescer)
+    return coalescer
+
+
+async def _location_of(session_maker, user_id: int) -> UserLocation | None:
+    async with session_maker() as session:
+        query = select(UserLocation).where(UserLocation.user_id == user_id)
+        return (await session.scalars(query.execution_options(populate_existing=True))).first()
+
+
+async def test_submitting_locations(session_maker, logged_in_client, location_coalescer):
+    client = logged_in_client.client
+    user_id = logged_in_client.user.id
+    await _create_users_at(session_maker, [("10.000000", "10.000000")] * 2)
+    async with session_maker() as session:
+        query = select(UserLocation.user_id).order_by(UserLocation.id.desc()).limit(2)
+        other_ids = (await session.scalars(query)).all()
+    pings = [
+        {"latitude": "50.000000", "longitude": "50.000000"},
+        {"latitude": "50.100000", "longitude": "50.000000"},
+        # ~1 meter further, dropped
+        {"latitude": "50.100010", "longitude": "50.000000"},
+    ]
+    resp = await client.post("api/v1/users/me/locations/", json=pings)
+    assert resp.status_code == 202
+    assert resp.json() == {"received": 3, "queued": False}
+    # nothing is written until the flush
+    assert await _location_of(session_maker, user_id) is None
+    for other_id in other_ids:
+        location_coalescer.submit(other_id, Decimal("11.000000"), Decimal("11.000000"))
+
+    async with session_maker() as session:
+        # in batches of two
+        assert await location_coalescer.flush(session) == 3
+    location = await _location_of(session_maker, user_id)
+    assert (location.latitude, location.longitude) == (Decimal("50.1"), Decimal("50"))
+    x, y, z = GeoLocationHelper.to_unit_vector(50.1, 50.0)
+    assert (location.x, location.y, location.z) == pytest.approx((x, y, z))
+    assert location.geohash == GeoLocationHelper.geohash(50.1, 50.0, settings.GEOHASH_PRECISION)
+    for other_id in other_ids:
+        location = await _location_of(session_maker, other_id)
+        assert (location.latitude, location.longitude) == (Decimal("11"), Decimal("11"))
+    stats = location_coalescer.stats()
+    assert (stats.written, stats.flushes, stats.pending) == (3, 1, 0)
+
+    # searched from the flushed location
+    resp = await client.get("api/v1/users/?distance=100")
+    assert resp.status_code == 200
+    assert not set(other_ids) & {user["id"] for user in resp.json()["results"]}
+
+
+async def test_submitting_locations_is_validated(logged_in_client, location_coalescer):
+    client = logged_in_client.client
+    url = "api/v1/users/me/locations/"
+    resp = await client.post(url, json=[])
+    assert resp.status_code == 422
+    pings = [{"latitude": "50.000000", "longitude": "50.000000"}] * (
+        settings.LOCATION_BATCH_MAX_SIZE + 1
+    )
+    resp = await client.post(url, json=pings)
+    assert resp.status_code == 422
+    resp = await client.post(url, json=[{"latitude": "91.000000", "longitude": "50.000000"}])
+    assert resp.status_code == 422
+    assert len(location_coalescer) == 0
+
+
+async def test_flushed_locations_are_indexed(
+    session_maker, logged_in_client, location_coalescer, rebuild_spatial_index
+):
+    user_id = logged_in_client.user.id
+    location = LocationBase(latitude="10.000000", longitude="10.000000")
+    await _update_location_of_user(logged_in_client.client, user_id, location)
+    await rebuild_spatial_index()
+
+    # compared with the indexed position
+    assert not location_coalescer.submit(user_id, Decimal("10.000001"), Decimal("10.000000"))
+    assert location_coalescer.submit(user_id, Decimal("-10.000000"), Decimal("10.000000"))
+    async with session_maker() as session:
+        await location_coalescer.flush(session)
+    assert spatial_index.location_of(user_id) == (-10.0, 10.0)
+
+
+async def test_pings_are_compared_with_flushed_locations(
+    session_maker, logged_in_client, location_coalescer
+):
+    user_id = logged_in_client.user.id
+    assert location_coalescer.submit(user_id, Decimal("10.000000"), Decimal("10.000000"))
+    async with session_maker() as session:
+        await location_coalescer.flush(session)
+    # without the spatial index
+    assert not spatial_index.warm
+    assert not location_coalescer.submit(user_id, Decimal("10.000001"), Decimal("10.000000"))
+    assert location_coalescer.submit(user_id, Decimal("-10.000000"), Decimal("10.000000"))
+
+
+async def test_rows_that_cant_be_written_are_dropped(
+    session_maker, logged_in_client, location_coalescer
+):
+    user_id = logged_in_client.user.id
+    location_coalescer.submit(user_id, Decimal("10.000000"), Decimal("10.000000"))
+    # no such user
+    location_coalescer.submit(-1, Decimal("10.000000"), Decimal("10.000000"))
+    async with session_maker() as session:
+        assert await location_coalescer.flush(session) == 1
+    location = await _location_of(session_maker, user_id)
+    assert (location.latitude, location.longitude) == (Decimal("10"), Decimal("10"))
+    stats = location_coalescer.stats()
+    assert (stats.pending, stats.rejected, stats.written, stats.failed_flushes) == (0, 1, 1, 0)
+
+    # the next flushes aren't held up by it
+    location_coalescer.submit(-1, Decimal("10.000000"), Decimal("10.000000"))
+    location_coalescer.submit(user_id, Decimal("20.000000"), Decimal("10.000000"))
+    async with session_maker() as session:
+        assert await location_coalescer.flush(session) == 1
+    location = await _location_of(session_maker, user_id)
+    assert location.latitude == Decimal("20")
+
+
+async def test_failed_flushes_are_retried(
+    session_maker, logged_in_client, location_coalescer, monkeypatch
+):
+    user_id = logged_in_client.user.id
+    location_coalescer.submit(user_id, Decimal("10.000000"), Decimal("10.000000"))
+
+    async def fail(session, moves):
+        raise RuntimeError()
+
+    monkeypatch.setattr(density_grid, "apply", fail)
+    for _ in range(location_coalescer.max_attempts):
+        assert len(location_coalescer) == 1
+        with pytest.raises(RuntimeError):
+            async with session_maker() as session:
+                await location_coalescer.flush(session)
+    assert await _location_of(session_maker, user_id) is None
+    # given up on after max_attempts
+    stats = location_coalescer.stats()
+    assert (stats.pending, stats.rejected) == (0, 1)
+    assert stats.failed_flushes == location_coalescer.max_attempts
+
+
+def _events(body: str):
+    for message in body.strip().split("\n\n"):
+        event, data = message.split("\n")
+        yield event.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+
+async def test_subscribing_to_nearby_users(session_maker, logged_in_client, monkeypatch):
+    client = logged_in_client.client
+    user_id = logged_in_client.user.id
+    resp = await client.get("api/v1/users/feed/")
+    assert resp.status_code == 404
+
+    location = LocationBase(latitude="50.000000", longitude="50.000000")
+    await _update_location_of_user(client, user_id, location)
+    await _create_users_at(session_maker, [("50.100000", "50.000000"), ("52.000000", "50.000000")])
+    async with session_maker() as session:
+        query = select(UserLocation.user_id).order_by(UserLocation.id.desc()).limit(2)
+        far_id, near_id = (await session.scalars(query)).all()
+
+    streaming = asyncio.Event()
+    stream = nearby_feed.stream
+
+    async def signalling_stream(subscription, snapshot):
+        async for chunk in stream(subscription, snapshot):
+            yield chunk
+            streaming.set()
+
+    monkeypatch.setattr(nearby_feed, "stream", signalling_stream)
+    # the test client only returns once the stream ends
+    feed = asyncio.create_task(client.get("api/v1/users/feed/?distance=50"))
+    await streaming.wait()
+
+    coalescer = LocationCoalescer(flush_seconds=1, batch_size=10, min_distance=0)
+
+    async def move(moving_id, latitude, longitude):
+        coalescer.submit(moving_id, Decimal(latitude), Decimal(longitude))
+        async with session_maker() as session:
+            await coalescer.flush(session)
+
+    await move(far_id, "50.200000", "50.000000")
+    await move(near_id, "50.150000", "50.000000")
+    await move(near_id, "51.000000", "50.000000")
+    location = LocationBase(latitude="10.000000", longitude="10.000000")
+    await _update_location_of_user(client, user_id, location)
+
+    resp = await feed
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/event-stream")
+    events = list(_events(resp.text))
+    (event, snapshot), *events = events
+    assert event == "snapshot"
+    assert [user["id"] for user in snapshot["results"]] == [near_id]
+    assert [(event, data.get("id")) for event, data in events] == [
+        ("enter", far_id),
+        ("move", near_id),
+        ("leave", near_id),
+        ("recenter", None),
+    ]
+    assert nearby_feed.stats().subscribers == 0
+
+
+async def test_nearby_feed_subscribers_are_limited(logged_in_client, monkeypatch):
+    client = logged_in_client.client
+    location = LocationBase(latitude="50.000000", longitude="50.000000")
+    await _update_location_of_user(client, logged_in_client.user.id, location)
+    monkeypatch.setattr(nearby_feed, "max_subscribers", 0)
+    resp = await client.get("api/v1/users/feed/")
+    assert resp.status_code == 503
+
+
+async def test_unsent_nearby_feeds_are_not_subscribed(session_maker, logged_in_client):
+    client = logged_in_client.client
+    location = LocationBase(latitude="50.000000", longitude="50.000000")
+    await _update_location_of_user(client, logged_in_client.user.id, location)
+
+    service = user_service.UserService(session_maker())
+    # the client left before the response body started
+    await service.subscribe_users_within_distance(logged_in_client.user.id)
+    assert nearby_feed.stats().subscribers == 0
+
+
+async def _density(client, min_latitude, max_latitude, min_longitude, max_longitude, **params):
+    box = {
+        "min_latitude": min_latitude,
+        "max_latitude": max_latitude,
+        "min_longitude": min_longitude,
+        "max_longitude": max_longitude,
+    }
+    resp = await client.get("api/v1/users/density/", params={**box, **params})
+    assert resp.status_code == 200, resp.text
+    return resp.json()
+
+
+async def _check_density_grid(session_maker, repair=True):
+    async with session_maker() as session:
+        return await density_grid.check(session, repair=repair)
+
+
+def _cells(density):
+    return [(cell["latitude"], cell["longitude"], cell["count"]) for cell in density["cells"]]
+
+
+async def test_user_density(session_maker, logged_in_client, location_coalescer):
+    client = logged_in_client.client
+    user_id = logged_in_client.user.id
+    # written without the grid, the check counts them
+    await _create_users_at(
+        session_maker,
+        [("33.350000", "44.450000"), ("33.360000", "44.460000"), ("33.750000", "44.450000")],
+    )
+    results = await _check_density_grid(session_maker)
+    assert [check.zoom for check in results] == [0, 1, 2]
+
+    density = await _density(client, 33, 34, 44, 45, zoom=0)
+    assert _cells(density) == [(33, 44, 3)]
+    # too many cells at 0.01 degrees
+    density = await _density(client, 33, 34, 44, 45)
+    assert (density["zoom"], density["cell_degrees"], density["total"]) == (1, 0.1, 3)
+    assert _cells(density) == [(33.3, 44.4, 2), (33.7, 44.4, 1)]
+
+    # the old cell loses the user, the new one gains them
+    location = LocationBase(latitude="33.710000", longitude="44.410000")
+    await _update_location_of_user(client, user_id, location)
+    assert _cells(await _density(client, 33, 34, 44, 45)) == [(33.3, 44.4, 2), (33.7, 44.4, 2)]
+    location = LocationBase(latitude="33.350000", longitude="44.450000")
+    await _update_location_of_user(client, user_id, location)
+    assert _cells(await _density(client, 33, 34, 44, 45)) == [(33.3, 44.4, 3), (33.7, 44.4, 1)]
+    density = await _density(client, 33.3, 33.4, 44.4, 44.5, zoom=2)
+    assert _cells(density) == [(33.35, 44.45, 2), (33.36, 44.46, 1)]
+
+    # and so do flushed locations
+    location_coalescer.submit(user_id, Decimal("-33.500000"), Decimal("44.500000"))
+    async with session_maker() as session:
+        await location_coalescer.flush(session)
+    assert _cells(await _density(client, 33, 34, 44, 45)) == [(33.3, 44.4, 2), (33.7, 44.4, 1)]
+    assert _cells(await _density(client, -34, -33, 44, 45, zoom=0)) == [(-34, 44, 1)]
+
+    results = await _check_density_grid(session_maker, repair=False)
+    assert [check.mismatched_cells for check in results] == [0, 0, 0]
+
+
+async def test_user_density_across_the_antimeridian(session_maker, logged_in_client):
+    client = logged_in_client.client
+    await _create_users_at(
+        session_maker, [("10.500000", "179.950000"), ("10.500000", "-179.950000")]
+    )
+    await _check_density_grid(session_maker)
+
+    density = await _density(client, 10, 11, 179.5, -179.5, zoom=1)
+    assert _cells(density) == [(10.5, -180, 1), (10.5, 179.9, 1)]
+    assert density["total"] == 2
+
+
+async def test_user_density_is_validated(logged_in_client):
+    client = logged_in_client.client
+    box = {"min_latitude": 10, "max_latitude": 11, "min_longitude": 10, "max_longitude": 11}
+    resp = await client.get("api/v1/users/density/", params={**box, "min_latitude": 12})
+    assert resp.status_code == 400
+    resp = await client.get("api/v1/users/density/", params={**box, "zoom": 2})
+    assert resp.status_code == 400
+    resp = await client.get("api/v1/users/density/", params={**box, "zoom": 3})
+    assert resp.status_code == 400
+    resp = await client.get("api/v1/users/density/", params={**box, "max_longitude": 181})
+    assert resp.status_code == 422
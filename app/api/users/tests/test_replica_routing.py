@@ -0,0 +1,74 @@
+import pytest
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.domain.auth.services.user_service import UserService
+from app.domain.users.dtos import LocationBase
+from app.infrastructure.services import session_service
+from app.infrastructure.services.replicas import ReplicaRouter
+from app.repositories.users.models import User, UserProfile
+
+from .test_location import _update_location_of_user
+
+pytestmark = pytest.mark.anyio
+
+# far beyond the primary's sequences, so the ids only ever exist on the replica
+REPLICA_ONLY_ID = 2_000_000_000
+
+
+async def test_reads_are_routed_to_replica(logged_in_client, replica_engine, monkeypatch):
+    client = logged_in_client.client
+    user_id = logged_in_client.user.id
+
+    # resolve the token on the primary, the replica doesn't know the logged in user
+    resp = await client.get("api/v1/me/")
+    assert resp.status_code == 200
+
+    monkeypatch.setattr(
+        session_service,
+        "replica_router",
+        ReplicaRouter(engines=[replica_engine], selection="round_robin", read_your_writes=60),
+    )
+    async with AsyncSession(replica_engine) as session:
+        user = User(
+            id=REPLICA_ONLY_ID,
+            username="replica_only",
+            email="replica_only@mail.com",
+            is_active=True,
+        )
+        user.profile = UserProfile(id=REPLICA_ONLY_ID)
+        session.add(user)
+        await session.commit()
+
+    try:
+        resp = await client.get(f"api/v1/users/{REPLICA_ONLY_ID}/")
+        assert resp.status_code == 200
+        resp = await client.get(f"api/v1/users/{user_id}/")
+        assert resp.status_code == 404
+
+        # writes go to the primary
+        location = LocationBase(latitude="50.000000", longitude="50.000000")
+        resp = await _update_location_of_user(client, user_id, location)
+        assert resp.status_code == 201
+
+        # the user just wrote, so they read their own location back from the primary
+        resp = await client.get("api/v1/users/")
+        assert resp.status_code == 200
+    finally:
+        async with AsyncSession(replica_engine) as session:
+            await session.execute(delete(User).where(User.id == REPLICA_ONLY_ID))
+            await session.execute(delete(UserProfile).where(UserProfile.id == REPLICA_ONLY_ID))
+            await session.commit()
+
+
+async def test_claims_are_read_from_the_primary(
+    session_maker, logged_in_client, replica_engine, monkeypatch
+):
+    monkeypatch.setattr(
+        session_service,
+        "replica_router",
+        ReplicaRouter(engines=[replica_engine], selection="round_robin", read_your_writes=60),
+    )
+    # the replica doesn't know the logged in user yet
+    claims = await UserService(session_maker()).get_user_claims(logged_in_client.user.id)
+    assert claims.id == logged_in_client.user.id
@@ -0,0 +1,117 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.domain.auth.services.token_cache import token_cache
+from app.domain.users.dtos import LocationBase
+
+from .test_location import _update_location_of_user
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture()
+def checkouts():
+    """
+    Collects the connections sessions check out, a session begins once per connection it uses
+    """
+    connections = []
+
+    def on_begin(session, transaction, connection):
+        connections.append(connection)
+
+    event.listen(Session, "after_begin", on_begin)
+    yield connections
+    event.remove(Session, "after_begin", on_begin)
+
+
+@pytest.fixture()
+def statements():
+    """
+    Collects the statements services execute through their sessions
+    """
+    executed = []
+
+    def on_execute(orm_execute_state):
+        executed.append(orm_execute_state.statement)
+
+    event.listen(Session, "do_orm_execute", on_execute)
+    yield executed
+    event.remove(Session, "do_orm_execute", on_execute)
+
+
+async def _count_checkouts(checkouts, request) -> int:
+    # resolve the user from the database instead of the token cache
+    token_cache.clear()
+    checkouts.clear()
+    resp = await request
+    assert resp.status_code < 400
+    return len(checkouts)
+
+
+async def test_one_connection_per_request(logged_in_client, checkouts):
+    client = logged_in_client.client
+    user_id = logged_in_client.user.id
+    location = LocationBase(latitude="50.000000", longitude="50.000000")
+    resp = await _update_location_of_user(client, user_id, location)
+    assert resp.status_code == 201
+
+    assert await _count_checkouts(checkouts, client.get("api/v1/me/")) == 1
+    assert await _count_checkouts(checkouts, client.get("api/v1/users/")) == 1
+    assert await _count_checkouts(checkouts, client.get(f"api/v1/users/{user_id}/")) == 1
+
+    payload = {"first_name": "first", "last_name": "last", "birthday": "1990-01-01"}
+    request = client.put("api/v1/users/me/profile/", json=payload)
+    assert await _count_checkouts(checkouts, request) == 1
+
+
+async def _count_statements(client, statements, request) -> int:
+    # writes evict the user's tokens, resolve the user into the token cache first
+    resp = await client.get("api/v1/me/")
+    assert resp.status_code == 200
+    statements.clear()
+    resp = await request
+    assert resp.status_code < 400
+    return len(statements)
+
+
+async def test_single_statement_writes(logged_in_client, statements):
+    client = logged_in_client.client
+    user_id = logged_in_client.user.id
+
+    location = LocationBase(latitude="50.000000", longitude="50.000000")
+    # inserts the location and counts it in the density grid, then updates it within its cells
+    request = _update_location_of_user(client, user_id, location)
+    assert await _count_statements(client, statements, request) == 2
+    request = _update_location_of_user(client, user_id, location)
+    assert await _count_statements(client, statements, request) == 1
+
+    payload = {"first_name": "first", "last_name": "last", "birthday": "1990-01-01"}
+    request = client.put("api/v1/users/me/profile/", json=payload)
+    assert await _count_statements(client, statements, request) == 1
+
+
+async def test_tokens_are_evicted_once_committed(logged_in_client, monkeypatch):
+    client = logged_in_client.client
+    user_id = logged_in_client.user.id
+    events = []
+
+    def on_commit(session):
+        events.append("commit")
+
+    monkeypatch.setattr(token_cache, "evict_user", lambda user_id: events.append("evict"))
+    event.listen(Session, "before_commit", on_commit)
+    try:
+        location = LocationBase(latitude="50.000000", longitude="50.000000")
+        resp = await _update_location_of_user(client, user_id, location)
+        assert resp.status_code == 201
+        # a request resolving the user in between would cache the claims from before the write
+        assert events == ["commit", "evict"]
+
+        events.clear()
+        payload = {"first_name": "first", "last_name": "last", "birthday": "1990-01-01"}
+        resp = await client.put("api/v1/users/me/profile/", json=payload)
+        assert resp.status_code == 201
+        assert events == ["commit", "evict"]
+    finally:
+        event.remove(Session, "before_commit", on_commit)
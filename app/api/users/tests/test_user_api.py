@@ -30,6 +30,20 @@ async def test_creating_user_with_existing_email(client):
     assert resp.status_code == 400
 
 
+async def test_creating_user_with_existing_username(client):
+    user_data = RegisterPayload(
+        email=person.email(),
+        password=person.password(),
+        username=person.username(),
+    )
+    resp = await _create_user(client, user_data)
+    assert resp.status_code == 201
+
+    user_data.email = person.email()
+    resp = await _create_user(client, user_data)
+    assert resp.status_code == 400
+
+
 async def test_getting_users(logged_in_client):
     client = logged_in_client.client
 
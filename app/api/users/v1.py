@@ -1,10 +1,14 @@
-from typing import Annotated
+from typing import Annotated, List
 
-from fastapi import APIRouter, Depends, Query, status
+from fastapi import APIRouter, Body, Depends, Query, status
+from fastapi.responses import StreamingResponse
 
+from app.config import settings
 from app.domain.common.services.token_decode_service import TokenDecodeService
 from app.domain.users.dtos import (
+    DensityDto,
     LocationBase,
+    LocationBatchResultDto,
     LocationDto,
     UserProfileBase,
     UserProfileDto,
@@ -13,24 +17,103 @@ from app.domain.users.dtos import (
 )
 from app.domain.users.service import UserService
 from app.infrastructure.dtos import PaginationDto
+from app.infrastructure.responses import ModelResponse
+from app.infrastructure.services.session_service import UnitOfWorkRoute
+from app.infrastructure.services.sse import SSE_HEADERS
 
-router = APIRouter(prefix="/users")
+router = APIRouter(prefix="/users", route_class=UnitOfWorkRoute)
 
 
-@router.get("/")
+@router.get("/", response_model=PaginationDto[UserWithDistanceDto])
 async def get_users(
     user: Annotated[UserWithProfileDto, Depends(TokenDecodeService())],
     service: UserService = Depends(UserService),
     page: int = Query(ge=0, default=1),
     limit: int = Query(ge=1, le=100, default=100),
     distance: int = Query(ge=0, le=100, default=100),
-) -> PaginationDto[UserWithDistanceDto]:
-    return await service.get_users_within_distance(
+    cursor: str | None = Query(default=None, description="next_cursor of the previous page"),
+) -> ModelResponse:
+    # the page is validated by the service already, skip validating the response again
+    page_dto = await service.get_users_within_distance(
         user_id=user.id,
         page=page,
         limit=limit,
         distance=distance,
+        cursor=cursor,
     )
+    return ModelResponse(page_dto)
+
+
+@router.get(
+    "/export/",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {}}}},
+)
+async def export_users(
+    user: Annotated[UserWithProfileDto, Depends(TokenDecodeService())],
+    service: UserService = Depends(UserService),
+    distance: int = Query(ge=0, le=100, default=100),
+) -> StreamingResponse:
+    """
+    Every user within distance, nearest first, one UserWithDistanceDto JSON per line
+    """
+    users = await service.stream_users_within_distance(user_id=user.id, distance=distance)
+    return StreamingResponse(users, media_type="application/x-ndjson")
+
+
+@router.get(
+    "/feed/",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"text/event-stream": {}}}},
+)
+async def subscribe_users(
+    user: Annotated[UserWithProfileDto, Depends(TokenDecodeService())],
+    service: UserService = Depends(UserService),
+    limit: int = Query(ge=1, le=100, default=100),
+    distance: int = Query(ge=0, le=100, default=100),
+) -> StreamingResponse:
+    """
+    Server-sent events of the users within distance. A `snapshot` event with the first page
+    of GET /users/ comes first, then `enter` and `move` events with the id and distance of
+    a user, and `leave` events with the id. The stream ends with a `recenter` event once
+    the user moves, or `resync` if they fall behind, subscribe again to start over.
+    """
+    return StreamingResponse(
+        await service.subscribe_users_within_distance(
+            user_id=user.id, distance=distance, limit=limit
+        ),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+
+@router.get("/density/")
+async def get_user_density(
+    user: Annotated[UserWithProfileDto, Depends(TokenDecodeService())],
+    service: UserService = Depends(UserService),
+    min_latitude: float = Query(ge=-90, le=90),
+    max_latitude: float = Query(ge=-90, le=90),
+    min_longitude: float = Query(ge=-180, le=180),
+    max_longitude: float = Query(ge=-180, le=180),
+    zoom: int | None = Query(ge=0, default=None),
+) -> DensityDto:
+    """
+    Users per cell of the density grid within the box, the cells without users are left out.
+    A min_longitude greater than max_longitude wraps around the antimeridian. Without a zoom,
+    the finest level with at most DENSITY_GRID_MAX_CELLS cells in the box is used.
+    """
+    return await service.get_user_density(
+        min_latitude, max_latitude, min_longitude, max_longitude, zoom
+    )
+
+
+@router.get("/nearest/")
+async def get_nearest_users(
+    user: Annotated[UserWithProfileDto, Depends(TokenDecodeService())],
+    service: UserService = Depends(UserService),
+    k: int = Query(ge=1, le=100, default=10),
+) -> List[UserWithDistanceDto]:
+    return await service.get_nearest_users(user_id=user.id, k=k)
 
 
 @router.get("/{id}/")
@@ -57,3 +140,18 @@ async def update_user_location(
     user_service: UserService = Depends(UserService),
 ) -> LocationDto:
     return await user_service.update_user_location(user, location)
+
+
+@router.post("/me/locations/", status_code=status.HTTP_202_ACCEPTED)
+async def submit_user_locations(
+    locations: Annotated[
+        List[LocationBase], Body(min_length=1, max_length=settings.LOCATION_BATCH_MAX_SIZE)
+    ],
+    user: Annotated[UserWithProfileDto, Depends(TokenDecodeService())],
+    user_service: UserService = Depends(UserService),
+) -> LocationBatchResultDto:
+    """
+    Pings of the user's location, oldest first. They're written in batches with other users'
+    pings, only the latest one is, and only if it moved the user far enough.
+    """
+    return user_service.submit_user_locations(user, locations)
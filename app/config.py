@@ -1,6 +1,12 @@
-from typing import Any, List, Union
+from typing import Any, List, Literal, Union
 
-from pydantic import AnyHttpUrl, FieldValidationInfo, PostgresDsn, field_validator
+from pydantic import (
+    AnyHttpUrl,
+    FieldValidationInfo,
+    PostgresDsn,
+    SecretStr,
+    field_validator,
+)
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -25,6 +31,8 @@ class Settings(BaseSettings):
     DATABASE_URI: PostgresDsn | None = None
     TEST_DATABASE_URI: PostgresDsn | None = None
     API_V1_STR: str = "api/v1"
+    # Bearer token of the /internal/ operational endpoints, they answer 404 while it's unset
+    INTERNAL_API_TOKEN: SecretStr | None = None
 
     @field_validator("DATABASE_URI", mode="before")
     def assemble_db_connection(cls, v: str | None, values: FieldValidationInfo) -> Any:
@@ -54,6 +62,23 @@ class Settings(BaseSettings):
             path=f"{values.get('TEST_POSTGRES_DB') or ''}",
         )
 
+    # read-only queries are spread over these, a JSON list, i.e. ["postgresql+asyncpg://..."]
+    DATABASE_REPLICA_URIS: List[PostgresDsn] = []
+    DB_REPLICA_SELECTION: Literal["round_robin", "least_connections"] = "round_robin"
+    # users keep reading from the primary for this long after they wrote something
+    DB_READ_YOUR_WRITES_SECONDS: float = 5
+
+    # Database engine and connection pool
+    DB_ECHO: bool = False
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30
+    # seconds after which a connection is replaced, -1 keeps connections forever
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    # asyncpg's prepared statement cache per connection, 0 disables it (i.e. behind pgbouncer)
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = 100
+
     # JWT Configs
     JWT_EMAIL_SECRET_KEY: str
     JWT_ACCESS_SECRET_KEY: str
@@ -62,6 +87,40 @@ class Settings(BaseSettings):
     JWT_EMAIL_TOKEN_EXPIRE_MINUTES: str
     JWT_ACCESS_TOKEN_EXPIRE_HOURS: str
     JWT_REFRESH_TOKEN_EXPIRE_DAYS: str
+    # embed the user in access tokens, authenticated requests then don't query the user at all
+    AUTH_CLAIMS_ONLY: bool = False
+
+    # Verified access token cache
+    TOKEN_CACHE_MAX_SIZE: int = 10_000
+    TOKEN_CACHE_TTL_SECONDS: int = 60
+
+    # Password hashing, runs on a "process" or "thread" pool, "inline" hashes on the event loop
+    PASSWORD_HASHER_EXECUTOR: Literal["process", "thread", "inline"] = "process"
+    PASSWORD_HASHER_WORKERS: int = 2
+    PASSWORD_HASHER_MAX_IN_FLIGHT: int = 2
+    PASSWORD_HASHER_MAX_QUEUED: int = 256
+
+    # Domain events, handled by the request raising them ("inline") or put on a queue per event
+    # type and handled by MEDIATOR_WORKERS tasks per type ("queued"), once the app has started
+    MEDIATOR_DISPATCH: Literal["inline", "queued"] = "queued"
+    MEDIATOR_WORKERS: int = 4
+    MEDIATOR_QUEUE_SIZE: int = 1_000
+    # events sent to a full queue wait for room, are dropped, or are handled by the sender
+    MEDIATOR_BACKPRESSURE: Literal["block", "drop", "inline"] = "block"
+    # the events still queued at shutdown are handled for at most this long
+    MEDIATOR_DRAIN_SECONDS: float = 10
+
+    # Domain events that must survive a crash are written to the outbox by the transaction
+    # raising them, and handed to the Mediator's handlers by a dispatcher on every worker.
+    # A dispatcher claims up to OUTBOX_BATCH_SIZE events for OUTBOX_LEASE_SECONDS at a time,
+    # other workers skip them until then
+    OUTBOX_DISPATCHER_ENABLED: bool = True
+    OUTBOX_BATCH_SIZE: int = 100
+    OUTBOX_POLL_SECONDS: float = 1
+    OUTBOX_LEASE_SECONDS: float = 60
+    # failed events are retried after OUTBOX_RETRY_SECONDS times their attempts, then given up on
+    OUTBOX_RETRY_SECONDS: float = 10
+    OUTBOX_MAX_ATTEMPTS: int = 10
 
     # MINIO Configs
     MINIO_ROOT_USER: str
@@ -85,9 +144,81 @@ class Settings(BaseSettings):
     EMAIL_USE_CREDENTIALS: bool = True
     EMAIL_VALIDATE_CERTS: bool = True
     EMAIL_SUPRESS_SEND: bool = False
+    EMAIL_TEMPLATE_FOLDER: str = "app/templates"
+    # compiled templates are cached on disk, other workers and restarts don't compile them again
+    EMAIL_TEMPLATE_BYTECODE_CACHE: bool = True
+    # Messages are queued and sent over EMAIL_CONNECTIONS persistent SMTP connections,
+    # a connection sends up to EMAIL_BATCH_SIZE queued messages before taking the next ones
+    EMAIL_CONNECTIONS: int = 2
+    EMAIL_QUEUE_SIZE: int = 1_000
+    EMAIL_BATCH_SIZE: int = 50
+    EMAIL_TIMEOUT_SECONDS: float = 30
+    # the messages still queued at shutdown are sent for at most this long
+    EMAIL_DRAIN_SECONDS: float = 10
 
     # Max amount of results per api call
     MAX_PAGE_SIZE: int = 100
+    # How nearby users are searched, "earthdistance" needs the cube and earthdistance extensions
+    # and the index their migration only creates if they could be installed
+    GEO_SEARCH_STRATEGY: Literal[
+        "great_circle", "earthdistance", "unit_vector", "geohash"
+    ] = "great_circle"
+    # length of the stored user_locations.geohash, existing rows must be backfilled after a change
+    GEOHASH_PRECISION: int = 8
+    # Users within a distance are searched in memory instead of through GEO_SEARCH_STRATEGY,
+    # once the locations are loaded at startup. Without GEO_INDEX_SNAPSHOT_PATH every worker
+    # holds its own copy, other workers' writes show up after up to GEO_INDEX_REFRESH_SECONDS
+    GEO_INDEX_ENABLED: bool = False
+    GEO_INDEX_CELL_DEGREES: float = 1.0
+    # reloads the locations this often to pick up other workers' writes, 0 never reloads
+    GEO_INDEX_REFRESH_SECONDS: float = 300
+    # workers of a host share the index through a snapshot file at this path, and a delta log
+    # next to it, instead of loading a copy each. Must be on a local filesystem.
+    GEO_INDEX_SNAPSHOT_PATH: str | None = None
+    # Nearby users are cached and shared by everyone in the same cell of this many degrees,
+    # searched from the cell's center and widened by half the cell's diagonal, i.e. ~0.8 km
+    # with 0.01, then measured from each user's own location. 0 disables the cache
+    GEO_SEARCH_CACHE_CELL_DEGREES: float = 0
+    GEO_SEARCH_CACHE_MAX_SIZE: int = 10_000
+    GEO_SEARCH_CACHE_TTL_SECONDS: int = 30
+    # Pings of the bulk location endpoint are coalesced in memory and flushed this often,
+    # or as soon as this many users are pending, with one upsert per batch
+    LOCATION_FLUSH_SECONDS: float = 1.0
+    LOCATION_FLUSH_BATCH_SIZE: int = 1_000
+    # positions are dropped after failing this many flushes, and pings of new users are
+    # rejected while this many users are pending
+    LOCATION_FLUSH_MAX_ATTEMPTS: int = 3
+    LOCATION_MAX_PENDING: int = 100_000
+    # pings moving a user less than this from their last known position aren't written
+    LOCATION_MIN_DISTANCE_METERS: float = 10
+    # last flushed positions kept per worker to compare pings with
+    LOCATION_LAST_KNOWN_MAX_SIZE: int = 100_000
+    LOCATION_LAST_KNOWN_TTL_SECONDS: float = 300
+    # Max amount of locations per bulk location request
+    LOCATION_BATCH_MAX_SIZE: int = 100
+    # Nearby users pushed to GET /users/feed/ subscribers as they move, at most this many
+    # subscribers per worker, more are rejected with 503
+    NEARBY_FEED_ENABLED: bool = True
+    NEARBY_FEED_MAX_SUBSCRIBERS: int = 1_000
+    # moves are only checked against the subscribers whose radius overlaps their cell
+    NEARBY_FEED_CELL_DEGREES: float = 0.5
+    # moves buffered per subscriber, subscribers falling further behind must resubscribe
+    NEARBY_FEED_QUEUE_SIZE: int = 256
+    NEARBY_FEED_HEARTBEAT_SECONDS: float = 15
+    # Users per cell of the density grid served by GET /users/density/, at one zoom level per
+    # cell size, coarsest first. Location writes keep the counts up to date
+    DENSITY_GRID_ENABLED: bool = True
+    DENSITY_GRID_CELL_DEGREES: List[float] = [1.0, 0.1, 0.01]
+    # boxes are counted at the finest level that returns at most this many cells
+    DENSITY_GRID_MAX_CELLS: int = 10_000
+    # the grid is compared to user_locations and repaired this often, 0 never checks. Changed
+    # levels are rebuilt by the next check
+    DENSITY_GRID_CHECK_SECONDS: float = 3600
+    # checks asked for through the internal API are refused for this long after the last one
+    DENSITY_GRID_MANUAL_CHECK_SECONDS: float = 300
+    # Paginated totals counted with the "cached" strategy
+    PAGINATION_COUNT_CACHE_MAX_SIZE: int = 1_000
+    PAGINATION_COUNT_CACHE_TTL_SECONDS: int = 30
     model_config = SettingsConfigDict(case_sensitive=True, env_file=".env")
 
 
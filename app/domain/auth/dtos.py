@@ -53,3 +53,7 @@ class UserWithProfileDto(BaseModel):
     is_active: bool
     profile: UserProfileDto | None
     model_config = ConfigDict(from_attributes=True)
+
+
+class UserClaimsDto(UserWithProfileDto):
+    version: int
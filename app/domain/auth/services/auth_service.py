@@ -5,21 +5,25 @@ from typing import Dict
 
 import jwt
 from fastapi import Depends, HTTPException, Request, status
-from passlib.hash import pbkdf2_sha256
 
 from app.config import settings
 from app.domain.auth.dtos import (
     LoginPayload,
     RegisterPayload,
     TokenDto,
+    UserClaimsDto,
     UserWithPasswordDto,
     UserWithProfileDto,
 )
 from app.events import ConfirmationEmailEvent
 from app.infrastructure.services.mediator import Mediator
+from app.infrastructure.services.outbox import outbox
+from app.infrastructure.services.password_hasher import password_hasher
 from app.infrastructure.services.session_service import SessionMaker
 
+from .token_cache import token_cache
 from .user_service import UserService
+from .user_versions import user_versions
 
 
 class TokenTypes(Enum):
@@ -80,8 +84,24 @@ class AuthService:
         return token
 
     async def get_user_from_token(self, token: str) -> UserWithProfileDto:
+        cached = token_cache.lookup(token)
+        if cached is not None:
+            self._session.bind_user(cached.user.id)
+            return cached.user
+
         decoded = self.decode_token(token, token_type=TokenTypes.ACCESS)
-        user = await self._user_service.get_user_with_id(decoded["id"])
+        self._session.bind_user(decoded["id"])
+        claims = decoded.get("user")
+        if settings.AUTH_CLAIMS_ONLY and claims and user_versions.trusts(decoded["iat"]):
+            # claims-only mode, the token carries the user, no need to query it
+            user_claims = UserClaimsDto.model_validate(claims)
+            if user_versions.is_stale(user_claims.id, user_claims.version):
+                # user changed after the token was issued, make the client refresh it
+                raise HTTPException(status.HTTP_401_UNAUTHORIZED, detail="Expired token")
+            user = UserWithProfileDto.model_validate(user_claims.model_dump())
+        else:
+            user = await self._user_service.get_user_with_id(decoded["id"])
+
         if not user.is_active:
             # TODO: Don't throw the HTTP exception from here,
             # throw something called "UserNotActiveException" or smt,
@@ -89,15 +109,30 @@ class AuthService:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED, detail="User has not confirmed email"
             )
+        token_cache.add(token, decoded, user)
         return user
 
-    def _create_token_payload(self, access_token=None, refresh_token=None, **payload) -> TokenDto:
+    def _create_token_payload(
+        self, access_token=None, refresh_token=None, access_claims=None, **payload
+    ) -> TokenDto:
         if access_token is None:
-            access_token = self._create_token(token_type=TokenTypes.ACCESS, **payload)
+            access_token = self._create_token(
+                token_type=TokenTypes.ACCESS, **payload, **(access_claims or {})
+            )
         if refresh_token is None:
             refresh_token = self._create_token(token_type=TokenTypes.REFRESH, **payload)
         return TokenDto(access_token=access_token, refresh_token=refresh_token)
 
+    async def _create_access_claims(self, user_id: int) -> dict:
+        """
+        Extra access token claims, in claims-only mode the token carries the whole user
+        """
+        if not settings.AUTH_CLAIMS_ONLY:
+            return {}
+
+        user = await self._user_service.get_user_claims(user_id)
+        return {"user": user.model_dump(mode="json")}
+
     async def login(self, login_data: LoginPayload) -> TokenDto:
         """
         Gets email and password, finds the matching user, and returns a JWT token
@@ -106,32 +141,37 @@ class AuthService:
             login_data.username
         )
 
-        if not pbkdf2_sha256.verify(login_data.password, user_dto.password):
+        if not await password_hasher.verify(login_data.password, user_dto.password):
             raise HTTPException(status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
 
         # TODO: decide what payload to pass into the JWT, maybe user roles? permissions? email? etc.
-        return self._create_token_payload(id=user_dto.id, email=user_dto.email)
-
-    async def register(self, register_dto: RegisterPayload) -> TokenDto:
-        is_user_exists = await self._user_service.is_user_exists(
-            register_dto.username, register_dto.email
+        return self._create_token_payload(
+            id=user_dto.id,
+            email=user_dto.email,
+            access_claims=await self._create_access_claims(user_dto.id),
         )
 
-        if is_user_exists:
-            raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Given email is already in use")
-
-        register_dto.password = pbkdf2_sha256.hash(register_dto.password)
+    async def register(self, register_dto: RegisterPayload) -> TokenDto:
+        # duplicate usernames and emails are rejected by create_user's insert
+        register_dto.password = await password_hasher.hash(register_dto.password)
 
         user = await self._user_service.create_user(register_dto)
-        await Mediator.send(
-            ConfirmationEmailEvent(
-                email=user.email,
-                username=user.username,
-                base_url=str(self._request.base_url),
+        # committed with the user, sent even if this worker dies right after
+        async with self._session as session:
+            await outbox.add(
+                session,
+                ConfirmationEmailEvent(
+                    email=user.email,
+                    username=user.username,
+                    base_url=str(self._request.base_url),
+                ),
             )
-        )
 
-        return self._create_token_payload(id=user.id, email=user.email)
+        return self._create_token_payload(
+            id=user.id,
+            email=user.email,
+            access_claims=await self._create_access_claims(user.id),
+        )
 
     async def confirm_email(self, confirm_token: str) -> bool:
         try:
@@ -156,7 +196,7 @@ class AuthService:
             # TODO raise custom error
             raise
 
-    def refresh_token(self, refresh_token: str) -> TokenDto:
+    async def refresh_token(self, refresh_token: str) -> TokenDto:
         """
         Creates a new access token from a refresh token
         """
@@ -164,5 +204,8 @@ class AuthService:
         # TODO: decide what payload to pass into the JWT, maybe user roles? permissions? email? etc.
         # create a new access token for the given refresh token, do not recreate the refresh token
         return self._create_token_payload(
-            id=payload["id"], email=payload["email"], refresh_token=refresh_token
+            id=payload["id"],
+            email=payload["email"],
+            refresh_token=refresh_token,
+            access_claims=await self._create_access_claims(payload["id"]),
         )
@@ -0,0 +1,57 @@
+import hashlib
+import time
+from collections import defaultdict
+from typing import Dict, NamedTuple, Set
+
+from app.config import settings
+from app.domain.auth.dtos import UserWithProfileDto
+from app.infrastructure.services.cache import LRUCache
+
+
+class TokenCacheEntry(NamedTuple):
+    claims: dict
+    user: UserWithProfileDto
+
+
+class TokenCache(LRUCache[bytes, TokenCacheEntry]):
+    """
+    Caches verified access tokens, so the same bearer token isn't
+    decoded and resolved to a user again on every request
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        super().__init__(max_size=max_size, ttl=ttl)
+        self._user_keys: Dict[int, Set[bytes]] = defaultdict(set)
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        # never keep the raw token around, only its digest
+        return hashlib.sha256(token.encode()).digest()
+
+    def lookup(self, token: str) -> TokenCacheEntry | None:
+        return self.get(self._key(token))
+
+    def add(self, token: str, claims: dict, user: UserWithProfileDto) -> None:
+        key = self._key(token)
+        # entry lives until the token expires or the cache ttl passes, whichever comes first
+        self.set(key, TokenCacheEntry(claims=claims, user=user), ttl=claims["exp"] - time.time())
+        if key in self._entries:
+            self._user_keys[user.id].add(key)
+
+    def evict_user(self, user_id: int) -> None:
+        for key in self._user_keys.pop(user_id, set()):
+            self.pop(key)
+
+    def _on_remove(self, key: bytes, value: TokenCacheEntry) -> None:
+        keys = self._user_keys.get(value.user.id)
+        if keys is None:
+            return
+
+        keys.discard(key)
+        if not keys:
+            del self._user_keys[value.user.id]
+
+
+token_cache = TokenCache(
+    max_size=settings.TOKEN_CACHE_MAX_SIZE, ttl=settings.TOKEN_CACHE_TTL_SECONDS
+)
@@ -1,30 +1,48 @@
 from fastapi import Depends, HTTPException, status
-from sqlalchemy import or_, select, true, update
+from sqlalchemy import insert, literal, or_, select, true, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
 
 from app.domain.auth.dtos import (
     RegisterPayload,
+    UserClaimsDto,
     UserDto,
     UserWithPasswordDto,
     UserWithProfileDto,
 )
-from app.infrastructure.services.session_service import SessionMaker
+from app.infrastructure.services.replicas import read_only
+from app.infrastructure.services.session_service import SessionMaker, after_commit
 from app.repositories.users.models import User, UserProfile
 
+from .token_cache import token_cache
+from .user_versions import user_versions
+
 
 class UserService:
     def __init__(self, _session: SessionMaker = Depends(SessionMaker)) -> None:
         self._session = _session
 
-    async def get_user_with_id(self, user_id: int) -> UserWithProfileDto:
+    async def _get_user_with_profile(self, user_id: int) -> User:
         async with self._session as session:
             query = select(User).filter(User.id == user_id).options(joinedload(User.profile))
             result = await session.scalar(query)
             if not result:
                 raise HTTPException(status.HTTP_404_NOT_FOUND, detail="User not found.")
 
+        return result
+
+    @read_only
+    async def get_user_with_id(self, user_id: int) -> UserWithProfileDto:
+        result = await self._get_user_with_profile(user_id)
         return UserWithProfileDto.model_validate(result)
 
+    async def get_user_claims(self, user_id: int) -> UserClaimsDto:
+        # from the primary, a lagging replica would sign claims that are already out of date
+        result = await self._get_user_with_profile(user_id)
+        user_versions.observe(result.id, result.version)
+        return UserClaimsDto.model_validate(result)
+
+    @read_only
     async def get_user_with_username(self, username: str) -> UserWithPasswordDto:
         async with self._session as session:
             query = select(User).filter(User.username == username)
@@ -39,18 +57,21 @@ class UserService:
             query = (
                 update(User)
                 .filter(User.username == username)
-                .values({"is_active": is_active})
-                .returning(User.is_active)
+                .values({"is_active": is_active, "version": User.version + 1})
+                .returning(User.id, User.is_active, User.version)
             )
-            result = await session.scalar(query)
+            result = (await session.execute(query)).first()
             if not result:
                 raise HTTPException(
                     status.HTTP_404_NOT_FOUND,
                     detail="Couldn't activate user, user not found",
                 )
+            await user_versions.publish(session, result.id, result.version)
+            after_commit(session, lambda: token_cache.evict_user(result.id))
 
-        return result
+        return result.is_active
 
+    @read_only
     async def is_user_exists(self, username: str, email: str) -> bool:
         async with self._session as session:
             query = select(User).filter(
@@ -63,6 +84,7 @@ class UserService:
 
         return bool(result)
 
+    @read_only
     async def is_user_active(self, username: str, email: str) -> bool:
         async with self._session as session:
             query = select(User).filter(
@@ -77,10 +99,29 @@ class UserService:
         return bool(result)
 
     async def create_user(self, register_payload: RegisterPayload) -> UserDto:
+        """
+        Inserts the profile and the user in a single statement,
+        the unique constraints on username and email reject duplicates
+        """
+        # an empty profile, INSERT INTO user_profiles DEFAULT VALUES
+        profile = insert(UserProfile).values({}).returning(UserProfile.id).cte("profile")
+        payload = {**register_payload.model_dump(), "is_active": False}
+        query = (
+            insert(User)
+            .from_select(
+                [*payload, "profile_id"],
+                select(*(literal(value) for value in payload.values()), profile.c.id),
+                # column defaults aren't used by INSERT ... SELECT, version is a server default
+                include_defaults=False,
+            )
+            .returning(User.id, User.username, User.email, User.is_active)
+        )
         async with self._session as session:
-            user = User(**register_payload.model_dump())
-            user.profile = UserProfile()
-            session.add(user)
-            await session.commit()
+            try:
+                result = (await session.execute(query)).one()
+            except IntegrityError:
+                raise HTTPException(
+                    status.HTTP_400_BAD_REQUEST, detail="Given email is already in use"
+                )
 
-        return UserDto.model_validate(user)
+        return UserDto.model_validate(result)
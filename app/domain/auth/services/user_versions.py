@@ -0,0 +1,96 @@
+import logging
+import math
+import time
+from typing import Dict
+
+from sqlalchemy import Update, func, select, update
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession
+
+from app.config import settings
+from app.infrastructure.services.session_service import after_commit
+from app.repositories.users.models import User
+
+from .token_cache import token_cache
+
+logger = logging.getLogger(__name__)
+
+
+class UserVersions:
+    """
+    In-memory record of the latest user versions this process knows about,
+    used to reject claims-only access tokens that were issued before the user changed.
+
+    Bumps made by other workers arrive through postgres NOTIFY, claims of tokens issued
+    before this process started listening can't be checked and must not be trusted.
+    """
+
+    CHANNEL = "user_versions"
+
+    def __init__(self) -> None:
+        self._versions: Dict[int, int] = {}
+        self._connection: AsyncConnection | None = None
+        self.since = time.time()
+
+    def observe(self, user_id: int, version: int) -> None:
+        if version > self._versions.get(user_id, -1):
+            self._versions[user_id] = version
+
+    def trusts(self, issued_at: int) -> bool:
+        return issued_at >= self.since
+
+    def is_stale(self, user_id: int, version: int) -> bool:
+        return version < self._versions.get(user_id, version)
+
+    @staticmethod
+    def bump_query(user_id: int) -> Update:
+        """
+        Increments the user's version, returning it along with the user's profile id
+        a core statement so it can be a CTE of the statement that changes the user
+        """
+        users = User.__table__
+        return (
+            update(users)
+            .where(users.c.id == user_id)
+            .values(version=users.c.version + 1)
+            .returning(users.c.version, users.c.profile_id)
+        )
+
+    async def bump(self, session: AsyncSession, user_id: int) -> int:
+        version = await session.scalar(self.bump_query(user_id))
+        await self.publish(session, user_id, version)
+        return version
+
+    async def publish(self, session: AsyncSession, user_id: int, version: int) -> None:
+        """
+        Records the new version once the session commits,
+        other workers are notified by postgres on commit as well
+        """
+        if settings.AUTH_CLAIMS_ONLY:
+            await session.execute(select(func.pg_notify(self.CHANNEL, f"{user_id}:{version}")))
+        after_commit(session, lambda: self.observe(user_id, version))
+
+    async def listen(self, engine: AsyncEngine) -> None:
+        self._connection = await engine.connect()
+        raw_connection = await self._connection.get_raw_connection()
+        driver_connection = raw_connection.driver_connection
+        await driver_connection.add_listener(self.CHANNEL, self._on_notification)
+        driver_connection.add_termination_listener(self._on_termination)
+        self.since = time.time()
+
+    async def stop(self) -> None:
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    def _on_notification(self, connection, pid, channel, payload: str) -> None:
+        user_id, version = map(int, payload.split(":"))
+        self.observe(user_id, version)
+        token_cache.evict_user(user_id)
+
+    def _on_termination(self, connection) -> None:
+        # we can't see other workers' bumps anymore, stop trusting claims entirely
+        logger.error("Lost the %s listener connection, claims won't be trusted", self.CHANNEL)
+        self.since = math.inf
+
+
+user_versions = UserVersions()
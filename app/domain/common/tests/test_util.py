@@ -0,0 +1,160 @@
+import math
+import random
+
+import pytest
+
+from app.domain.common import util
+from app.domain.common.util import GeoLocationHelper, _cover_geohash
+
+
+def _destination(latitude: float, longitude: float, bearing: float, distance: float):
+    """The point distance kms away from the given one, in the bearing's direction"""
+    lat, lon, bearing = map(math.radians, (latitude, longitude, bearing))
+    angle = distance / GeoLocationHelper.EARTH_RADIUS
+    dest_lat = math.asin(
+        math.sin(lat) * math.cos(angle) + math.cos(lat) * math.sin(angle) * math.cos(bearing)
+    )
+    dest_lon = lon + math.atan2(
+        math.sin(bearing) * math.sin(angle) * math.cos(lat),
+        math.cos(angle) - math.sin(lat) * math.sin(dest_lat),
+    )
+    return math.degrees(dest_lat), (math.degrees(dest_lon) + 540) % 360 - 180
+
+
+def test_geohash():
+    assert GeoLocationHelper.geohash(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    assert GeoLocationHelper.geohash(-90, -180, 4) == "0000"
+    assert GeoLocationHelper.geohash(89.999999, 179.999999, 4) == "zzzz"
+
+
+def test_bounding_box_wraps_around_the_antimeridian():
+    lat_min, lat_max, lon_min, lon_max = GeoLocationHelper.calculate_bounding_box(0, 179.95, 20)
+    assert lon_min > lon_max
+    assert lon_min < 179.95 and lon_max > -180
+
+
+def test_bounding_box_at_the_poles():
+    for latitude in (89.95, -89.95):
+        lat_min, lat_max, lon_min, lon_max = GeoLocationHelper.calculate_bounding_box(
+            latitude, 10, 20
+        )
+        assert (lon_min, lon_max) == (-180, 180)
+        assert -90 <= lat_min < latitude < lat_max <= 90
+
+
+@pytest.mark.parametrize(
+    "latitude, longitude",
+    [
+        (50, 50),
+        (0, 179.95),  # antimeridian
+        (0, -179.99),
+        (89.95, 10),  # north pole
+        (-89.99, -120),  # south pole
+        (-89.95, 179.9),
+    ],
+)
+@pytest.mark.parametrize("distance", [1, 20, 100])
+def test_geohash_cover_contains_the_circle(latitude, longitude, distance):
+    cells = GeoLocationHelper.cover_geohash(latitude, longitude, distance, precision=8)
+    assert len(cells) <= 32
+    # cells don't overlap
+    assert not any(a != b and b.startswith(a) for a in cells for b in cells)
+
+    rng = random.Random(f"{latitude}{longitude}{distance}")
+    for _ in range(200):
+        point = _destination(
+            latitude, longitude, rng.uniform(0, 360), distance * math.sqrt(rng.random())
+        )
+        geohash = GeoLocationHelper.geohash(*point, precision=8)
+        assert any(geohash.startswith(cell) for cell in cells), point
+
+
+def test_geohash_cover_is_memoized():
+    _cover_geohash.cache_clear()
+    first = GeoLocationHelper.cover_geohash(50.001, 50.001, 10, precision=8)
+    # rounds to the same point
+    second = GeoLocationHelper.cover_geohash(50.002, 49.998, 10, precision=8)
+    assert first == second
+    assert _cover_geohash.cache_info().hits == 1
+
+
+def _random_points(count: int, seed: str):
+    rng = random.Random(seed)
+    # poles and the antimeridian as well
+    latitudes = [89.99, -89.99, 0, 0] + [rng.uniform(-90, 90) for _ in range(count)]
+    longitudes = [10, -10, 179.99, -179.99] + [rng.uniform(-180, 180) for _ in range(count)]
+    return latitudes, longitudes
+
+
+def test_haversine_distance():
+    # a degree of longitude along the equator
+    assert GeoLocationHelper.haversine_distance(0, 0, 0, 1) == pytest.approx(111.195, abs=1e-3)
+    assert GeoLocationHelper.haversine_distance(0, 179.5, 0, -179.5) == pytest.approx(
+        111.195, abs=1e-3
+    )
+    assert GeoLocationHelper.haversine_distance(90, 0, -90, 0) == pytest.approx(
+        math.pi * GeoLocationHelper.EARTH_RADIUS
+    )
+    for distance in (1, 20, 100):
+        point = _destination(40, 40, 75, distance)
+        assert GeoLocationHelper.haversine_distance(40, 40, *point) == pytest.approx(distance)
+
+
+def test_batch_functions_without_numpy_match_the_scalar_ones(monkeypatch):
+    monkeypatch.setattr(util, "np", None)
+    latitudes, longitudes = _random_points(200, "scalar")
+
+    boxes = GeoLocationHelper.calculate_bounding_boxes(latitudes, longitudes, 20)
+    assert boxes == [
+        GeoLocationHelper.calculate_bounding_box(latitude, longitude, 20)
+        for latitude, longitude in zip(latitudes, longitudes)
+    ]
+    distances = GeoLocationHelper.haversine_distances(10, 20, latitudes, longitudes)
+    assert distances == [
+        GeoLocationHelper.haversine_distance(10, 20, latitude, longitude)
+        for latitude, longitude in zip(latitudes, longitudes)
+    ]
+    matrix = GeoLocationHelper.haversine_distance_matrix(
+        latitudes[:5], longitudes[:5], latitudes, longitudes
+    )
+    assert matrix[3] == GeoLocationHelper.haversine_distances(
+        latitudes[3], longitudes[3], latitudes, longitudes
+    )
+    mask = GeoLocationHelper.within_distance(10, 20, latitudes, longitudes, 5000)
+    assert mask == [distance < 5000 for distance in distances]
+    # exactly at the distance is out, as in the searches
+    assert not GeoLocationHelper.within_distance(10, 20, latitudes, longitudes, distances[0])[0]
+
+
+def test_batch_functions_with_numpy_match_the_fallback(monkeypatch):
+    np = pytest.importorskip("numpy")
+    latitudes, longitudes = _random_points(200, "numpy")
+    array_latitudes = np.array(latitudes, dtype=np.float64)
+    array_longitudes = np.array(longitudes, dtype=np.float64)
+
+    boxes = GeoLocationHelper.calculate_bounding_boxes(array_latitudes, array_longitudes, 20)
+    distances = GeoLocationHelper.haversine_distances(10, 20, array_latitudes, array_longitudes)
+    matrix = GeoLocationHelper.haversine_distance_matrix(
+        array_latitudes[:5], array_longitudes[:5], array_latitudes, array_longitudes
+    )
+    mask = GeoLocationHelper.within_distance(10, 20, array_latitudes, array_longitudes, 5000)
+    assert not GeoLocationHelper.within_distance(
+        10, 20, array_latitudes, array_longitudes, distances[0]
+    )[0]
+    assert boxes.shape == (204, 4) and matrix.shape == (5, 204)
+
+    monkeypatch.setattr(util, "np", None)
+    np.testing.assert_allclose(
+        boxes, GeoLocationHelper.calculate_bounding_boxes(latitudes, longitudes, 20), atol=1e-9
+    )
+    np.testing.assert_allclose(
+        distances, GeoLocationHelper.haversine_distances(10, 20, latitudes, longitudes), atol=1e-9
+    )
+    np.testing.assert_allclose(
+        matrix,
+        GeoLocationHelper.haversine_distance_matrix(
+            latitudes[:5], longitudes[:5], latitudes, longitudes
+        ),
+        atol=1e-9,
+    )
+    assert mask.tolist() == GeoLocationHelper.within_distance(10, 20, latitudes, longitudes, 5000)
@@ -1,5 +1,172 @@
+import functools
 import math
-from typing import Tuple
+from typing import Any, List, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # the batch functions fall back to pure python
+    np = None  # type: ignore[assignment]
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+# coverings with more cells than this use shorter, coarser geohashes
+GEOHASH_MAX_CELLS = 32
+# cover_geohash rounds points to this many decimals (~1.1 km) so nearby points share coverings
+GEOHASH_COVER_ROUNDING = 2
+
+
+def _geohash_cell_size(precision: int) -> Tuple[float, float]:
+    # bits alternate between longitude and latitude, starting with longitude
+    bits = precision * 5
+    return 180 / 2 ** (bits // 2), 360 / 2 ** ((bits + 1) // 2)
+
+
+def _lower_bound_distance(
+    lat: float, lon: float, lat_min: float, lat_max: float, lon_min: float, lon_max: float
+) -> float:
+    """
+    A lower bound of the angular distance from (lat, lon) to any point of the cell, in radians
+    """
+    # nothing is closer than the nearest latitude of the cell
+    lat_gap = math.radians(max(lat_min - lat, lat - lat_max, 0))
+    delta_lon = min(
+        abs((lon - edge + 180) % 360 - 180) for edge in (lon_min, lon_max)
+    )  # degrees to the nearer meridian edge, across the antimeridian as well
+    if lon_min <= lon <= lon_max or delta_lon >= 90:
+        return lat_gap
+    # nor than the meridian of the nearer edge
+    cross_track = math.asin(abs(math.cos(math.radians(lat)) * math.sin(math.radians(delta_lon))))
+    return max(lat_gap, cross_track)
+
+
+@functools.lru_cache(maxsize=4096)
+def _cover_geohash(latitude: float, longitude: float, distance: float, precision: int):
+    lat_min, lat_max, lon_min, lon_max = GeoLocationHelper.calculate_bounding_box(
+        latitude, longitude, distance
+    )
+    # the box wraps around the antimeridian when lon_min > lon_max
+    lon_ranges = [(lon_min, lon_max)] if lon_min <= lon_max else [(lon_min, 180), (-180, lon_max)]
+    angular_distance = distance / GeoLocationHelper.EARTH_RADIUS
+
+    while True:
+        cell_height, cell_width = _geohash_cell_size(precision)
+        rows = range(
+            math.floor((lat_min + 90) / cell_height),
+            min(math.ceil((lat_max + 90) / cell_height), round(180 / cell_height)),
+        )
+        columns = [
+            column
+            for start, end in lon_ranges
+            for column in range(
+                math.floor((start + 180) / cell_width),
+                min(math.ceil((end + 180) / cell_width), round(360 / cell_width)),
+            )
+        ]
+        if len(rows) * len(columns) <= GEOHASH_MAX_CELLS or precision == 1:
+            break
+        precision -= 1
+
+    cells = set()
+    for row in rows:
+        cell_lat_min = row * cell_height - 90
+        for column in columns:
+            cell_lon_min = column * cell_width - 180
+            bound = _lower_bound_distance(
+                latitude,
+                longitude,
+                cell_lat_min,
+                cell_lat_min + cell_height,
+                cell_lon_min,
+                cell_lon_min + cell_width,
+            )
+            if bound <= angular_distance:
+                cells.add(
+                    GeoLocationHelper.geohash(
+                        cell_lat_min + cell_height / 2, cell_lon_min + cell_width / 2, precision
+                    )
+                )
+
+    # replace every complete set of 32 siblings by their parent
+    while True:
+        parents: dict = {}
+        for cell in cells:
+            parents.setdefault(cell[:-1], []).append(cell)
+        complete = [
+            parent for parent, children in parents.items() if parent and len(children) == 32
+        ]
+        if not complete:
+            break
+        for parent in complete:
+            cells.difference_update(parents[parent])
+            cells.add(parent)
+
+    return tuple(sorted(cells))
+
+
+def _as_float64(values: Any) -> Any:
+    # no copy when values already are a contiguous float64 array
+    return np.ascontiguousarray(values, dtype=np.float64)
+
+
+def _bounding_boxes_numpy(latitudes: Any, longitudes: Any, distance: float) -> Any:
+    lat = np.radians(_as_float64(latitudes))
+    lon = np.radians(_as_float64(longitudes))
+    r = distance / GeoLocationHelper.EARTH_RADIUS
+    lat_min, lat_max = lat - r, lat + r
+    inside = (lat_min > GeoLocationHelper.MIN_LAT) & (lat_max < GeoLocationHelper.MAX_LAT)
+
+    # boxes that hit a pole span every longitude, don't take the arcsin of their ratio at all
+    ratio = np.divide(math.sin(r), np.cos(lat), out=np.zeros_like(lat), where=inside)
+    delta_lon = np.arcsin(ratio, out=np.zeros_like(lat), where=inside)
+    lon_min = lon - delta_lon
+    lon_min += np.where(lon_min < GeoLocationHelper.MIN_LON, 2 * math.pi, 0)
+    lon_max = lon + delta_lon
+    lon_max -= np.where(lon_max > GeoLocationHelper.MAX_LON, 2 * math.pi, 0)
+
+    boxes = np.empty((lat.shape[0], 4), dtype=np.float64)
+    boxes[:, 0] = np.where(inside, lat_min, np.maximum(lat_min, GeoLocationHelper.MIN_LAT))
+    boxes[:, 1] = np.where(inside, lat_max, np.minimum(lat_max, GeoLocationHelper.MAX_LAT))
+    boxes[:, 2] = np.where(inside, lon_min, GeoLocationHelper.MIN_LON)
+    boxes[:, 3] = np.where(inside, lon_max, GeoLocationHelper.MAX_LON)
+    return np.degrees(boxes, out=boxes)
+
+
+def _bounding_boxes_python(
+    latitudes: Sequence[float], longitudes: Sequence[float], distance: float
+) -> List[Tuple[float, float, float, float]]:
+    return [
+        GeoLocationHelper.calculate_bounding_box(latitude, longitude, distance)
+        for latitude, longitude in zip(latitudes, longitudes)
+    ]
+
+
+def _haversine_numpy(latitude: Any, longitude: Any, latitudes: Any, longitudes: Any) -> Any:
+    # latitude and longitude are either scalars or (N, 1) columns, broadcast against M points
+    lat = np.radians(latitude)
+    lon = np.radians(longitude)
+    other_lat = np.radians(_as_float64(latitudes))
+    other_lon = np.radians(_as_float64(longitudes))
+    a = (
+        np.sin((other_lat - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(other_lat) * np.sin((other_lon - lon) / 2) ** 2
+    )
+    return 2 * GeoLocationHelper.EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _haversine_python(
+    latitude: float, longitude: float, latitudes: Sequence[float], longitudes: Sequence[float]
+) -> List[float]:
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+    cos_lat = math.cos(lat)
+    distances = []
+    for other_lat, other_lon in zip(latitudes, longitudes):
+        other_lat = math.radians(other_lat)
+        a = (
+            math.sin((other_lat - lat) / 2) ** 2
+            + cos_lat * math.cos(other_lat) * math.sin((math.radians(other_lon) - lon) / 2) ** 2
+        )
+        distances.append(2 * GeoLocationHelper.EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0))))
+    return distances
 
 
 class GeoLocationHelper:
@@ -11,7 +178,7 @@ class GeoLocationHelper:
 
     @staticmethod
     def calculate_bounding_box(
-        latitude: float, longitude: float, distance: int
+        latitude: float, longitude: float, distance: float
     ) -> Tuple[float, float, float, float]:
         """
         latitude : latitude in degrees
@@ -51,3 +218,173 @@ class GeoLocationHelper:
             math.degrees(lon_min),
             math.degrees(lon_max),
         )
+
+    @staticmethod
+    def to_unit_vector(latitude: float, longitude: float) -> Tuple[float, float, float]:
+        """
+        latitude : latitude in degrees
+        longitude : longitude in degrees
+        Returns:
+            Tuple(x, y, z) of the point on the unit sphere
+        """
+        lat = math.radians(latitude)
+        lon = math.radians(longitude)
+        return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+    @staticmethod
+    def min_dot_product(distance: float) -> float:
+        """
+        distance : max distance between points
+        Returns:
+            the dot product two unit vectors at most distance apart have at least
+        """
+        return math.cos(min(distance / GeoLocationHelper.EARTH_RADIUS, math.pi))
+
+    @staticmethod
+    def chord_length(distance: float) -> float:
+        """
+        distance : max distance between points
+        Returns:
+            the straight line distance between two unit vectors distance apart
+        """
+        return 2 * math.sin(min(distance / GeoLocationHelper.EARTH_RADIUS, math.pi) / 2)
+
+    @staticmethod
+    def geohash(latitude: float, longitude: float, precision: int) -> str:
+        """
+        latitude : latitude in degrees
+        longitude : longitude in degrees
+        precision : length of the geohash
+        Returns:
+            the geohash of the cell the point is in
+        """
+        lat_range = [-90.0, 90.0]
+        lon_range = [-180.0, 180.0]
+        chars: List[str] = []
+        bit = 0
+        char = 0
+        even = True  # longitude bits go first
+        while len(chars) < precision:
+            value, value_range = (longitude, lon_range) if even else (latitude, lat_range)
+            middle = (value_range[0] + value_range[1]) / 2
+            char <<= 1
+            if value >= middle:
+                char |= 1
+                value_range[0] = middle
+            else:
+                value_range[1] = middle
+            even = not even
+            bit += 1
+            if bit == 5:
+                chars.append(GEOHASH_ALPHABET[char])
+                bit = 0
+                char = 0
+        return "".join(chars)
+
+    @staticmethod
+    def cover_geohash(
+        latitude: float, longitude: float, distance: float, precision: int
+    ) -> List[str]:
+        """
+        latitude : latitude in degrees
+        longitude : longitude in degrees
+        distance : max distance between points
+        precision : length of the geohashes, at most
+        Returns:
+            geohashes, possibly shorter than precision, that together contain every point
+            within distance of the given point, without overlapping each other
+            note: coverings are memoized per rounded point and distance
+        """
+        step = 10**-GEOHASH_COVER_ROUNDING
+        # rounding moves the point by at most half a step in both directions, widen the circle
+        margin = math.radians(step) * GeoLocationHelper.EARTH_RADIUS
+        cells = _cover_geohash(
+            round(latitude, GEOHASH_COVER_ROUNDING),
+            round(longitude, GEOHASH_COVER_ROUNDING),
+            distance + margin,
+            precision,
+        )
+        return list(cells)
+
+    @staticmethod
+    def haversine_distance(
+        latitude: float, longitude: float, other_latitude: float, other_longitude: float
+    ) -> float:
+        """
+        latitude, longitude : the first point in degrees
+        other_latitude, other_longitude : the second point in degrees
+        Returns:
+            the great circle distance between the points
+        """
+        return _haversine_python(latitude, longitude, (other_latitude,), (other_longitude,))[0]
+
+    # Batch versions of the above, they run on numpy when it's installed and return arrays,
+    # otherwise they return lists with the same values, up to the last bits of rounding.
+    # Pass contiguous float64 arrays to skip converting, i.e. np.array(..., dtype=np.float64)
+
+    @staticmethod
+    def calculate_bounding_boxes(latitudes: Any, longitudes: Any, distance: float) -> Any:
+        """
+        latitudes : N latitudes in degrees
+        longitudes : N longitudes in degrees
+        distance : max distance between points
+        Returns:
+            (N, 4) array of calculate_bounding_box for every point
+        """
+        if np is None:
+            return _bounding_boxes_python(latitudes, longitudes, distance)
+        return _bounding_boxes_numpy(latitudes, longitudes, distance)
+
+    @staticmethod
+    def haversine_distances(
+        latitude: float, longitude: float, latitudes: Any, longitudes: Any
+    ) -> Any:
+        """
+        latitude, longitude : the point in degrees
+        latitudes, longitudes : M points in degrees
+        Returns:
+            (M,) array of distances from the point to every one of the M points
+        """
+        if np is None:
+            return _haversine_python(latitude, longitude, latitudes, longitudes)
+        return _haversine_numpy(latitude, longitude, latitudes, longitudes)
+
+    @staticmethod
+    def haversine_distance_matrix(
+        latitudes: Any, longitudes: Any, other_latitudes: Any, other_longitudes: Any
+    ) -> Any:
+        """
+        latitudes, longitudes : N points in degrees
+        other_latitudes, other_longitudes : M points in degrees
+        Returns:
+            (N, M) array, the distance between the i-th and the j-th point is at [i, j]
+        """
+        if np is None:
+            return [
+                _haversine_python(latitude, longitude, other_latitudes, other_longitudes)
+                for latitude, longitude in zip(latitudes, longitudes)
+            ]
+        return _haversine_numpy(
+            _as_float64(latitudes)[:, np.newaxis],
+            _as_float64(longitudes)[:, np.newaxis],
+            other_latitudes,
+            other_longitudes,
+        )
+
+    @staticmethod
+    def within_distance(
+        latitude: float, longitude: float, latitudes: Any, longitudes: Any, distance: float
+    ) -> Any:
+        """
+        latitude, longitude : the point in degrees
+        latitudes, longitudes : M points in degrees
+        distance : max distance between points, exclusive like the searches
+        Returns:
+            (M,) boolean mask of the points less than distance away from the point
+        """
+        distances = GeoLocationHelper.haversine_distances(
+            latitude, longitude, latitudes, longitudes
+        )
+        if np is None:
+            return [d < distance for d in distances]
+        return distances < distance
@@ -0,0 +1,395 @@
+import asyncio
+import contextlib
+import logging
+import math
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import (
+    Float,
+    Integer,
+    SmallInteger,
+    and_,
+    cast,
+    delete,
+    func,
+    literal,
+    or_,
+    select,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.domain.users.dtos import (
+    DensityCellDto,
+    DensityCheckDto,
+    DensityDto,
+    DensityGridStatsDto,
+)
+from app.domain.users.location_snapshot import GridCells
+from app.domain.users.nearby_feed import NearbyMove
+from app.repositories.users.models import LocationDensityCell, UserLocation
+
+logger = logging.getLogger(__name__)
+
+# held by the transaction checking the grid, one worker checks at a time
+CHECK_LOCK_KEY = 0x64656E73
+
+# postgres takes at most 32767 bind parameters per statement, a row binds 4
+MAX_DELTAS_PER_STATEMENT = 32767 // 4
+
+
+def cell_columns(cells: GridCells, latitude, longitude):
+    """
+    GridCells.row and GridCells.column of a location in SQL. The coordinates are turned into
+    doubles first, so postgres rounds exactly like python does at the cells' edges.
+    """
+    degrees = literal(cells.cell_degrees, Float)
+    row = func.least(func.floor((cast(latitude, Float) + 90.0) / degrees), cells.rows - 1)
+    column = func.floor((cast(longitude, Float) + 180.0) / degrees)
+    return cast(row, Integer), cast(column, Integer) % cells.columns
+
+
+def _apply_query():
+    densities = LocationDensityCell.__table__
+    query = insert(densities)
+    return query.on_conflict_do_update(
+        index_elements=[densities.c.zoom, densities.c.lat_index, densities.c.lon_index],
+        set_={"count": densities.c.count + query.excluded.count},
+    )
+
+
+_APPLY = _apply_query()
+
+
+class DensityGrid:
+    """
+    Users per cell at a few zoom levels, a level per entry of cell_degrees, coarsest first.
+
+    The counts are a summary table that location writes keep up to date in their own
+    transaction, a move takes one from the cell the user left and adds one to the cell they
+    entered, at every level they changed cells at. Boxes are read back in a single range
+    of the (zoom, lat_index, lon_index) primary key.
+
+    Moves of the same user committed concurrently can both count their previous location
+    as left, `check` compares the counts against user_locations and repairs the drift.
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        cell_degrees: List[float],
+        max_cells: int,
+        check_seconds: float,
+        manual_check_seconds: float,
+    ) -> None:
+        self.enabled = enabled
+        self.levels = [GridCells(degrees) for degrees in cell_degrees]
+        self.max_cells = max_cells
+        self.check_seconds = check_seconds
+        self.manual_check_seconds = manual_check_seconds
+        self._task: asyncio.Task | None = None
+        self._checking = False
+        self._check_started: float | None = None
+        self.applied = 0
+        self.checks = 0
+        self.last_check: List[DensityCheckDto] = []
+        self.last_check_seconds: float | None = None
+        self.last_checked_at: datetime | None = None
+
+    def deltas(self, moves: Iterable[NearbyMove]) -> Dict[Tuple[int, int, int], int]:
+        """
+        The change of every (zoom, row, column) count the moves make, in key order
+        """
+        deltas: Counter = Counter()
+        for move in moves:
+            for zoom, cells in enumerate(self.levels):
+                cell = cells.row(move.latitude), cells.column(move.longitude)
+                if move.previous is not None:
+                    previous_latitude, previous_longitude = move.previous
+                    previous = cells.row(previous_latitude), cells.column(previous_longitude)
+                    if previous == cell:
+                        continue
+                    deltas[(zoom, *previous)] -= 1
+                deltas[(zoom, *cell)] += 1
+        return {key: delta for key, delta in sorted(deltas.items()) if delta}
+
+    async def apply(self, session: AsyncSession, moves: Iterable[NearbyMove]) -> None:
+        """
+        Counts the moves in the session's transaction
+        """
+        if not self.enabled:
+            return
+        deltas = self.deltas(moves)
+        if not deltas:
+            return
+        # in key order, so concurrent writes lock the cells in the same order
+        rows = [
+            {"zoom": zoom, "lat_index": row, "lon_index": column, "count": delta}
+            for (zoom, row, column), delta in deltas.items()
+        ]
+        await session.execute(
+            _APPLY.execution_options(insertmanyvalues_page_size=MAX_DELTAS_PER_STATEMENT), rows
+        )
+        self.applied += len(rows)
+
+    def zoom_for(
+        self,
+        lat_min: float,
+        lat_max: float,
+        lon_min: float,
+        lon_max: float,
+        zoom: int | None = None,
+    ) -> int:
+        """
+        The requested zoom, or the finest one with at most max_cells cells in the box
+        """
+        if not self.enabled:
+            raise HTTPException(
+                status.HTTP_503_SERVICE_UNAVAILABLE, detail="The density grid is disabled"
+            )
+        if lat_min > lat_max:
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST, detail="min_latitude is greater than max_latitude"
+            )
+        if zoom is not None and zoom >= len(self.levels):
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST, detail=f"zoom must be less than {len(self.levels)}"
+            )
+
+        def cells_in_box(cells: GridCells) -> int:
+            ranges = cells.box_ranges(lat_min, lat_max, lon_min, lon_max)
+            return sum(last - first + 1 for first, last in ranges)
+
+        if zoom is None:
+            fitting = [
+                zoom
+                for zoom, cells in enumerate(self.levels)
+                if cells_in_box(cells) <= self.max_cells
+            ]
+            # the coarsest level is returned whatever the size of the box
+            return fitting[-1] if fitting else 0
+        if zoom > 0 and cells_in_box(self.levels[zoom]) > self.max_cells:
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST,
+                detail=f"The box has more than {self.max_cells} cells at this zoom",
+            )
+        return zoom
+
+    async def counts(
+        self,
+        session: AsyncSession,
+        lat_min: float,
+        lat_max: float,
+        lon_min: float,
+        lon_max: float,
+        zoom: int | None = None,
+    ) -> DensityDto:
+        """
+        The cells with users within the box, from its south west corner row by row
+        """
+        zoom = self.zoom_for(lat_min, lat_max, lon_min, lon_max, zoom)
+        cells = self.levels[zoom]
+        densities = LocationDensityCell.__table__
+        # a single range of the primary key, bounded by the rows and the columns. Boxes across
+        # the antimeridian take the columns at both ends of the rows, filtered from the rows read
+        columns = [
+            densities.c.lon_index.between(first, last)
+            for first, last in cells.column_ranges(lon_min, lon_max)
+        ]
+        query = (
+            select(densities.c.lat_index, densities.c.lon_index, densities.c.count)
+            .where(
+                densities.c.zoom == zoom,
+                densities.c.lat_index.between(cells.row(lat_min), cells.row(lat_max)),
+                or_(*columns),
+                densities.c.count > 0,
+            )
+            .order_by(densities.c.lat_index, densities.c.lon_index)
+        )
+        results = [
+            DensityCellDto(
+                latitude=round(row * cells.cell_degrees - 90, 9),
+                longitude=round(column * cells.cell_degrees - 180, 9),
+                count=count,
+            )
+            for row, column, count in await session.execute(query)
+        ]
+        return DensityDto(
+            zoom=zoom,
+            cell_degrees=cells.cell_degrees,
+            total=sum(cell.count for cell in results),
+            cells=results,
+        )
+
+    def check_query(self, zoom: int, repair: bool):
+        """
+        The mismatched cells of the zoom level and the sum of their differences, all in the
+        statement's snapshot. With repair, the differences are added to the stored counts,
+        which keeps the moves counted concurrently.
+        """
+        cells = self.levels[zoom]
+        densities = LocationDensityCell.__table__
+        # core columns, the ORM leaves out the CTE of the repair when it compiles the statement
+        locations = UserLocation.__table__
+        row, column = cell_columns(cells, locations.c.latitude, locations.c.longitude)
+        located = (
+            select(row.label("lat_index"), column.label("lon_index"))
+            .where(locations.c.latitude.is_not(None))
+            .subquery("located")
+        )
+        actual = (
+            select(located.c.lat_index, located.c.lon_index, func.count().label("count"))
+            .group_by(located.c.lat_index, located.c.lon_index)
+            .cte("actual")
+        )
+        stored = (
+            select(densities.c.lat_index, densities.c.lon_index, densities.c.count)
+            .where(densities.c.zoom == zoom)
+            .cte("stored")
+        )
+        actual_count = func.coalesce(actual.c.count, 0)
+        stored_count = func.coalesce(stored.c.count, 0)
+        same_cell = and_(
+            actual.c.lat_index == stored.c.lat_index, actual.c.lon_index == stored.c.lon_index
+        )
+        drift = (
+            select(
+                func.coalesce(actual.c.lat_index, stored.c.lat_index).label("lat_index"),
+                func.coalesce(actual.c.lon_index, stored.c.lon_index).label("lon_index"),
+                (actual_count - stored_count).label("delta"),
+            )
+            .select_from(actual.join(stored, same_cell, full=True))
+            .where(actual_count != stored_count)
+            .cte("drift")
+        )
+        query = select(
+            func.count(), func.coalesce(func.sum(func.abs(drift.c.delta)), 0)
+        ).select_from(drift)
+        if repair:
+            repaired = insert(densities).from_select(
+                ["zoom", "lat_index", "lon_index", "count"],
+                select(
+                    literal(zoom, SmallInteger), drift.c.lat_index, drift.c.lon_index, drift.c.delta
+                ),
+            )
+            repaired = repaired.on_conflict_do_update(
+                index_elements=[densities.c.zoom, densities.c.lat_index, densities.c.lon_index],
+                set_={"count": densities.c.count + repaired.excluded.count},
+            )
+            query = query.add_cte(repaired.cte("repaired"))
+        return query
+
+    async def check(self, session: AsyncSession, repair: bool = True) -> List[DensityCheckDto]:
+        """
+        Compares every level against user_locations, and repairs them. Returns nothing
+        if another worker is checking the grid already.
+        """
+        self._checking = True
+        try:
+            return await self._check(session, repair)
+        finally:
+            self._checking = False
+
+    async def check_on_demand(
+        self, session: AsyncSession, repair: bool = True
+    ) -> List[DensityCheckDto]:
+        """
+        A check asked for through the API. Refused while this worker is checking the grid,
+        or if it started checking it less than manual_check_seconds ago.
+        """
+        if self._check_started is not None:
+            wait = self.manual_check_seconds - (time.monotonic() - self._check_started)
+            if self._checking or wait > 0:
+                raise HTTPException(
+                    status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="The density grid was checked recently",
+                    headers={"Retry-After": str(max(math.ceil(wait), 1))},
+                )
+        return await self.check(session, repair)
+
+    async def _check(self, session: AsyncSession, repair: bool) -> List[DensityCheckDto]:
+        started = time.perf_counter()
+        self._check_started = time.monotonic()
+        locked = await session.scalar(select(func.pg_try_advisory_xact_lock(CHECK_LOCK_KEY)))
+        if not locked:
+            await session.rollback()
+            return []
+
+        results = []
+        for zoom in range(len(self.levels)):
+            mismatched, drift = (await session.execute(self.check_query(zoom, repair))).one()
+            results.append(
+                DensityCheckDto(
+                    zoom=zoom, mismatched_cells=mismatched, drift=drift, repaired=repair
+                )
+            )
+        if repair:
+            densities = LocationDensityCell.__table__
+            await session.execute(
+                delete(densities).where(
+                    or_(densities.c.count == 0, densities.c.zoom >= len(self.levels))
+                )
+            )
+            await session.commit()
+        else:
+            await session.rollback()
+
+        self.checks += 1
+        self.last_check = results
+        self.last_check_seconds = time.perf_counter() - started
+        self.last_checked_at = datetime.now(timezone.utc)
+        return results
+
+    async def _check_periodically(self, session_maker) -> None:
+        while True:
+            await asyncio.sleep(self.check_seconds)
+            try:
+                async with session_maker() as session:
+                    results = await self.check(session)
+            except Exception:
+                logger.exception("Couldn't check the density grid")
+                continue
+            for result in results:
+                if result.mismatched_cells:
+                    logger.warning(
+                        "Repaired %d density grid cells of zoom %d, off by %d users",
+                        result.mismatched_cells,
+                        result.zoom,
+                        result.drift,
+                    )
+
+    def start(self, session_maker) -> None:
+        if self.enabled and self.check_seconds > 0:
+            self._task = asyncio.create_task(self._check_periodically(session_maker))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def stats(self) -> DensityGridStatsDto:
+        return DensityGridStatsDto(
+            enabled=self.enabled,
+            cell_degrees=[cells.cell_degrees for cells in self.levels],
+            applied=self.applied,
+            checks=self.checks,
+            last_check=self.last_check,
+            last_check_seconds=self.last_check_seconds,
+            last_checked_at=self.last_checked_at,
+        )
+
+
+density_grid = DensityGrid(
+    enabled=settings.DENSITY_GRID_ENABLED,
+    cell_degrees=settings.DENSITY_GRID_CELL_DEGREES,
+    max_cells=settings.DENSITY_GRID_MAX_CELLS,
+    check_seconds=settings.DENSITY_GRID_CHECK_SECONDS,
+    manual_check_seconds=settings.DENSITY_GRID_MANUAL_CHECK_SECONDS,
+)
@@ -1,5 +1,6 @@
-from datetime import date
+from datetime import date, datetime
 from decimal import Decimal
+from typing import List
 
 from pydantic import BaseModel, ConfigDict, EmailStr, Field
 
@@ -14,6 +15,12 @@ class LocationDto(LocationBase):
     model_config = ConfigDict(from_attributes=True)
 
 
+class LocationBatchResultDto(BaseModel):
+    received: int
+    # positions that will be written with the next flush, the rest was dropped or superseded
+    queued: bool
+
+
 class UserProfileBase(BaseModel):
     first_name: str | None
     last_name: str | None
@@ -42,3 +49,80 @@ class UserWithDistanceDto(UserDto):
     profile: UserProfileDto | None = None
     distance: float
     model_config = ConfigDict(from_attributes=True)
+
+
+class SpatialIndexStatsDto(BaseModel):
+    warm: bool
+    # the locations are a snapshot mapped by every worker, instead of a copy per process
+    shared: bool
+    size: int
+    cells: int
+    memory_bytes: int
+    rebuild_seconds: float | None
+    built_at: datetime | None
+
+
+class LocationCoalescerStatsDto(BaseModel):
+    pending: int
+    received: int
+    # pings that moved their user less than the minimum distance
+    dropped: int
+    # pings that replaced a pending position of their user
+    coalesced: int
+    # positions that weren't written, i.e. of deleted users, failed too many flushes
+    # or found too many users pending
+    rejected: int
+    written: int
+    flushes: int
+    failed_flushes: int
+    last_flush_seconds: float | None
+    last_flushed_at: datetime | None
+
+
+class NearbyFeedStatsDto(BaseModel):
+    subscribers: int
+    max_subscribers: int
+    # cells with at least one subscriber
+    cells: int
+    # whether moves of other workers are received
+    listening: bool
+    published: int
+    delivered: int
+    rejected: int
+    # subscribers told to resync because they fell behind
+    overflowed: int
+
+
+class DensityCellDto(BaseModel):
+    # the south west corner of the cell
+    latitude: float
+    longitude: float
+    count: int
+
+
+class DensityDto(BaseModel):
+    zoom: int
+    cell_degrees: float
+    # users within the cells
+    total: int
+    cells: List[DensityCellDto]
+
+
+class DensityCheckDto(BaseModel):
+    zoom: int
+    # cells whose count differed from user_locations
+    mismatched_cells: int
+    # sum of the differences, in users
+    drift: int
+    repaired: bool
+
+
+class DensityGridStatsDto(BaseModel):
+    enabled: bool
+    cell_degrees: List[float]
+    # cell counts changed by location writes
+    applied: int
+    checks: int
+    last_check: List[DensityCheckDto]
+    last_check_seconds: float | None
+    last_checked_at: datetime | None
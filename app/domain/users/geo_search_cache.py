@@ -0,0 +1,114 @@
+import math
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Set, Tuple
+
+from app.config import settings
+from app.domain.common.util import GeoLocationHelper
+from app.domain.users.location_snapshot import GridCells
+from app.infrastructure.services.cache import LRUCache
+
+# kms, candidates whose radius a location misses by less than this are evicted as well
+DISTANCE_TOLERANCE = 1e-3
+
+
+class GeoSearchKey(NamedTuple):
+    cell: Tuple[int, int]
+    distance: int
+
+
+class GeoSearchCandidates(NamedTuple):
+    """
+    The users within distance of a cell's center, widened by the cell's reach so they
+    include the users within distance of any point of the cell
+    """
+
+    ids: List[int]
+    latitudes: List[float]
+    longitudes: List[float]
+
+
+class GeoSearchCache(LRUCache[GeoSearchKey, GeoSearchCandidates]):
+    """
+    Caches the candidates of nearby user searches per cell_degrees x cell_degrees cell,
+    every user whose location falls into the same cell filters the same candidates by their
+    distance to their own location.
+
+    Locations written by this process evict the candidates whose radius contains the old or
+    the new location, writes of other processes are only picked up once they expire.
+    """
+
+    def __init__(self, max_size: int, ttl: float, cell_degrees: float) -> None:
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.cell_degrees = cell_degrees
+        # keys by the 1 degree cell of their center, the ones near a location are found quickly
+        self._regions = GridCells(1.0)
+        self._region_keys: Dict[int, Set[GeoSearchKey]] = defaultdict(set)
+        self._max_distance = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.cell_degrees > 0 and self.max_size > 0
+
+    def cell_of(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees)
+
+    def center_of(self, cell: Tuple[int, int]) -> Tuple[float, float]:
+        row, column = cell
+        latitude = min((row + 0.5) * self.cell_degrees, 90)
+        longitude = (column + 0.5) * self.cell_degrees
+        return latitude, (longitude + 180) % 360 - 180
+
+    def reach(self, cell: Tuple[int, int]) -> float:
+        """
+        Distance from the cell's center to its farthest corner
+        """
+        row, column = cell
+        center = self.center_of(cell)
+        return max(
+            GeoLocationHelper.haversine_distance(*center, max(min(latitude, 90), -90), longitude)
+            for latitude in (row * self.cell_degrees, (row + 1) * self.cell_degrees)
+            for longitude in (column * self.cell_degrees, (column + 1) * self.cell_degrees)
+        )
+
+    def radius(self, key: GeoSearchKey) -> float:
+        """
+        Distance from the cell's center the candidates of the key are searched within
+        """
+        return key.distance + self.reach(key.cell)
+
+    def set(self, key: GeoSearchKey, value: GeoSearchCandidates, ttl: float | None = None) -> None:
+        super().set(key, value, ttl)
+        if key in self._entries:
+            self._region_keys[self._regions.cell(*self.center_of(key.cell))].add(key)
+            self._max_distance = max(self._max_distance, self.radius(key))
+
+    def evict_around(self, latitude: float, longitude: float) -> None:
+        """
+        Evicts the candidates a user at the location is, or would be, part of
+        """
+        for first, last in self._regions.ranges(
+            latitude, longitude, self._max_distance + DISTANCE_TOLERANCE
+        ):
+            for region in range(first, last + 1):
+                for key in list(self._region_keys.get(region, ())):
+                    center = self.center_of(key.cell)
+                    distance = GeoLocationHelper.haversine_distance(*center, latitude, longitude)
+                    if distance < self.radius(key) + DISTANCE_TOLERANCE:
+                        self.pop(key)
+
+    def _on_remove(self, key: GeoSearchKey, value: GeoSearchCandidates) -> None:
+        region = self._regions.cell(*self.center_of(key.cell))
+        keys = self._region_keys.get(region)
+        if keys is None:
+            return
+
+        keys.discard(key)
+        if not keys:
+            del self._region_keys[region]
+
+
+geo_search_cache = GeoSearchCache(
+    max_size=settings.GEO_SEARCH_CACHE_MAX_SIZE,
+    ttl=settings.GEO_SEARCH_CACHE_TTL_SECONDS,
+    cell_degrees=settings.GEO_SEARCH_CACHE_CELL_DEGREES,
+)
@@ -0,0 +1,318 @@
+import asyncio
+import contextlib
+import logging
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Dict, List, Tuple
+
+from sqlalchemy import literal_column, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.domain.auth.services.token_cache import token_cache
+from app.domain.common.util import GeoLocationHelper
+from app.domain.users.density_grid import density_grid
+from app.domain.users.dtos import LocationCoalescerStatsDto
+from app.domain.users.geo_search_cache import geo_search_cache
+from app.domain.users.nearby_feed import NearbyMove, nearby_feed
+from app.domain.users.spatial_index import spatial_index
+from app.infrastructure.services.cache import LRUCache
+from app.infrastructure.services.session_service import after_commit
+from app.repositories.users.models import UserLocation
+
+logger = logging.getLogger(__name__)
+
+# postgres takes at most 32767 bind parameters per statement, a row binds 7
+MAX_BATCH_SIZE = 32767 // 7
+
+
+def _upsert_query():
+    # a core insert, the ORM can't return the subqueries
+    locations = UserLocation.__table__
+    query = insert(locations)
+    query = query.on_conflict_do_update(
+        index_elements=[locations.c.user_id],
+        set_={
+            "latitude": query.excluded.latitude,
+            "longitude": query.excluded.longitude,
+            "x": query.excluded.x,
+            "y": query.excluded.y,
+            "z": query.excluded.z,
+            "geohash": query.excluded.geohash,
+        },
+    )
+    # subqueries of RETURNING see the table as it was before the statement. SQLAlchemy
+    # doesn't correlate them to the inserted table, the row's user_id is spelled out instead
+    previous = locations.alias("previous")
+    inserted_user_id = literal_column(f"{locations.name}.{locations.c.user_id.name}")
+    previous = select(previous).where(previous.c.user_id == inserted_user_id)
+    return query.returning(
+        locations.c.user_id,
+        previous.with_only_columns(previous.selected_columns.latitude).scalar_subquery(),
+        previous.with_only_columns(previous.selected_columns.longitude).scalar_subquery(),
+    )
+
+
+_UPSERT = _upsert_query()
+
+
+class LocationCoalescer:
+    """
+        Buffers location pings in memory and writes them in batches, instead of a transaction
+        per ping. Only the latest position of a user is kept until the next flush, and pings
+        moving a user less than `min_distance` meters from their last known position are dropped.
+    The last positions it flushed are kept for up to `last_known_size` users and
+    `last_known_ttl` seconds, since other workers may have moved them since.
+
+        `start` flushes every `flush_seconds`, or as soon as `batch_size` users are pending,
+        each batch is a single multi-row upsert. Pings aren't visible to searches until they
+        are flushed, and the ones pending when the process dies are lost.
+
+        Positions that can't be written, i.e. of deleted users, are dropped, the rest of their
+        batch is written without them. Positions of failed flushes are retried with the next
+        ones, up to `max_attempts` flushes, and pings of new users are rejected while
+        `max_pending` users are pending.
+    """
+
+    def __init__(
+        self,
+        flush_seconds: float,
+        batch_size: int,
+        min_distance: float,
+        max_attempts: int = 3,
+        max_pending: int = 100_000,
+        last_known_size: int = 100_000,
+        last_known_ttl: float = 300,
+    ) -> None:
+        self.flush_seconds = flush_seconds
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.min_distance = min_distance
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self._pending: Dict[int, Tuple[Decimal, Decimal]] = {}
+        # failed flushes of the pending positions
+        self._attempts: Dict[int, int] = {}
+        self._flushed: LRUCache[int, Tuple[float, float]] = LRUCache(
+            last_known_size, last_known_ttl
+        )
+        self._flush_lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.received = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.written = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_seconds: float | None = None
+        self.last_flushed_at: datetime | None = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def _last_known(self, user_id: int) -> Tuple[float, float] | None:
+        pending = self._pending.get(user_id)
+        if pending is not None:
+            return float(pending[0]), float(pending[1])
+        flushed = self._flushed.get(user_id)
+        if flushed is not None:
+            return flushed
+        # written by other workers, as long as the spatial index is warm
+        return spatial_index.location_of(user_id)
+
+    def submit(self, user_id: int, latitude: Decimal, longitude: Decimal) -> bool:
+        """
+        Queues the user's position for the next flush, returns False if it's dropped
+        """
+        self.received += 1
+        last_known = self._last_known(user_id)
+        if last_known is not None and self.min_distance > 0:
+            # kms
+            moved = GeoLocationHelper.haversine_distance(
+                *last_known, float(latitude), float(longitude)
+            )
+            if moved * 1000 < self.min_distance:
+                self.dropped += 1
+                return False
+
+        if user_id in self._pending:
+            self.coalesced += 1
+        elif len(self._pending) >= self.max_pending:
+            self.rejected += 1
+            return False
+        self._pending[user_id] = (latitude, longitude)
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+        return True
+
+    def _take(self) -> Dict[int, Tuple[Decimal, Decimal]]:
+        pending, self._pending = self._pending, {}
+        self._full.clear()
+        return pending
+
+    def _requeue(self, positions: Dict[int, Tuple[Decimal, Decimal]]) -> None:
+        for user_id, position in positions.items():
+            if user_id in self._pending:
+                # pings received during the flush are newer
+                continue
+            attempts = self._attempts.pop(user_id, 0) + 1
+            if attempts >= self.max_attempts or len(self._pending) >= self.max_pending:
+                self.rejected += 1
+                continue
+            self._attempts[user_id] = attempts
+            self._pending[user_id] = position
+
+    async def _write(self, session: AsyncSession, positions: List[Tuple[int, Decimal, Decimal]]):
+        rows = []
+        for user_id, latitude, longitude in positions:
+            x, y, z = GeoLocationHelper.to_unit_vector(float(latitude), float(longitude))
+            geohash = GeoLocationHelper.geohash(
+                float(latitude), float(longitude), settings.GEOHASH_PRECISION
+            )
+            rows.append(
+                {
+                    "user_id": user_id,
+                    "latitude": latitude,
+                    "longitude": longitude,
+                    "x": x,
+                    "y": y,
+                    "z": z,
+                    "geohash": geohash,
+                }
+            )
+        # executed with a list of rows, SQLAlchemy sends them as one multi-row INSERT
+        # per page of insertmanyvalues_page_size rows
+        query = _UPSERT.execution_options(insertmanyvalues_page_size=self.batch_size)
+        try:
+            return (await session.execute(query, rows)).all()
+        except IntegrityError:
+            # nothing else is written before the batch
+            await session.rollback()
+
+        # one by one to set aside the rows that can't be written
+        written = []
+        for row in rows:
+            try:
+                async with session.begin_nested():
+                    written.extend((await session.execute(_UPSERT, [row])).all())
+            except IntegrityError:
+                logger.warning(
+                    "Dropped the location of user %d, it can't be written", row["user_id"]
+                )
+                self.rejected += 1
+        return written
+
+    async def flush(self, session: AsyncSession) -> int:
+        """
+        Writes every pending position, in batches of batch_size users, and commits.
+        Returns the number of positions written.
+        """
+        async with self._flush_lock:
+            pending = self._take()
+            if not pending:
+                return 0
+
+            started = time.perf_counter()
+            # in user order, so concurrent flushes of several workers lock rows in the same order
+            positions = sorted((user_id, *position) for user_id, position in pending.items())
+            try:
+                written = await self._write(session, positions)
+
+                def on_commit() -> None:
+                    for user_id, previous_latitude, previous_longitude in written:
+                        latitude, longitude = map(float, pending[user_id])
+                        self._flushed.set(user_id, (latitude, longitude))
+                        spatial_index.set(user_id, latitude, longitude)
+                        geo_search_cache.evict_around(latitude, longitude)
+                        if previous_latitude is not None:
+                            geo_search_cache.evict_around(
+                                float(previous_latitude), float(previous_longitude)
+                            )
+                        token_cache.evict_user(user_id)
+
+                after_commit(session, on_commit)
+                moves = [
+                    NearbyMove(
+                        user_id=user_id,
+                        latitude=float(pending[user_id][0]),
+                        longitude=float(pending[user_id][1]),
+                        previous=None
+                        if previous_latitude is None
+                        else (float(previous_latitude), float(previous_longitude)),
+                    )
+                    for user_id, previous_latitude, previous_longitude in written
+                ]
+                # the cells of the whole batch in one statement
+                await density_grid.apply(session, moves)
+                await nearby_feed.publish(session, moves)
+                await session.commit()
+            except BaseException:
+                # cancelled flushes too, i.e. on shutdown
+                self._requeue(pending)
+                self.failed_flushes += 1
+                await session.rollback()
+                raise
+
+            for user_id in pending:
+                self._attempts.pop(user_id, None)
+            self.written += len(written)
+            self.flushes += 1
+            self.last_flush_seconds = time.perf_counter() - started
+            self.last_flushed_at = datetime.now(timezone.utc)
+            return len(written)
+
+    async def _flush_from(self, session_maker) -> None:
+        try:
+            async with session_maker() as session:
+                await self.flush(session)
+        except Exception:
+            # the positions are pending again, retried with the next flush
+            logger.exception("Couldn't flush %d user locations", len(self._pending))
+
+    async def _flush_periodically(self, session_maker) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            await self._flush_from(session_maker)
+
+    def start(self, session_maker) -> None:
+        self._task = asyncio.create_task(self._flush_periodically(session_maker))
+
+    async def stop(self, session_maker) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self._flush_from(session_maker)
+
+    def stats(self) -> LocationCoalescerStatsDto:
+        return LocationCoalescerStatsDto(
+            pending=len(self._pending),
+            received=self.received,
+            dropped=self.dropped,
+            coalesced=self.coalesced,
+            rejected=self.rejected,
+            written=self.written,
+            flushes=self.flushes,
+            failed_flushes=self.failed_flushes,
+            last_flush_seconds=self.last_flush_seconds,
+            last_flushed_at=self.last_flushed_at,
+        )
+
+
+location_coalescer = LocationCoalescer(
+    flush_seconds=settings.LOCATION_FLUSH_SECONDS,
+    batch_size=settings.LOCATION_FLUSH_BATCH_SIZE,
+    min_distance=settings.LOCATION_MIN_DISTANCE_METERS,
+    max_attempts=settings.LOCATION_FLUSH_MAX_ATTEMPTS,
+    max_pending=settings.LOCATION_MAX_PENDING,
+    last_known_size=settings.LOCATION_LAST_KNOWN_MAX_SIZE,
+    last_known_ttl=settings.LOCATION_LAST_KNOWN_TTL_SECONDS,
+)
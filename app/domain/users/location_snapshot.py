@@ -0,0 +1,501 @@
+import asyncio
+import bisect
+import contextlib
+import fcntl
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+from array import array
+from typing import Any, BinaryIO, Dict, List, Sequence, Tuple
+
+from sqlalchemy import Float, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.domain.common.util import GeoLocationHelper
+from app.repositories.users.models import UserLocation
+
+try:
+    import numpy as np
+except ImportError:  # read and built with struct instead
+    np = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"ULOCSNAP"
+VERSION = 1
+# magic, version, padding, cell_degrees, records, cells, started_at, built_at
+HEADER = struct.Struct("<8sIIdqqdd")
+HEADER_SIZE = 64
+# user_id, latitude, longitude, cell, sorted by cell and then user_id
+RECORD = struct.Struct("<qddq")
+# user_id, position of its record, sorted by user_id
+ID_ENTRY = struct.Struct("<qq")
+# user_id, latitude, longitude, written at
+DELTA = struct.Struct("<qddd")
+# delta records replayed per catch up at most, the rest by the next ones
+MAX_CATCH_UP_RECORDS = 32_768
+
+if np is not None:
+    RECORD_DTYPE = np.dtype(
+        [("user_id", "<i8"), ("latitude", "<f8"), ("longitude", "<f8"), ("cell", "<i8")]
+    )
+    ID_ENTRY_DTYPE = np.dtype([("user_id", "<i8"), ("record", "<i8")])
+
+
+class GridCells:
+    """
+    Numbers cell_degrees x cell_degrees cells of latitude and longitude row by row,
+    so the cells of a row's longitude range have consecutive numbers
+    """
+
+    def __init__(self, cell_degrees: float) -> None:
+        self.cell_degrees = cell_degrees
+        self.rows = math.ceil(180 / cell_degrees)
+        self.columns = math.ceil(360 / cell_degrees)
+
+    def row(self, latitude: float) -> int:
+        return min(math.floor((latitude + 90) / self.cell_degrees), self.rows - 1)
+
+    def column(self, longitude: float) -> int:
+        return math.floor((longitude + 180) / self.cell_degrees) % self.columns
+
+    def cell(self, latitude: float, longitude: float) -> int:
+        return self.row(latitude) * self.columns + self.column(longitude)
+
+    def cells(self, latitudes, longitudes):
+        """
+        cell of every point, as an array when numpy is installed
+        """
+        if np is None:
+            return [self.cell(lat, lon) for lat, lon in zip(latitudes, longitudes)]
+        rows = np.minimum(np.floor((latitudes + 90) / self.cell_degrees), self.rows - 1)
+        columns = np.floor((longitudes + 180) / self.cell_degrees) % self.columns
+        return rows.astype(np.int64) * self.columns + columns.astype(np.int64)
+
+    def ranges(self, latitude: float, longitude: float, distance: float) -> List[Tuple[int, int]]:
+        """
+        Inclusive ranges of the cells that intersect the bounding box of the radius
+        """
+        return self.box_ranges(
+            *GeoLocationHelper.calculate_bounding_box(latitude, longitude, distance)
+        )
+
+    def box_ranges(
+        self, lat_min: float, lat_max: float, lon_min: float, lon_max: float
+    ) -> List[Tuple[int, int]]:
+        """
+        Inclusive ranges of the cells that intersect the box, row by row,
+        a lon_min greater than lon_max wraps around the antimeridian
+        """
+        columns = self.column_ranges(lon_min, lon_max)
+        return [
+            (row * self.columns + start, row * self.columns + end)
+            for row in range(self.row(lat_min), self.row(lat_max) + 1)
+            for start, end in columns
+        ]
+
+    def column_ranges(self, lon_min: float, lon_max: float) -> List[Tuple[int, int]]:
+        """
+        Inclusive ranges of the columns between the longitudes
+        """
+        first, last = self.column(lon_min), self.column(lon_max)
+        if lon_max - lon_min >= 360 - self.cell_degrees:
+            return [(0, self.columns - 1)]
+        elif lon_min <= lon_max:
+            return [(first, last)]
+        elif first <= last:
+            # wraps around the antimeridian and overlaps itself within a cell
+            return [(0, self.columns - 1)]
+        # wraps around the antimeridian
+        return [(first, self.columns - 1), (0, last)]
+
+
+def write_location_snapshot(
+    path: str,
+    user_ids: Sequence[int],
+    latitudes: Sequence[float],
+    longitudes: Sequence[float],
+    cell_degrees: float,
+    started_at: float,
+) -> int:
+    """
+    Writes the locations as a snapshot next to path and swaps it in atomically,
+    processes that mapped the previous one keep reading it until they reopen.
+    Returns the number of records.
+    """
+    grid = GridCells(cell_degrees)
+    if np is not None:
+        records = np.empty(len(user_ids), dtype=RECORD_DTYPE)
+        records["user_id"] = user_ids
+        records["latitude"] = latitudes
+        records["longitude"] = longitudes
+        records["cell"] = grid.cells(records["latitude"], records["longitude"])
+        records = records[np.lexsort((records["user_id"], records["cell"]))]
+        id_entries = np.empty(len(records), dtype=ID_ENTRY_DTYPE)
+        id_entries["user_id"] = records["user_id"]
+        id_entries["record"] = np.arange(len(records))
+        id_entries = id_entries[np.argsort(id_entries["user_id"], kind="stable")]
+        count = len(records)
+        cells = len(np.unique(records["cell"]))
+        body = [records.tobytes(), id_entries.tobytes()]
+    else:
+        record_rows = sorted(
+            (grid.cell(latitude, longitude), user_id, latitude, longitude)
+            for user_id, latitude, longitude in zip(user_ids, latitudes, longitudes)
+        )
+        count = len(record_rows)
+        cells = len({cell for cell, *_ in record_rows})
+        body = [
+            b"".join(
+                RECORD.pack(user_id, lat, lon, cell) for cell, user_id, lat, lon in record_rows
+            ),
+            b"".join(
+                ID_ENTRY.pack(user_id, position)
+                for user_id, position in sorted(
+                    (user_id, position) for position, (_, user_id, *_) in enumerate(record_rows)
+                )
+            ),
+        ]
+
+    header = HEADER.pack(MAGIC, VERSION, 0, cell_degrees, count, cells, started_at, time.time())
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(header.ljust(HEADER_SIZE, b"\0"))
+        for part in body:
+            file.write(part)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    return count
+
+
+class LocationSnapshot:
+    """
+    User locations shared by every worker of a host: a snapshot file mapped read-only,
+    plus a delta log of the locations written since the snapshot was taken.
+
+    The snapshot is a header, RECORDs sorted by cell so the cells under a radius are
+    a few range scans, and ID_ENTRYs sorted by user id to find a user's record.
+    Workers append the locations they write to the delta log and replay everyone's
+    appends before searching. Rebuilding swaps in a new snapshot, and drops the delta
+    records it already contains.
+
+    Neither appends nor replays wait for a lock: a record is a single write to the log
+    opened with O_APPEND, and replays read a bounded chunk of new records.
+    """
+
+    def __init__(self, path: str, cell_degrees: float) -> None:
+        self.path = path
+        self.delta_path = f"{path}.delta"
+        self._build_lock_path = f"{path}.build"
+        self._grid = GridCells(cell_degrees)
+        self._mmap: mmap.mmap | None = None
+        # numpy views of the records and id entries in the mapping
+        self._records: Any = None
+        self._id_entries: Any = None
+        self._inode: int | None = None
+        self.count = 0
+        self.cells = 0
+        self.started_at = 0.0
+        self.built_at = 0.0
+        self._delta_inode: int | None = None
+        self._delta_offset = 0
+        self._delta: BinaryIO | None = None
+        self._appender: BinaryIO | None = None
+        self._appender_inode: int | None = None
+        # latest location of the users in the delta log, they override their records
+        self._overlay: Dict[int, Tuple[float, float]] = {}
+
+    def __len__(self) -> int:
+        return self.count + sum(1 for user_id in self._overlay if self._find(user_id) is None)
+
+    def open(self) -> bool:
+        """
+        Maps the current snapshot, returns False if there's none yet
+        """
+        try:
+            with open(self.path, "rb") as file:
+                inode = os.fstat(file.fileno()).st_ino
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        magic, version, _, cell_degrees, count, cells, started_at, built_at = HEADER.unpack_from(
+            mapped
+        )
+        if magic != MAGIC or version != VERSION or cell_degrees != self._grid.cell_degrees:
+            logger.warning("Ignoring the incompatible location snapshot at %s", self.path)
+            mapped.close()
+            return False
+
+        self.close()
+        self._mmap, self._inode = mapped, inode
+        self.count, self.cells = count, cells
+        self.started_at, self.built_at = started_at, built_at
+        if np is not None:
+            self._records = np.frombuffer(mapped, RECORD_DTYPE, count, HEADER_SIZE)
+            self._id_entries = np.frombuffer(
+                mapped, ID_ENTRY_DTYPE, count, HEADER_SIZE + count * RECORD.size
+            )
+        self._delta_inode, self._delta_offset = None, 0
+        self._overlay = {}
+        self._catch_up()
+        return True
+
+    def close(self) -> None:
+        for file in (self._delta, self._appender):
+            if file is not None:
+                file.close()
+        self._delta = self._appender = None
+        self._delta_inode = self._appender_inode = None
+        if self._mmap is None:
+            return
+        self._records = self._id_entries = None
+        mapped, self._mmap = self._mmap, None
+        with contextlib.suppress(BufferError):
+            # views of a search still in flight keep it mapped until they're collected
+            mapped.close()
+
+    @property
+    def _mapped(self) -> mmap.mmap:
+        # records are only read while the snapshot is open
+        assert self._mmap is not None
+        return self._mmap
+
+    def age(self) -> float:
+        self._catch_up()
+        return time.time() - self.built_at
+
+    def nbytes(self) -> int:
+        return 0 if self._mmap is None else len(self._mmap)
+
+    def _catch_up(self) -> None:
+        """
+        Reopens the snapshot if it was swapped and replays new delta log records
+        """
+        with contextlib.suppress(FileNotFoundError):
+            if os.stat(self.path).st_ino != self._inode:
+                self.open()
+                return
+        try:
+            inode = os.stat(self.delta_path).st_ino
+            if inode != self._delta_inode:
+                # compacted by a rebuild
+                if self._delta is not None:
+                    self._delta.close()
+                self._delta = open(self.delta_path, "rb", buffering=0)
+                self._delta_inode = os.fstat(self._delta.fileno()).st_ino
+                self._delta_offset = 0
+                self._overlay = {}
+        except FileNotFoundError:
+            return
+
+        assert self._delta is not None
+        data = os.pread(self._delta.fileno(), MAX_CATCH_UP_RECORDS * DELTA.size, self._delta_offset)
+        # a record still being appended is read next time
+        data = data[: len(data) - len(data) % DELTA.size]
+        self._delta_offset += len(data)
+        for user_id, latitude, longitude, written_at in DELTA.iter_unpack(data):
+            if written_at >= self.started_at:
+                self._overlay[user_id] = (latitude, longitude)
+
+    def _append(self, record: bytes) -> int:
+        """
+        Appends the record to the log it has open, returns the inode of that log
+        """
+        if self._appender is None:
+            self._appender = open(self.delta_path, "ab", buffering=0)
+            self._appender_inode = os.fstat(self._appender.fileno()).st_ino
+        # a single write with O_APPEND, other workers' appends don't interleave with it
+        self._appender.write(record)
+        assert self._appender_inode is not None
+        return self._appender_inode
+
+    def set(self, user_id: int, latitude: float, longitude: float) -> None:
+        record = DELTA.pack(user_id, latitude, longitude, time.time())
+        inode = self._append(record)
+        with contextlib.suppress(FileNotFoundError):
+            if os.stat(self.delta_path).st_ino != inode:
+                # written to a log a compaction swapped out, it may have been read already
+                assert self._appender is not None
+                self._appender.close()
+                self._appender = None
+                self._append(record)
+        self._overlay[user_id] = (latitude, longitude)
+
+    def _find(self, user_id: int) -> int | None:
+        """
+        Position of the user's record
+        """
+        if np is not None:
+            position = int(np.searchsorted(self._id_entries["user_id"], user_id))
+            if position < self.count and self._id_entries[position]["user_id"] == user_id:
+                return int(self._id_entries[position]["record"])
+            return None
+
+        offset = HEADER_SIZE + self.count * RECORD.size
+        position = bisect.bisect_left(
+            range(self.count),
+            user_id,
+            key=lambda i: ID_ENTRY.unpack_from(self._mapped, offset + i * ID_ENTRY.size)[0],
+        )
+        if position < self.count:
+            entry_id, record = ID_ENTRY.unpack_from(self._mapped, offset + position * ID_ENTRY.size)
+            if entry_id == user_id:
+                return record
+        return None
+
+    def location_of(self, user_id: int) -> Tuple[float, float] | None:
+        self._catch_up()
+        if user_id in self._overlay:
+            return self._overlay[user_id]
+        position = self._find(user_id)
+        if position is None:
+            return None
+        _, latitude, longitude, _ = RECORD.unpack_from(
+            self._mapped, HEADER_SIZE + position * RECORD.size
+        )
+        return latitude, longitude
+
+    def _record_range(self, first_cell: int, last_cell: int) -> Tuple[int, int]:
+        if np is not None:
+            cells = self._records["cell"]
+            return (
+                int(np.searchsorted(cells, first_cell, "left")),
+                int(np.searchsorted(cells, last_cell, "right")),
+            )
+
+        def cell_at(i: int) -> int:
+            return RECORD.unpack_from(self._mapped, HEADER_SIZE + i * RECORD.size)[3]
+
+        return (
+            bisect.bisect_left(range(self.count), first_cell, key=cell_at),
+            bisect.bisect_right(range(self.count), last_cell, key=cell_at),
+        )
+
+    def search(
+        self, latitude: float, longitude: float, distance: float, exclude: int
+    ) -> Tuple[List[int], List[float]]:
+        self._catch_up()
+        cell_ranges = self._grid.ranges(latitude, longitude, distance)
+        ranges = [self._record_range(first, last) for first, last in cell_ranges]
+        overlay = [
+            (user_id, lat, lon)
+            for user_id, (lat, lon) in self._overlay.items()
+            if any(first <= self._grid.cell(lat, lon) <= last for first, last in cell_ranges)
+        ]
+        if np is None:
+            candidates = [
+                RECORD.unpack_from(self._mapped, HEADER_SIZE + i * RECORD.size)[:3]
+                for start, end in ranges
+                for i in range(start, end)
+            ]
+            candidates = [row for row in candidates if row[0] not in self._overlay] + overlay
+            distances = GeoLocationHelper.haversine_distances(
+                latitude,
+                longitude,
+                [lat for _, lat, _ in candidates],
+                [lon for _, _, lon in candidates],
+            )
+            matches = sorted(
+                (d, user_id)
+                for (user_id, _, _), d in zip(candidates, distances)
+                if d < distance and user_id != exclude
+            )
+            return [user_id for _, user_id in matches], [d for d, _ in matches]
+
+        # slices of the mapped records, only the candidates are copied
+        candidates = np.concatenate(
+            [self._records[start:end] for start, end in ranges] + [np.empty(0, RECORD_DTYPE)]
+        )
+        if self._overlay:
+            candidates = candidates[
+                ~np.isin(candidates["user_id"], np.fromiter(self._overlay, np.int64))
+            ]
+        overlay_ids, overlay_latitudes, overlay_longitudes = (
+            np.array(column, dtype=dtype)
+            for column, dtype in zip(
+                zip(*overlay) if overlay else ((), (), ()), ("<i8", "<f8", "<f8")
+            )
+        )
+        ids = np.concatenate([candidates["user_id"], overlay_ids])
+        distances = GeoLocationHelper.haversine_distances(
+            latitude,
+            longitude,
+            np.concatenate([candidates["latitude"], overlay_latitudes]),
+            np.concatenate([candidates["longitude"], overlay_longitudes]),
+        )
+        mask = (distances < distance) & (ids != exclude)
+        ids, distances = ids[mask], distances[mask]
+        order = np.lexsort((ids, distances))
+        return ids[order].tolist(), distances[order].tolist()
+
+    async def build(self, session: AsyncSession, requested_at: float) -> bool:
+        """
+        Builds a snapshot of user_locations and compacts the delta log, one worker at
+        a time. Returns False when another worker built one since requested_at instead.
+        """
+        build_lock = await asyncio.to_thread(open, self._build_lock_path, "a")
+        try:
+            await asyncio.to_thread(fcntl.flock, build_lock, fcntl.LOCK_EX)
+            if self.open() and self.built_at >= requested_at:
+                return False
+
+            # everything written from now on is either read below, or in the delta log
+            started_at = time.time()
+            query = select(
+                UserLocation.user_id,
+                UserLocation.latitude.cast(Float),
+                UserLocation.longitude.cast(Float),
+            ).execution_options(yield_per=10_000)
+            connection = await session.connection()
+            result = await connection.stream(query)
+            user_ids, latitudes, longitudes = array("q"), array("d"), array("d")
+            async for partition in result.partitions():
+                for user_id, latitude, longitude in partition:
+                    user_ids.append(user_id)
+                    latitudes.append(latitude)
+                    longitudes.append(longitude)
+            await asyncio.to_thread(
+                write_location_snapshot,
+                self.path,
+                user_ids,
+                latitudes,
+                longitudes,
+                self._grid.cell_degrees,
+                started_at,
+            )
+            await asyncio.to_thread(self._compact_delta, started_at)
+            self.open()
+            return True
+        finally:
+            build_lock.close()
+
+    def _compact_delta(self, started_at: float) -> None:
+        """
+        Swaps in a log of the records written since started_at, then moves over what
+        was appended to the previous one in the meantime. Later appends to the previous
+        log are appended again by their writers, once they see it swapped.
+        """
+        try:
+            previous = open(self.delta_path, "rb")
+        except FileNotFoundError:
+            return
+        with previous:
+            data = previous.read()
+            data = data[: len(data) - len(data) % DELTA.size]
+            kept = b"".join(
+                DELTA.pack(*record) for record in DELTA.iter_unpack(data) if record[3] >= started_at
+            )
+            temporary = f"{self.delta_path}.{os.getpid()}.tmp"
+            with open(temporary, "wb") as file:
+                file.write(kept)
+            os.replace(temporary, self.delta_path)
+            previous.seek(len(data))
+            appended = previous.read()
+        if appended:
+            with open(self.delta_path, "ab") as file:
+                file.write(appended)
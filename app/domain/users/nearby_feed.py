@@ -0,0 +1,343 @@
+import asyncio
+import itertools
+import json
+import logging
+from collections import defaultdict
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Set,
+    Tuple,
+)
+
+from fastapi import HTTPException, status
+from sqlalchemy import ARRAY, Text, cast, func, select
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession
+
+from app.config import settings
+from app.domain.common.util import GeoLocationHelper
+from app.domain.users.dtos import NearbyFeedStatsDto, UserWithDistanceDto
+from app.domain.users.location_snapshot import GridCells
+from app.infrastructure.dtos import PaginationDto
+from app.infrastructure.services.session_service import after_commit
+from app.infrastructure.services.sse import SSE_HEARTBEAT, format_sse
+
+logger = logging.getLogger(__name__)
+
+# moves per NOTIFY payload, postgres limits payloads to 8000 bytes
+MOVES_PER_NOTIFICATION = 100
+
+# closes a subscription, the client should subscribe again for a fresh snapshot
+RECENTER = "recenter"
+RESYNC = "resync"
+
+
+class NearbyMove(NamedTuple):
+    user_id: int
+    latitude: float
+    longitude: float
+    previous: Tuple[float, float] | None
+
+    def encode(self) -> str:
+        previous = "{}:{}".format(*self.previous) if self.previous is not None else ":"
+        return f"{self.user_id}:{self.latitude}:{self.longitude}:{previous}"
+
+    @classmethod
+    def decode(cls, value: str) -> "NearbyMove":
+        user_id, latitude, longitude, previous_latitude, previous_longitude = value.split(":")
+        previous = None
+        if previous_latitude:
+            previous = float(previous_latitude), float(previous_longitude)
+        return cls(int(user_id), float(latitude), float(longitude), previous)
+
+
+class NearbySubscription:
+    """
+    A user's view of the users within distance of them. Moves are queued as (user id,
+    distance) pairs and turned into events by the consumer, against the users it has sent.
+    """
+
+    def __init__(
+        self, user_id: int, latitude: float, longitude: float, distance: float, queue_size: int
+    ) -> None:
+        self.user_id = user_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.distance = distance
+        self.cells: List[int] = []
+        # the users the client knows of, with their last sent distances
+        self.members: Dict[int, float] = {}
+        self._queue: asyncio.Queue[Tuple[int, float] | str] = asyncio.Queue(queue_size)
+        self.closed = False
+
+    def distance_to(self, latitude: float, longitude: float) -> float:
+        return GeoLocationHelper.haversine_distance(
+            self.latitude, self.longitude, latitude, longitude
+        )
+
+    def offer(self, user_id: int, distance: float) -> bool:
+        try:
+            self._queue.put_nowait((user_id, distance))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def close(self, reason: str) -> None:
+        """
+        The consumer sends the reason after the queued moves and ends the stream,
+        the moves are dropped if there's no room left for it
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._queue.put_nowait(reason)
+        except asyncio.QueueFull:
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(reason)
+
+    async def get(self) -> Tuple[int, float] | str:
+        return await self._queue.get()
+
+    def event(self, user_id: int, distance: float) -> bytes | None:
+        if distance < self.distance:
+            kind = "move" if user_id in self.members else "enter"
+            self.members[user_id] = distance
+            return format_sse(kind, json.dumps({"id": user_id, "distance": distance}))
+        if self.members.pop(user_id, None) is not None:
+            return format_sse("leave", json.dumps({"id": user_id}))
+        return None
+
+
+class NearbyFeed:
+    """
+    Pushes the users entering, leaving or moving within the subscribers' radius.
+
+    Subscriptions are registered in every cell_degrees x cell_degrees cell their radius
+    overlaps, a move is only checked against the subscriptions of the cells of its new
+    and previous location. Moves are published by the transaction writing them, through
+    postgres NOTIFY to every worker once `listen` runs, otherwise to this process only.
+
+    At most `max_subscribers` subscribe to a worker, subscribers falling more than
+    `queue_size` moves behind are told to resync.
+    """
+
+    CHANNEL = "user_locations"
+
+    def __init__(
+        self,
+        enabled: bool,
+        max_subscribers: int,
+        cell_degrees: float,
+        queue_size: int,
+        heartbeat_seconds: float,
+    ) -> None:
+        self.enabled = enabled
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.heartbeat_seconds = heartbeat_seconds
+        self._cells = GridCells(cell_degrees)
+        self._cell_subscriptions: Dict[int, Set[NearbySubscription]] = defaultdict(set)
+        self._user_subscriptions: Dict[int, Set[NearbySubscription]] = defaultdict(set)
+        self._connection: AsyncConnection | None = None
+        self.subscribers = 0
+        self.published = 0
+        self.delivered = 0
+        self.rejected = 0
+        self.overflowed = 0
+
+    def admit(self) -> None:
+        """
+        Raises a 503 when there's no room left for another subscriber
+        """
+        if not self.enabled or self.subscribers >= self.max_subscribers:
+            self.rejected += 1
+            raise HTTPException(
+                status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many nearby feed subscribers"
+            )
+
+    def subscribe(
+        self, user_id: int, latitude: float, longitude: float, distance: float
+    ) -> NearbySubscription:
+        self.admit()
+        subscription = NearbySubscription(user_id, latitude, longitude, distance, self.queue_size)
+        for first, last in self._cells.ranges(latitude, longitude, distance):
+            subscription.cells.extend(range(first, last + 1))
+        for cell in subscription.cells:
+            self._cell_subscriptions[cell].add(subscription)
+        self._user_subscriptions[user_id].add(subscription)
+        self.subscribers += 1
+        return subscription
+
+    def unsubscribe(self, subscription: NearbySubscription) -> None:
+        subscriptions = self._user_subscriptions.get(subscription.user_id)
+        if subscriptions is None or subscription not in subscriptions:
+            return
+
+        subscription.closed = True
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._user_subscriptions[subscription.user_id]
+        for cell in subscription.cells:
+            subscriptions = self._cell_subscriptions[cell]
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._cell_subscriptions[cell]
+        self.subscribers -= 1
+
+    async def subscribe_stream(
+        self,
+        user_id: int,
+        latitude: float,
+        longitude: float,
+        distance: float,
+        read_snapshot: Callable[[], Awaitable[PaginationDto[UserWithDistanceDto]]],
+    ) -> AsyncIterator[bytes]:
+        """
+        Subscribes, reads the snapshot and streams the subscription, see `stream`.
+        The slot is only taken once the body is iterated, so a response that's never sent,
+        because the client left before it started, doesn't hold on to it.
+        """
+        try:
+            subscription = self.subscribe(user_id, latitude, longitude, distance)
+        except HTTPException:
+            # the last slots were taken since the request was admitted
+            yield format_sse(RESYNC, "{}")
+            return
+        try:
+            # subscribed before the snapshot is read, the moves in between aren't missed
+            snapshot = await read_snapshot()
+            async for chunk in self.stream(subscription, snapshot):
+                yield chunk
+        finally:
+            self.unsubscribe(subscription)
+
+    async def stream(
+        self, subscription: NearbySubscription, snapshot: PaginationDto[UserWithDistanceDto]
+    ) -> AsyncIterator[bytes]:
+        """
+        The subscription as server-sent events, the snapshot first and then the moves.
+        Ends with a recenter event once the subscriber moves, or resync if they fell behind.
+        """
+        try:
+            # moves queued since subscribing are applied on top of the snapshot
+            subscription.members = {user.id: user.distance for user in snapshot.results}
+            yield format_sse("snapshot", snapshot.model_dump_json())
+            while True:
+                try:
+                    item = await asyncio.wait_for(subscription.get(), self.heartbeat_seconds)
+                except asyncio.TimeoutError:
+                    yield SSE_HEARTBEAT
+                    continue
+                if isinstance(item, str):
+                    yield format_sse(item, "{}")
+                    return
+                event = subscription.event(*item)
+                if event is not None:
+                    self.delivered += 1
+                    yield event
+        finally:
+            self.unsubscribe(subscription)
+
+    def dispatch(self, move: NearbyMove) -> None:
+        self.published += 1
+        for subscription in self._user_subscriptions.get(move.user_id, ()):
+            subscription.close(RECENTER)
+
+        cells = {self._cells.cell(move.latitude, move.longitude)}
+        if move.previous is not None:
+            cells.add(self._cells.cell(*move.previous))
+        subscriptions: Set[NearbySubscription] = set()
+        for cell in cells:
+            subscriptions.update(self._cell_subscriptions.get(cell, ()))
+
+        for subscription in subscriptions:
+            if subscription.closed:
+                continue
+            distance = subscription.distance_to(move.latitude, move.longitude)
+            # a user moving out is only relevant if they were within the radius before
+            if distance >= subscription.distance and (
+                move.previous is None
+                or subscription.distance_to(*move.previous) >= subscription.distance
+            ):
+                continue
+            if not subscription.offer(move.user_id, distance):
+                self.overflowed += 1
+                subscription.close(RESYNC)
+
+    async def publish(self, session: AsyncSession, moves: List[NearbyMove]) -> None:
+        """
+        Dispatches the moves once the session commits
+        """
+        if not self.enabled or not moves:
+            return
+        if self._connection is None:
+            after_commit(session, lambda: self._dispatch_all(moves))
+            return
+
+        # this worker dispatches them from the notification as well
+        encoded = [move.encode() for move in moves]
+        payloads = [
+            ";".join(itertools.islice(encoded, start, start + MOVES_PER_NOTIFICATION))
+            for start in range(0, len(encoded), MOVES_PER_NOTIFICATION)
+        ]
+        notifications = func.unnest(cast(payloads, ARRAY(Text))).table_valued("payload")
+        payload = notifications.render_derived().c.payload
+        await session.execute(select(func.count(func.pg_notify(self.CHANNEL, payload))))
+
+    def _dispatch_all(self, moves: List[NearbyMove]) -> None:
+        for move in moves:
+            self.dispatch(move)
+
+    async def listen(self, engine: AsyncEngine) -> None:
+        self._connection = await engine.connect()
+        raw_connection = await self._connection.get_raw_connection()
+        driver_connection = raw_connection.driver_connection
+        await driver_connection.add_listener(self.CHANNEL, self._on_notification)
+        driver_connection.add_termination_listener(self._on_termination)
+
+    async def stop(self) -> None:
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+        self._close_all(RESYNC)
+
+    def _close_all(self, reason: str) -> None:
+        for subscriptions in self._user_subscriptions.values():
+            for subscription in subscriptions:
+                subscription.close(reason)
+
+    def _on_notification(self, connection, pid, channel, payload: str) -> None:
+        self._dispatch_all([NearbyMove.decode(move) for move in payload.split(";")])
+
+    def _on_termination(self, connection) -> None:
+        # other workers' moves are missed from now on, subscribers start over
+        logger.error("Lost the %s listener connection", self.CHANNEL)
+        self._connection = None
+        self._close_all(RESYNC)
+
+    def stats(self) -> NearbyFeedStatsDto:
+        return NearbyFeedStatsDto(
+            subscribers=self.subscribers,
+            max_subscribers=self.max_subscribers,
+            cells=len(self._cell_subscriptions),
+            listening=self._connection is not None,
+            published=self.published,
+            delivered=self.delivered,
+            rejected=self.rejected,
+            overflowed=self.overflowed,
+        )
+
+
+nearby_feed = NearbyFeed(
+    enabled=settings.NEARBY_FEED_ENABLED,
+    max_subscribers=settings.NEARBY_FEED_MAX_SUBSCRIBERS,
+    cell_degrees=settings.NEARBY_FEED_CELL_DEGREES,
+    queue_size=settings.NEARBY_FEED_QUEUE_SIZE,
+    heartbeat_seconds=settings.NEARBY_FEED_HEARTBEAT_SECONDS,
+)
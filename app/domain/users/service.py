@@ -1,80 +1,455 @@
+from typing import AsyncIterator, List, Tuple
+
 from fastapi import Depends, HTTPException
-from sqlalchemy import VARCHAR, and_, func, not_, select
-from sqlalchemy.orm import joinedload, with_expression
-from sqlalchemy.sql.expression import cast
+from sqlalchemy import (
+    JSON,
+    Boolean,
+    ColumnElement,
+    Float,
+    and_,
+    func,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload
 
+from app.config import settings
+from app.domain.auth.services.token_cache import token_cache
+from app.domain.auth.services.user_versions import user_versions
 from app.domain.common.util import GeoLocationHelper
+from app.domain.users.density_grid import density_grid
 from app.domain.users.dtos import (
+    DensityDto,
+    LocationBase,
+    LocationBatchResultDto,
     LocationDto,
     UserProfileBase,
     UserProfileDto,
     UserWithDistanceDto,
     UserWithProfileDto,
 )
-from app.infrastructure.dtos import PaginationDto
-from app.infrastructure.services.paginator import Paginator
-from app.infrastructure.services.session_service import SessionMaker
+from app.domain.users.geo_search_cache import (
+    GeoSearchCandidates,
+    GeoSearchKey,
+    geo_search_cache,
+)
+from app.domain.users.location_coalescer import location_coalescer
+from app.domain.users.nearby_feed import NearbyMove, nearby_feed
+from app.domain.users.spatial_index import spatial_index
+from app.infrastructure.dtos import CountStrategy, PaginationDto
+from app.infrastructure.services.ndjson import stream_ndjson
+from app.infrastructure.services.paginator import (
+    NUMBER,
+    Paginator,
+    decode_cursor,
+    encode_cursor,
+    list_adapter,
+)
+from app.infrastructure.services.replicas import read_only
+from app.infrastructure.services.session_service import SessionMaker, after_commit
 from app.repositories.users.models import User, UserLocation, UserProfile
 
 
+def _great_circle_search(lat, lon, distance: float) -> Tuple[ColumnElement, ColumnElement, list]:
+    """
+    Spherical law of cosines over the raw coordinates, can't use an index beyond
+    the bounding box ranges on latitude and longitude
+    """
+    lat_min, lat_max, lon_min, lon_max = GeoLocationHelper.calculate_bounding_box(
+        lat, lon, distance
+    )
+
+    distance_q = (
+        func.acos(
+            # rounding can push identical locations just past 1
+            func.least(
+                func.sin(func.radians(lat)) * func.sin(func.radians(UserLocation.latitude))
+                + func.cos(func.radians(lat))
+                * func.cos(func.radians(UserLocation.latitude))
+                * func.cos(func.radians(lon) - func.radians(UserLocation.longitude)),
+                1.0,
+            ),
+            type_=Float,
+        )
+        * GeoLocationHelper.EARTH_RADIUS
+    )
+    if lon_min <= lon_max:
+        lon_within = UserLocation.longitude.between(lon_min, lon_max)
+    else:
+        # the box wraps around the antimeridian
+        lon_within = or_(UserLocation.longitude >= lon_min, UserLocation.longitude <= lon_max)
+    within = [
+        UserLocation.latitude.between(lat_min, lat_max),
+        lon_within,
+        distance_q < distance,
+    ]
+    return distance_q, distance_q, within
+
+
+def _earth_search(lat, lon, distance: float) -> Tuple[ColumnElement, ColumnElement, list]:
+    """
+    earthdistance over the GiST indexed ll_to_earth point of the location,
+    earth_box narrows the candidates down through the index and `<->` orders by it
+    """
+    point = func.ll_to_earth(lat, lon)
+    location_point = func.ll_to_earth(UserLocation.latitude, UserLocation.longitude)
+    # earthdistance works in meters on a 6378168m earth, scale to our kms
+    to_km = GeoLocationHelper.EARTH_RADIUS / func.earth()
+    distance_q = func.earth_distance(point, location_point) * to_km
+    # straight line distance through the earth, grows with the great circle distance
+    order_q = location_point.op("<->", return_type=Float)(point)
+    within = [
+        func.earth_box(point, distance / to_km).op("@>", return_type=Boolean)(location_point),
+        distance_q < distance,
+    ]
+    return distance_q, order_q, within
+
+
+def _unit_vector_search(lat, lon, distance: float) -> Tuple[ColumnElement, ColumnElement, list]:
+    """
+    Dot product of the precomputed unit vectors, the radius is a single comparison
+    against cos(distance / R), and the cube around the point that contains the radius
+    bounds x, y and z for their indexes
+    """
+    x, y, z = GeoLocationHelper.to_unit_vector(float(lat), float(lon))
+    dot_q = UserLocation.x * x + UserLocation.y * y + UserLocation.z * z
+    distance_q = func.acos(func.least(dot_q, 1.0)) * GeoLocationHelper.EARTH_RADIUS
+    chord = GeoLocationHelper.chord_length(distance)
+    within = [
+        UserLocation.x.between(x - chord, x + chord),
+        UserLocation.y.between(y - chord, y + chord),
+        UserLocation.z.between(z - chord, z + chord),
+        dot_q >= GeoLocationHelper.min_dot_product(distance),
+    ]
+    # ascending with the distance, without evaluating acos for rows that aren't returned
+    return distance_q, -dot_q, within
+
+
+def _geohash_search(lat, lon, distance: float) -> Tuple[ColumnElement, ColumnElement, list]:
+    """
+    Prefix ranges of the geohash cells covering the radius, served by the geohash index
+    on any postgres, then the exact unit vector check on what's left
+    """
+    cells = GeoLocationHelper.cover_geohash(
+        float(lat), float(lon), distance, settings.GEOHASH_PRECISION
+    )
+    distance_q, order_q, within = _unit_vector_search(lat, lon, distance)
+    # with C collation, every geohash that starts with cell sorts in [cell, cell + "~")
+    cells_q = or_(
+        *(and_(UserLocation.geohash >= cell, UserLocation.geohash < f"{cell}~") for cell in cells)
+    )
+    return distance_q, order_q, [cells_q, within[-1]]
+
+
+def _users_with_profile_query():
+    """
+    Users as plain columns named after UserWithDistanceDto's fields, but the distance
+    """
+    # no ORM objects are built, the profile comes as a JSON object
+    profile = func.json_build_object(
+        "id",
+        UserProfile.id,
+        "first_name",
+        UserProfile.first_name,
+        "last_name",
+        UserProfile.last_name,
+        "birthday",
+        UserProfile.birthday,
+        type_=JSON,
+    ).label("profile")
+    return select(User.id, User.username, User.email, User.is_active, profile).join(
+        UserProfile, User.profile_id == UserProfile.id
+    )
+
+
+_searches = {
+    "great_circle": _great_circle_search,
+    "earthdistance": _earth_search,
+    "unit_vector": _unit_vector_search,
+    "geohash": _geohash_search,
+}
+
+
 class UserService:
     def __init__(self, _session: SessionMaker = Depends(SessionMaker)) -> None:
         self._session = _session
 
+    async def _get_location(self, session, user_id: int) -> UserLocation:
+        user_location = select(UserLocation).join(User).where(User.id == user_id)
+        user_location = await session.scalar(user_location)
+        if not user_location:
+            raise HTTPException(404, detail="User doesn't have a location")
+        return user_location
+
+    async def _get_coordinates(self, session, user_id: int) -> Tuple[float, float]:
+        if spatial_index.warm:
+            location = spatial_index.location_of(user_id)
+            # users this process hasn't seen a location of yet are looked up in postgres
+            if location is not None:
+                return location
+        user_location = await self._get_location(session, user_id)
+        return float(user_location.latitude), float(user_location.longitude)
+
+    def _nearby_users_query(self, lat, lon, distance: int, exclude: int | None):
+        """
+        Users other than exclude nearest to (lat, lon) first, as plain columns named after
+        UserWithDistanceDto's fields, along with the query's unique sort keys
+        and the conditions that limit it to the users within distance kms
+        """
+        search = _searches[settings.GEO_SEARCH_STRATEGY]
+        distance_q, order_q, within = search(lat, lon, distance)
+
+        query = (
+            _users_with_profile_query()
+            .add_columns(distance_q.label("distance"))
+            .join(UserLocation, isouter=False)
+            .order_by(order_q, User.id)
+        )
+        if exclude is not None:
+            query = query.where(UserLocation.user_id != exclude)
+        return query, (order_q, User.id), within
+
+    async def _users_within_distance_query(self, session, user_id: int, distance: int):
+        user_location = await self._get_location(session, user_id)
+        query, sort_keys, within = self._nearby_users_query(
+            user_location.latitude, user_location.longitude, distance, exclude=user_id
+        )
+        return query.where(*within), sort_keys
+
+    @read_only
     async def get_users_within_distance(
         self,
         user_id: int,
         page: int = 1,
         limit: int = 100,
         distance: int = 100,
+        cursor: str | None = None,
     ) -> PaginationDto[UserWithDistanceDto]:
+        """
+        Searches the spatial index when it's warm, postgres otherwise.
+        With the geo search cache enabled, the candidates around the center of the cell the
+        user is in are shared by every user in the cell, each of them is measured from the
+        user's own location.
+        """
+        page_size = min(settings.MAX_PAGE_SIZE, limit)
+        # maximum arg for page is 2**31 - 1 to avoid internal server error
+        page = min(Paginator.MAX_PAGE, page)
         async with self._session as session:
-            user_location = select(UserLocation).join(User).where(User.id == user_id)
-            user_location = await session.scalar(user_location)
-            if not user_location:
-                raise HTTPException(404, detail="User doesn't have a location")
+            location = await self._get_coordinates(session, user_id)
+        if not geo_search_cache.enabled:
+            return await self._search_users(location, user_id, page, page_size, distance, cursor)
 
-            lat = user_location.latitude
-            lon = user_location.longitude
+        key = GeoSearchKey(geo_search_cache.cell_of(*location), distance)
+        candidates = geo_search_cache.get(key)
+        if candidates is None:
+            candidates = await self._search_candidates(
+                geo_search_cache.center_of(key.cell), geo_search_cache.radius(key)
+            )
+            geo_search_cache.set(key, candidates)
 
-            lat_min, lat_max, lon_min, lon_max = GeoLocationHelper.calculate_bounding_box(
-                lat, lon, distance
+        distances = GeoLocationHelper.haversine_distances(
+            *location, candidates.latitudes, candidates.longitudes
+        )
+        matches = sorted(
+            (float(d), candidate_id)
+            for candidate_id, d in zip(candidates.ids, distances)
+            if d < distance and candidate_id != user_id
+        )
+        return await self._page_users(
+            [candidate_id for _, candidate_id in matches],
+            [d for d, _ in matches],
+            page,
+            page_size,
+            cursor,
+        )
+
+    async def _search_candidates(
+        self, location: Tuple[float, float], distance: float
+    ) -> GeoSearchCandidates:
+        """
+        Ids and coordinates of the users within distance of the location, unordered
+        """
+        if spatial_index.warm:
+            ids, _ = spatial_index.search(*location, distance, exclude=0)
+            located = [
+                (candidate_id, candidate_location)
+                for candidate_id in ids
+                if (candidate_location := spatial_index.location_of(candidate_id)) is not None
+            ]
+            return GeoSearchCandidates(
+                ids=[candidate_id for candidate_id, _ in located],
+                latitudes=[latitude for _, (latitude, _) in located],
+                longitudes=[longitude for _, (_, longitude) in located],
             )
 
-            distance_q = (
-                func.acos(
-                    func.sin(func.radians(lat)) * func.sin(func.radians(UserLocation.latitude))
-                    + func.cos(func.radians(lat))
-                    * func.cos(func.radians(UserLocation.latitude))
-                    * func.cos(func.radians(lon) - func.radians(UserLocation.longitude))
-                )
-                * 6371
-            ).label("distance")
-
-            query = (
-                select(User)
-                .join(UserLocation, isouter=False)
-                .where(
-                    not_(
-                        and_(
-                            cast(UserLocation.latitude, VARCHAR) == str(lat),
-                            cast(UserLocation.longitude, VARCHAR) == str(lon),
-                        )
-                    ),
-                    and_(
-                        UserLocation.latitude.between(lat_min, lat_max),
-                        UserLocation.longitude.between(lon_min, lon_max),
-                        distance_q < distance,
-                    ),
-                )
-                .order_by(distance_q)
-                .options(joinedload(User.profile), with_expression(User.distance, distance_q))
+        _, _, within = _searches[settings.GEO_SEARCH_STRATEGY](*location, distance)
+        query = select(UserLocation.user_id, UserLocation.latitude, UserLocation.longitude)
+        async with self._session as session:
+            rows = (await session.execute(query.where(*within))).all()
+        return GeoSearchCandidates(
+            ids=[row.user_id for row in rows],
+            latitudes=[float(row.latitude) for row in rows],
+            longitudes=[float(row.longitude) for row in rows],
+        )
+
+    async def _search_users(
+        self,
+        location: Tuple[float, float],
+        exclude: int | None,
+        page: int,
+        page_size: int,
+        distance: int,
+        cursor: str | None,
+    ) -> PaginationDto[UserWithDistanceDto]:
+        if spatial_index.warm:
+            return await self._search_users_in_index(
+                location, exclude, page, page_size, distance, cursor
             )
 
+        async with self._session as session:
+            query, sort_keys, within = self._nearby_users_query(*location, distance, exclude)
             return await Paginator.get_paginated_response(
-                session, query, limit=limit, page=page, serializer=UserWithDistanceDto
+                session,
+                query.where(*within),
+                limit=page_size,
+                page=page,
+                cursor=cursor,
+                sort_keys=sort_keys,
+                # the distance filter is only evaluated once, by the page query
+                count=CountStrategy.WINDOW,
+                serializer=UserWithDistanceDto,
+            )
+
+    async def _search_users_in_index(
+        self,
+        location: Tuple[float, float],
+        exclude: int | None,
+        page: int,
+        page_size: int,
+        distance: int,
+        cursor: str | None,
+    ) -> PaginationDto[UserWithDistanceDto]:
+        """
+        Searches the spatial index, see _page_users
+        """
+        # no user has the id 0
+        ids, distances = spatial_index.search(*location, distance, exclude=exclude or 0)
+        return await self._page_users(ids, distances, page, page_size, cursor)
+
+    async def _page_users(
+        self,
+        ids: List[int],
+        distances: List[float],
+        page: int,
+        page_size: int,
+        cursor: str | None,
+    ) -> PaginationDto[UserWithDistanceDto]:
+        """
+        A page of search results ordered by (distance, id), only the users on it are queried.
+        Its cursors are the (distance, id) of the last user of the page.
+        """
+        if cursor is not None:
+            start = spatial_index.seek(ids, distances, *decode_cursor(cursor, (NUMBER, (int,))))
+        else:
+            start = (page - 1) * page_size
+        end = start + page_size
+        has_more = len(ids) > end
+        return PaginationDto(
+            results=await self._load_users(ids[start:end], distances[start:end]),
+            total=len(ids),
+            total_strategy=CountStrategy.EXACT,
+            has_more=has_more,
+            page=None if cursor is not None else page,
+            size=page_size,
+            next_cursor=encode_cursor([distances[end - 1], ids[end - 1]]) if has_more else None,
+        )
+
+    async def _load_users(
+        self, ids: List[int], distances: List[float], exclude: int | None = None
+    ) -> List[UserWithDistanceDto]:
+        """
+        The users with the given ids in the same order, along with their distances
+        """
+        ids_to_load = [user_id for user_id in ids if user_id != exclude]
+        if not ids_to_load:
+            return []
+        async with self._session as session:
+            query = _users_with_profile_query().where(User.id.in_(ids_to_load))
+            users = {row.id: row._mapping for row in await session.execute(query)}
+        return list_adapter(UserWithDistanceDto).validate_python(
+            [
+                {**users[user_id], "distance": distance}
+                for user_id, distance in zip(ids, distances)
+                # deleted since they were found
+                if user_id in users
+            ]
+        )
+
+    @read_only
+    async def stream_users_within_distance(
+        self, user_id: int, distance: int = 100
+    ) -> AsyncIterator[bytes]:
+        """
+        Every user within distance as newline-delimited JSON, read on a server-side cursor.
+        The user's location is looked up before returning, so it's a 404 rather than a broken
+        stream if they have none.
+        """
+        async with self._session as session:
+            query, _ = await self._users_within_distance_query(session, user_id, distance)
+        return stream_ndjson(session, query, serializer=UserWithDistanceDto)
+
+    async def subscribe_users_within_distance(
+        self, user_id: int, distance: int = 100, limit: int = 100
+    ) -> AsyncIterator[bytes]:
+        """
+        The first page of users within distance, then the users entering, leaving or moving
+        within it as server-sent events, see NearbyFeed.stream
+        """
+        async with self._session as session:
+            location = await self._get_coordinates(session, user_id)
+        # a full feed is a 503 rather than a stream, the slot is taken once the body is sent
+        nearby_feed.admit()
+
+        async def read_snapshot() -> PaginationDto[UserWithDistanceDto]:
+            try:
+                return await self.get_users_within_distance(user_id, limit=limit, distance=distance)
+            finally:
+                # the feed runs for as long as the client listens, it mustn't hold a connection
+                await self._session.close()
+
+        return nearby_feed.subscribe_stream(user_id, *location, distance, read_snapshot)
+
+    @read_only
+    async def get_user_density(
+        self,
+        min_latitude: float,
+        max_latitude: float,
+        min_longitude: float,
+        max_longitude: float,
+        zoom: int | None = None,
+    ) -> DensityDto:
+        async with self._session as session:
+            return await density_grid.counts(
+                session, min_latitude, max_latitude, min_longitude, max_longitude, zoom
             )
 
+    @read_only
+    async def get_nearest_users(self, user_id: int, k: int = 10) -> List[UserWithDistanceDto]:
+        """
+        The k users nearest to the user, regardless of distance. With earthdistance,
+        the GiST index yields them in order, without sorting every other location.
+        """
+        async with self._session as session:
+            user_location = await self._get_location(session, user_id)
+            query, _, _ = self._nearby_users_query(
+                user_location.latitude, user_location.longitude, distance=0, exclude=user_id
+            )
+            rows = await session.execute(query.limit(k))
+        return list_adapter(UserWithDistanceDto).validate_python(rows.mappings().all())
+
+    @read_only
     async def get_user_with_id(self, user_id: int) -> UserWithProfileDto:
         async with self._session as session:
             query = select(User).filter(User.id == user_id).options(joinedload(User.profile))
@@ -87,29 +462,85 @@ class UserService:
     async def update_user_profile(
         self, user: UserWithProfileDto, new_profile: UserProfileBase
     ) -> UserProfileDto:
-        query = select(UserProfile).join(User).where(User.id == user.id)
+        bumped = user_versions.bump_query(user.id).cte("bumped")
+        # a core update, the ORM can't return columns of the CTE
+        profiles = UserProfile.__table__
+        query = (
+            update(profiles)
+            .where(profiles.c.id == bumped.c.profile_id)
+            .values(new_profile.model_dump())
+            .returning(*profiles.c, bumped.c.version)
+        )
         async with self._session as session:
-            profile = await session.scalar(query)
-            profile.first_name = new_profile.first_name
-            profile.last_name = new_profile.last_name
-            profile.birthday = new_profile.birthday
-            await session.commit()
+            profile = (await session.execute(query)).one()
+            await user_versions.publish(session, user.id, profile.version)
+            after_commit(session, lambda: token_cache.evict_user(user.id))
         return UserProfileDto.model_validate(profile)
 
     async def update_user_location(
         self, user: UserWithProfileDto, location: LocationDto
     ) -> LocationDto:
-        query = select(User).where(User.id == user.id).options(joinedload(User.location))
-        async with self._session as session:
-            user = await session.scalar(query)
-            if not user.location:
-                user.location = UserLocation(**location.model_dump(), user_id=user.id)
-            else:
-                user.location.longitude = location.longitude
-                user.location.latitude = location.latitude
-            await session.commit()
-        return LocationDto(
-            id=user.location.id,
-            latitude=user.location.latitude,
-            longitude=user.location.longitude,
+        x, y, z = GeoLocationHelper.to_unit_vector(
+            float(location.latitude), float(location.longitude)
         )
+        geohash = GeoLocationHelper.geohash(
+            float(location.latitude), float(location.longitude), settings.GEOHASH_PRECISION
+        )
+        # a core insert, the ORM can't return the subqueries
+        locations = UserLocation.__table__
+        query = insert(locations).values(
+            **location.model_dump(), x=x, y=y, z=z, geohash=geohash, user_id=user.id
+        )
+        query = query.on_conflict_do_update(
+            index_elements=[locations.c.user_id],
+            set_={
+                "latitude": query.excluded.latitude,
+                "longitude": query.excluded.longitude,
+                "x": query.excluded.x,
+                "y": query.excluded.y,
+                "z": query.excluded.z,
+                "geohash": query.excluded.geohash,
+            },
+        )
+        # subqueries of RETURNING see the table as it was before the statement
+        previous = select(locations).where(locations.c.user_id == user.id)
+        query = query.returning(
+            locations.c.id,
+            previous.with_only_columns(locations.c.latitude).scalar_subquery(),
+            previous.with_only_columns(locations.c.longitude).scalar_subquery(),
+        )
+        latitude, longitude = float(location.latitude), float(location.longitude)
+        async with self._session as session:
+            location_id, previous_latitude, previous_longitude = (
+                await session.execute(query)
+            ).one()
+
+            def on_commit() -> None:
+                spatial_index.set(user.id, latitude, longitude)
+                geo_search_cache.evict_around(latitude, longitude)
+                if previous_latitude is not None:
+                    geo_search_cache.evict_around(
+                        float(previous_latitude), float(previous_longitude)
+                    )
+                token_cache.evict_user(user.id)
+
+            after_commit(session, on_commit)
+            previous = None
+            if previous_latitude is not None:
+                previous = float(previous_latitude), float(previous_longitude)
+            moves = [NearbyMove(user.id, latitude, longitude, previous)]
+            await density_grid.apply(session, moves)
+            await nearby_feed.publish(session, moves)
+        return LocationDto(id=location_id, **location.model_dump())
+
+    def submit_user_locations(
+        self, user: UserWithProfileDto, locations: List[LocationBase]
+    ) -> LocationBatchResultDto:
+        """
+        Queues the user's latest position for the next flush of the location coalescer,
+        locations are in the order they were recorded
+        """
+        queued = False
+        for location in locations:
+            queued = location_coalescer.submit(user.id, location.latitude, location.longitude)
+        return LocationBatchResultDto(received=len(locations), queued=queued)
@@ -0,0 +1,275 @@
+import asyncio
+import bisect
+import logging
+import sys
+import time
+from array import array
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+from sqlalchemy import Float, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.domain.common.util import GeoLocationHelper
+from app.domain.users.dtos import SpatialIndexStatsDto
+from app.domain.users.location_snapshot import GridCells, LocationSnapshot
+from app.repositories.users.models import UserLocation
+
+try:
+    import numpy as np
+except ImportError:  # searched with the pure python fallback
+    np = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+
+class _Grid:
+    """
+    Locations bucketed into cell_degrees x cell_degrees cells of latitude and longitude.
+    Every location is a slot of three flat arrays, ids, latitudes and longitudes,
+    and cells only hold the slots that fall into them.
+    """
+
+    def __init__(self, cell_degrees: float) -> None:
+        self._cells = GridCells(cell_degrees)
+        self.ids = array("q")
+        self.latitudes = array("d")
+        self.longitudes = array("d")
+        self.slots: Dict[int, int] = {}
+        self.cells: Dict[int, array] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def location_of(self, user_id: int) -> Tuple[float, float] | None:
+        slot = self.slots.get(user_id)
+        if slot is None:
+            return None
+        return self.latitudes[slot], self.longitudes[slot]
+
+    def set(self, user_id: int, latitude: float, longitude: float) -> None:
+        cell = self._cells.cell(latitude, longitude)
+        slot = self.slots.get(user_id)
+        if slot is None:
+            slot = self.slots[user_id] = len(self.ids)
+            self.ids.append(user_id)
+            self.latitudes.append(latitude)
+            self.longitudes.append(longitude)
+        else:
+            previous = self._cells.cell(self.latitudes[slot], self.longitudes[slot])
+            self.latitudes[slot] = latitude
+            self.longitudes[slot] = longitude
+            if previous == cell:
+                return
+            self.cells[previous].remove(slot)
+            if not self.cells[previous]:
+                del self.cells[previous]
+        self.cells.setdefault(cell, array("q")).append(slot)
+
+    def _candidates(self, latitude: float, longitude: float, distance: float) -> array:
+        candidates = array("q")
+        for first, last in self._cells.ranges(latitude, longitude, distance):
+            for number in range(first, last + 1):
+                cell = self.cells.get(number)
+                if cell is not None:
+                    candidates.extend(cell)
+        return candidates
+
+    def search(
+        self, latitude: float, longitude: float, distance: float, exclude: int
+    ) -> Tuple[List[int], List[float]]:
+        candidates = self._candidates(latitude, longitude, distance)
+        if np is None:
+            distances = GeoLocationHelper.haversine_distances(
+                latitude,
+                longitude,
+                [self.latitudes[slot] for slot in candidates],
+                [self.longitudes[slot] for slot in candidates],
+            )
+            matches = sorted(
+                (d, self.ids[slot])
+                for slot, d in zip(candidates, distances)
+                if d < distance and self.ids[slot] != exclude
+            )
+            return [user_id for _, user_id in matches], [d for d, _ in matches]
+
+        # views of the arrays, nothing is copied until the candidates are gathered
+        slots = np.frombuffer(candidates, dtype=np.int64)
+        ids = np.frombuffer(self.ids, dtype=np.int64)[slots]
+        distances = GeoLocationHelper.haversine_distances(
+            latitude,
+            longitude,
+            np.frombuffer(self.latitudes, dtype=np.float64)[slots],
+            np.frombuffer(self.longitudes, dtype=np.float64)[slots],
+        )
+        mask = (distances < distance) & (ids != exclude)
+        ids, distances = ids[mask], distances[mask]
+        order = np.lexsort((ids, distances))
+        return ids[order].tolist(), distances[order].tolist()
+
+    def nbytes(self) -> int:
+        arrays: List[array] = [self.ids, self.latitudes, self.longitudes, *self.cells.values()]
+        return (
+            sum(values.itemsize * len(values) for values in arrays)
+            + sys.getsizeof(self.slots)
+            + sys.getsizeof(self.cells)
+        )
+
+
+class SpatialIndex:
+    """
+    Every user location kept in memory, searched instead of postgres for the users
+    within a distance once it's warm. It's loaded by `rebuild` and kept current by
+    `set` as this process writes locations, other processes' writes are picked up by
+    the periodic rebuilds of `start`.
+
+    With a snapshot_path, the locations aren't loaded into every process, the workers
+    of a host map the same LocationSnapshot and see each other's writes right away.
+    """
+
+    def __init__(
+        self, cell_degrees: float, refresh_seconds: float, snapshot_path: str | None = None
+    ) -> None:
+        self.cell_degrees = cell_degrees
+        self.refresh_seconds = refresh_seconds
+        self._grid = _Grid(cell_degrees)
+        self._snapshot = LocationSnapshot(snapshot_path, cell_degrees) if snapshot_path else None
+        self.warm = False
+        self.rebuild_seconds: float | None = None
+        self.built_at: datetime | None = None
+        # locations written while a rebuild reads the table, replayed on top of it
+        self._pending: Dict[int, Tuple[float, float]] | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def _locations(self) -> _Grid | LocationSnapshot:
+        return self._grid if self._snapshot is None else self._snapshot
+
+    def location_of(self, user_id: int) -> Tuple[float, float] | None:
+        return self._locations.location_of(user_id)
+
+    def set(self, user_id: int, latitude: float, longitude: float) -> None:
+        if self._snapshot is not None:
+            # even while cold, a snapshot another worker is building may have missed it
+            self._snapshot.set(user_id, latitude, longitude)
+            return
+        if self._pending is not None:
+            self._pending[user_id] = (latitude, longitude)
+        if self.warm:
+            self._grid.set(user_id, latitude, longitude)
+
+    def search(
+        self, latitude: float, longitude: float, distance: float, exclude: int
+    ) -> Tuple[List[int], List[float]]:
+        """
+        Ids of the users closer than distance to the point, nearest first and then by id,
+        along with their distances
+        """
+        return self._locations.search(latitude, longitude, distance, exclude)
+
+    @staticmethod
+    def seek(ids: List[int], distances: List[float], last_distance: float, last_id: int) -> int:
+        """
+        Position of the first result after (last_distance, last_id) in a search's results
+        """
+        return bisect.bisect_right(
+            range(len(ids)), (last_distance, last_id), key=lambda i: (distances[i], ids[i])
+        )
+
+    async def rebuild(self, session: AsyncSession) -> None:
+        started = time.perf_counter()
+        if self._snapshot is not None:
+            if await self._snapshot.build(session, requested_at=time.time()):
+                self.rebuild_seconds = time.perf_counter() - started
+            self._opened_snapshot()
+            return
+
+        self._pending = {}
+        try:
+            grid = _Grid(self.cell_degrees)
+            query = select(
+                UserLocation.user_id,
+                UserLocation.latitude.cast(Float),
+                UserLocation.longitude.cast(Float),
+            ).execution_options(yield_per=10_000)
+            # rows straight off the connection, the ORM's result processing isn't needed
+            connection = await session.connection()
+            result = await connection.stream(query)
+            async for partition in result.partitions():
+                for user_id, latitude, longitude in partition:
+                    grid.set(user_id, latitude, longitude)
+            for user_id, (latitude, longitude) in self._pending.items():
+                grid.set(user_id, latitude, longitude)
+        finally:
+            self._pending = None
+
+        self._grid = grid
+        self.warm = True
+        self.rebuild_seconds = time.perf_counter() - started
+        self.built_at = datetime.now(timezone.utc)
+        logger.info("Spatial index rebuilt, %d locations in %.3fs", len(grid), self.rebuild_seconds)
+
+    def _opened_snapshot(self) -> None:
+        assert self._snapshot is not None
+        self.warm = True
+        self.built_at = datetime.fromtimestamp(self._snapshot.built_at, timezone.utc)
+
+    def _is_stale(self) -> bool:
+        if self._snapshot is None:
+            return True
+        # another worker may have rebuilt it already
+        return self._snapshot.age() >= self.refresh_seconds > 0
+
+    def clear(self) -> None:
+        self._grid = _Grid(self.cell_degrees)
+        if self._snapshot is not None:
+            self._snapshot.close()
+        self.warm = False
+
+    async def _rebuild_from(self, session_maker) -> None:
+        try:
+            async with session_maker() as session:
+                await self.rebuild(session)
+        except Exception:
+            # keeps serving the previous index, or postgres while it's cold
+            logger.exception("Couldn't rebuild the spatial index")
+
+    async def _refresh(self, session_maker) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            if self._is_stale():
+                await self._rebuild_from(session_maker)
+
+    async def start(self, session_maker) -> None:
+        if self._snapshot is not None and self._snapshot.open() and not self._is_stale():
+            self._opened_snapshot()
+        else:
+            await self._rebuild_from(session_maker)
+        if self.refresh_seconds > 0:
+            self._task = asyncio.create_task(self._refresh(session_maker))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.clear()
+
+    def stats(self) -> SpatialIndexStatsDto:
+        locations = self._locations
+        return SpatialIndexStatsDto(
+            warm=self.warm,
+            shared=self._snapshot is not None,
+            size=len(locations) if self.warm else 0,
+            cells=self._snapshot.cells if self._snapshot is not None else len(self._grid.cells),
+            memory_bytes=locations.nbytes(),
+            rebuild_seconds=self.rebuild_seconds,
+            built_at=self.built_at,
+        )
+
+
+spatial_index = SpatialIndex(
+    cell_degrees=settings.GEO_INDEX_CELL_DEGREES,
+    refresh_seconds=settings.GEO_INDEX_REFRESH_SECONDS,
+    snapshot_path=settings.GEO_INDEX_SNAPSHOT_PATH,
+)
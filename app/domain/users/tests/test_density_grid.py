@@ -0,0 +1,110 @@
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import Numeric, cast, literal, select
+
+from app.domain.users.density_grid import DensityGrid, cell_columns
+from app.domain.users.nearby_feed import NearbyMove
+
+pytestmark = pytest.mark.anyio
+
+
+def _grid(**kwargs):
+    return DensityGrid(
+        **{
+            "enabled": True,
+            "cell_degrees": [1.0, 0.1],
+            "max_cells": 100,
+            "check_seconds": 0,
+            "manual_check_seconds": 60,
+            **kwargs,
+        }
+    )
+
+
+def test_moves_count_at_every_level():
+    grid = _grid()
+    fine = grid.levels[1]
+    assert grid.deltas([NearbyMove(1, 10.55, 20.55, None)]) == {
+        (0, 10 + 90, 20 + 180): 1,
+        (1, fine.row(10.55), fine.column(20.55)): 1,
+    }
+
+    # within the coarse cell, across fine cells
+    assert grid.deltas([NearbyMove(1, 10.55, 20.75, (10.55, 20.55))]) == {
+        (1, fine.row(10.55), fine.column(20.55)): -1,
+        (1, fine.row(10.55), fine.column(20.75)): 1,
+    }
+    assert grid.deltas([NearbyMove(1, 10.55, 20.56, (10.55, 20.55))]) == {}
+
+
+def test_moves_are_aggregated():
+    grid = _grid(cell_degrees=[1.0])
+    moves = [
+        NearbyMove(1, 10.5, 20.5, (11.5, 20.5)),
+        NearbyMove(2, 11.5, 20.5, (10.5, 20.5)),
+        NearbyMove(3, 10.5, 20.5, None),
+    ]
+    assert grid.deltas(moves) == {(0, 100, 200): 1}
+
+
+def test_picks_the_finest_zoom_within_max_cells():
+    grid = _grid()
+    # 2 x 2 cells at 1 degree, 20 x 20 at 0.1
+    assert grid.zoom_for(10.5, 11.5, 20.5, 21.5) == 0
+    # 5 x 5 at 0.1
+    assert grid.zoom_for(10.05, 10.45, 20.05, 20.45) == 1
+    # too large at every zoom
+    assert grid.zoom_for(-90, 90, -180, 180) == 0
+    assert grid.zoom_for(-90, 90, -180, 180, zoom=0) == 0
+
+    for kwargs in (
+        {"zoom": 1},
+        {"zoom": 2},
+        {"lat_min": 12.0},
+    ):
+        box = {"lat_min": 10.5, "lat_max": 11.5, "lon_min": 20.5, "lon_max": 21.5, **kwargs}
+        with pytest.raises(HTTPException) as exc_info:
+            grid.zoom_for(**box)
+        assert exc_info.value.status_code == 400
+
+    with pytest.raises(HTTPException) as exc_info:
+        _grid(enabled=False).zoom_for(10.5, 11.5, 20.5, 21.5)
+    assert exc_info.value.status_code == 503
+
+
+async def test_cells_are_numbered_alike_in_sql(session_maker):
+    grid = _grid(cell_degrees=[1.0, 0.1, 0.01, 0.3])
+    # on and around the cells' edges, where decimal and float arithmetic disagree
+    points = [
+        ("10.300000", "20.300000"),
+        ("-10.300000", "-20.700000"),
+        ("0.290000", "0.570000"),
+        ("-90.000000", "-180.000000"),
+        ("90.000000", "180.000000"),
+        ("89.990000", "179.990000"),
+        ("45.600000", "-0.010000"),
+    ]
+    async with session_maker() as session:
+        for latitude, longitude in points:
+            for cells in grid.levels:
+                row, column = cell_columns(
+                    cells, cast(literal(latitude), Numeric), cast(literal(longitude), Numeric)
+                )
+                assert (await session.execute(select(row, column))).one() == (
+                    cells.row(float(latitude)),
+                    cells.column(float(longitude)),
+                )
+
+
+async def test_checks_on_demand_are_debounced(session_maker):
+    grid = _grid()
+    async with session_maker() as session:
+        assert len(await grid.check_on_demand(session, repair=False)) == 2
+        with pytest.raises(HTTPException) as exc_info:
+            await grid.check_on_demand(session, repair=False)
+    assert exc_info.value.status_code == 429
+    assert 0 < int(exc_info.value.headers["Retry-After"]) <= 60
+
+    grid.manual_check_seconds = 0
+    async with session_maker() as session:
+        assert len(await grid.check_on_demand(session, repair=False)) == 2
@@ -0,0 +1,83 @@
+import pytest
+
+from app.domain.common.util import GeoLocationHelper
+from app.domain.users.geo_search_cache import (
+    GeoSearchCache,
+    GeoSearchCandidates,
+    GeoSearchKey,
+)
+
+
+def _key(cache, latitude, longitude, distance=10):
+    return GeoSearchKey(cache.cell_of(latitude, longitude), distance)
+
+
+def _candidates(*ids):
+    return GeoSearchCandidates(
+        ids=list(ids),
+        latitudes=[float(i) for i in ids],
+        longitudes=[float(i) for i in ids],
+    )
+
+
+def test_cells():
+    cache = GeoSearchCache(max_size=10, ttl=60, cell_degrees=0.01)
+    assert cache.cell_of(50.0012, 10.0099) == cache.cell_of(50.0088, 10.0001) == (5000, 1000)
+    assert cache.cell_of(-0.001, -0.001) == (-1, -1)
+    assert cache.center_of((5000, 1000)) == pytest.approx((50.005, 10.005))
+    # the edges of the world stay in it
+    assert cache.center_of(cache.cell_of(90, 180)) == pytest.approx((90, -179.995))
+
+
+def test_candidates_reach_the_corners_of_the_cell():
+    cache = GeoSearchCache(max_size=10, ttl=60, cell_degrees=0.01)
+    key = _key(cache, 50, 10)
+    corner = GeoLocationHelper.haversine_distance(*cache.center_of(key.cell), 50, 10)
+    assert cache.reach(key.cell) == pytest.approx(corner, rel=1e-3)
+    assert cache.radius(key) == pytest.approx(10 + corner, rel=1e-3)
+    # narrower cells nearer to the poles
+    assert cache.reach(cache.cell_of(80, 10)) < cache.reach(key.cell)
+
+
+def test_evicting_the_candidates_around_a_location():
+    cache = GeoSearchCache(max_size=10, ttl=60, cell_degrees=0.01)
+    near = _key(cache, 50, 10)
+    wide = _key(cache, 50.5, 10, distance=100)
+    far = _key(cache, 50.5, 10)
+    for key in (near, wide, far):
+        cache.set(key, _candidates(1, 2))
+
+    # within 10 kms of the first cell's center, ~50 kms away from the others,
+    # so within the wide radius as well
+    latitude, longitude = 50.05, 10.005
+    assert GeoLocationHelper.haversine_distance(
+        *cache.center_of(near.cell), latitude, longitude
+    ) == pytest.approx(5, abs=0.1)
+    cache.evict_around(latitude, longitude)
+    assert cache.get(near) is None
+    assert cache.get(wide) is None
+    assert cache.get(far) is not None
+
+    # within the candidates' radius but not the distance of the key
+    cache.set(near, _candidates(1, 2))
+    center = cache.center_of(near.cell)
+    cache.evict_around(center[0] + (10 + cache.reach(near.cell) / 2) / 111.2, center[1])
+    assert cache.get(near) is None
+
+    cache.evict_around(-50, -10)
+    assert len(cache) == 1
+
+
+def test_cache_is_bounded_and_counts_hits():
+    cache = GeoSearchCache(max_size=2, ttl=60, cell_degrees=0.01)
+    keys = [_key(cache, 50 + i, 10) for i in range(3)]
+    for key in keys:
+        cache.set(key, _candidates(1))
+
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[2]) == _candidates(1)
+    stats = cache.stats()
+    assert (stats.size, stats.evictions, stats.hits, stats.misses) == (2, 1, 1, 1)
+    assert stats.hit_rate == 0.5
+    # evicted keys are dropped from the regions as well
+    assert sum(len(keys) for keys in cache._region_keys.values()) == 2
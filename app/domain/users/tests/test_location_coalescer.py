@@ -0,0 +1,96 @@
+from decimal import Decimal
+
+from app.domain.users.location_coalescer import MAX_BATCH_SIZE, LocationCoalescer
+
+
+def _coalescer(**kwargs):
+    return LocationCoalescer(
+        **{"flush_seconds": 1, "batch_size": 100, "min_distance": 10, **kwargs}
+    )
+
+
+def test_keeps_the_latest_position_per_user():
+    coalescer = _coalescer()
+    assert coalescer.submit(1, Decimal("10.000000"), Decimal("10.000000"))
+    assert coalescer.submit(2, Decimal("20.000000"), Decimal("20.000000"))
+    assert coalescer.submit(1, Decimal("10.100000"), Decimal("10.000000"))
+    assert len(coalescer) == 2
+    assert coalescer._take() == {
+        1: (Decimal("10.100000"), Decimal("10.000000")),
+        2: (Decimal("20.000000"), Decimal("20.000000")),
+    }
+    stats = coalescer.stats()
+    assert (stats.received, stats.coalesced, stats.dropped, stats.pending) == (3, 1, 0, 0)
+
+
+def test_drops_small_moves():
+    coalescer = _coalescer()
+    assert coalescer.submit(1, Decimal("10.000000"), Decimal("10.000000"))
+    # ~5.5 meters
+    assert not coalescer.submit(1, Decimal("10.000050"), Decimal("10.000000"))
+    # ~11 meters
+    assert coalescer.submit(1, Decimal("10.000100"), Decimal("10.000000"))
+    assert coalescer.stats().dropped == 1
+
+    coalescer = _coalescer(min_distance=0)
+    assert coalescer.submit(1, Decimal("10.000000"), Decimal("10.000000"))
+    assert coalescer.submit(1, Decimal("10.000000"), Decimal("10.000000"))
+
+
+def test_signals_a_full_batch():
+    coalescer = _coalescer(batch_size=2)
+    coalescer.submit(1, Decimal("10.000000"), Decimal("10.000000"))
+    assert not coalescer._full.is_set()
+    coalescer.submit(2, Decimal("10.000000"), Decimal("10.000000"))
+    assert coalescer._full.is_set()
+    coalescer._take()
+    assert not coalescer._full.is_set()
+
+    assert _coalescer(batch_size=100_000).batch_size == MAX_BATCH_SIZE
+
+
+def test_requeued_positions_dont_replace_newer_ones():
+    coalescer = _coalescer()
+    coalescer.submit(1, Decimal("10.000000"), Decimal("10.000000"))
+    coalescer.submit(2, Decimal("20.000000"), Decimal("20.000000"))
+    failed = coalescer._take()
+    coalescer.submit(1, Decimal("11.000000"), Decimal("10.000000"))
+    coalescer._requeue(failed)
+    assert coalescer._take() == {
+        1: (Decimal("11.000000"), Decimal("10.000000")),
+        2: (Decimal("20.000000"), Decimal("20.000000")),
+    }
+
+
+def test_requeued_positions_are_given_up_on():
+    coalescer = _coalescer(max_attempts=2)
+    coalescer.submit(1, Decimal("10.000000"), Decimal("10.000000"))
+    coalescer._requeue(coalescer._take())
+    assert len(coalescer) == 1
+    coalescer._requeue(coalescer._take())
+    assert len(coalescer) == 0
+    assert coalescer.stats().rejected == 1
+
+
+def test_pending_users_are_bounded():
+    coalescer = _coalescer(max_pending=2)
+    assert coalescer.submit(1, Decimal("10.000000"), Decimal("10.000000"))
+    assert coalescer.submit(2, Decimal("20.000000"), Decimal("20.000000"))
+    assert not coalescer.submit(3, Decimal("30.000000"), Decimal("30.000000"))
+    # pending users still move
+    assert coalescer.submit(1, Decimal("11.000000"), Decimal("10.000000"))
+    failed = coalescer._take()
+    coalescer.submit(3, Decimal("30.000000"), Decimal("30.000000"))
+    coalescer.submit(4, Decimal("40.000000"), Decimal("40.000000"))
+    coalescer._requeue(failed)
+    assert set(coalescer._take()) == {3, 4}
+    assert coalescer.stats().rejected == 3
+
+
+def test_last_flushed_positions_are_bounded():
+    coalescer = _coalescer(last_known_size=1)
+    coalescer._flushed.set(1, (10.0, 10.0))
+    assert coalescer._last_known(1) == (10.0, 10.0)
+    coalescer._flushed.set(2, (20.0, 20.0))
+    assert coalescer._last_known(1) is None
+    assert not coalescer.submit(2, Decimal("20.000001"), Decimal("20.000000"))
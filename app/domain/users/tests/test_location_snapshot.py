@@ -0,0 +1,141 @@
+import random
+import time
+
+import pytest
+
+from app.domain.common import util
+from app.domain.common.util import GeoLocationHelper
+from app.domain.users import location_snapshot
+from app.domain.users.location_snapshot import (
+    HEADER_SIZE,
+    LocationSnapshot,
+    write_location_snapshot,
+)
+
+
+@pytest.fixture(params=["numpy", "python"])
+def implementation(request, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(location_snapshot, "np", None)
+        monkeypatch.setattr(util, "np", None)
+    return request.param
+
+
+def _locations(count: int):
+    rng = random.Random(count)
+    # poles and the antimeridian as well
+    latitudes = [89.99, -89.99, 0.0, 0.0] + [rng.uniform(-5, 5) for _ in range(count)]
+    longitudes = [10.0, -10.0, 179.99, -179.99] + [rng.uniform(170, 180) for _ in range(count)]
+    return list(range(1, len(latitudes) + 1)), latitudes, longitudes
+
+
+def _brute_force(locations, latitude, longitude, distance, exclude):
+    matches = sorted(
+        (GeoLocationHelper.haversine_distance(latitude, longitude, lat, lon), user_id)
+        for user_id, lat, lon in zip(*locations)
+        if user_id != exclude
+    )
+    return [user_id for d, user_id in matches if d < distance]
+
+
+def _snapshot(tmp_path, locations, started_at=0.0) -> LocationSnapshot:
+    path = str(tmp_path / "locations.snapshot")
+    user_ids, latitudes, longitudes = locations
+    write_location_snapshot(
+        path, user_ids, latitudes, longitudes, cell_degrees=1.0, started_at=started_at
+    )
+    snapshot = LocationSnapshot(path, cell_degrees=1.0)
+    assert snapshot.open()
+    return snapshot
+
+
+@pytest.mark.parametrize(
+    "latitude, longitude", [(0, 175), (0, 179.99), (0, -179.99), (89.99, 0), (-89.99, 100)]
+)
+@pytest.mark.parametrize("distance", [10, 100, 500])
+def test_search(tmp_path, implementation, latitude, longitude, distance):
+    locations = _locations(2000)
+    snapshot = _snapshot(tmp_path, locations)
+    assert len(snapshot) == 2004
+
+    ids, distances = snapshot.search(latitude, longitude, distance, exclude=5)
+    assert ids == _brute_force(locations, latitude, longitude, distance, exclude=5)
+    assert distances == sorted(distances)
+    assert snapshot.location_of(3) == (0.0, 179.99)
+    assert snapshot.location_of(10_000) is None
+
+
+def test_numpy_and_python_write_the_same_records(tmp_path, monkeypatch):
+    pytest.importorskip("numpy")
+    locations = _locations(500)
+    with_numpy = tmp_path / "numpy.snapshot"
+    write_location_snapshot(str(with_numpy), *locations, cell_degrees=1.0, started_at=0)
+    monkeypatch.setattr(location_snapshot, "np", None)
+    with_python = tmp_path / "python.snapshot"
+    write_location_snapshot(str(with_python), *locations, cell_degrees=1.0, started_at=0)
+
+    assert with_numpy.read_bytes()[HEADER_SIZE:] == with_python.read_bytes()[HEADER_SIZE:]
+
+
+def test_workers_see_each_others_writes(tmp_path, implementation):
+    snapshot = _snapshot(tmp_path, ([1, 2], [0.0, 0.0], [10.0, 10.1]))
+    # another worker maps the same snapshot
+    other = LocationSnapshot(snapshot.path, cell_degrees=1.0)
+    assert other.open()
+
+    # user 2 moves away, user 3 shows up
+    snapshot.set(2, 20.0, 20.0)
+    snapshot.set(3, 0.0, 10.05)
+    for worker in (snapshot, other):
+        assert worker.location_of(2) == (20.0, 20.0)
+        assert worker.search(0, 10, 20, exclude=0)[0] == [1, 3]
+        assert worker.search(20, 20, 20, exclude=0)[0] == [2]
+        assert len(worker) == 3
+        worker.close()
+
+
+def test_rebuilt_snapshots_are_swapped_in(tmp_path, implementation):
+    snapshot = _snapshot(tmp_path, ([1], [0.0], [10.0]))
+    snapshot.set(1, 0.0, 10.1)
+    started_at = time.time()
+    snapshot.set(2, 0.0, 10.2)
+
+    # a rebuild that read user 1's write but started before user 2's
+    write_location_snapshot(snapshot.path, [1], [0.0], [10.1], 1.0, started_at)
+    snapshot._compact_delta(started_at)
+    assert snapshot.search(0, 10, 50, exclude=0)[0] == [1, 2]
+    assert snapshot.started_at == started_at
+    assert snapshot.count == 1
+    # only the write the snapshot may have missed is kept
+    assert (tmp_path / "locations.snapshot.delta").stat().st_size == 32
+    snapshot.close()
+
+
+def test_writes_to_a_compacted_delta_log_are_kept(tmp_path):
+    snapshot = _snapshot(tmp_path, ([1], [0.0], [10.0]))
+    other = LocationSnapshot(snapshot.path, cell_degrees=1.0)
+    assert other.open()
+    # both workers hold the log open
+    snapshot.set(1, 0.0, 10.1)
+    other.set(2, 0.0, 10.2)
+
+    snapshot._compact_delta(started_at=0)
+    other.set(3, 0.0, 10.3)
+    assert snapshot.search(0, 10, 50, exclude=0)[0] == [1, 2, 3]
+    assert (tmp_path / "locations.snapshot.delta").stat().st_size == 3 * 32
+    snapshot.close()
+    other.close()
+
+
+def test_delta_log_is_replayed_in_bounded_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(location_snapshot, "MAX_CATCH_UP_RECORDS", 2)
+    snapshot = _snapshot(tmp_path, ([1], [0.0], [10.0]))
+    other = LocationSnapshot(snapshot.path, cell_degrees=1.0)
+    assert other.open()
+    for user_id in range(2, 7):
+        snapshot.set(user_id, 0.0, 10.0)
+
+    for found in (3, 5, 6, 6):
+        assert len(other.search(0, 10, 50, exclude=0)[0]) == found
+    snapshot.close()
+    other.close()
@@ -0,0 +1,178 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app.config import settings
+from app.domain.users.dtos import UserWithDistanceDto
+from app.domain.users.nearby_feed import NearbyFeed, NearbyMove
+from app.infrastructure.dtos import PaginationDto
+
+pytestmark = pytest.mark.anyio
+
+
+def _feed(**kwargs):
+    return NearbyFeed(
+        **{
+            "enabled": True,
+            "max_subscribers": 10,
+            "cell_degrees": 0.5,
+            "queue_size": 10,
+            "heartbeat_seconds": 60,
+            **kwargs,
+        }
+    )
+
+
+def _snapshot(*users):
+    results = [
+        UserWithDistanceDto(
+            id=user_id,
+            username=f"u{user_id}",
+            email=f"u{user_id}@a.com",
+            is_active=True,
+            distance=d,
+        )
+        for user_id, d in users
+    ]
+    return PaginationDto(results=results, total=len(results), page=1, size=100)
+
+
+def _parse(chunk: bytes):
+    event, data = chunk.decode().strip().split("\n")
+    return event.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+
+def test_moves_are_encoded():
+    for move in [NearbyMove(1, 50.5, -10.25, (50.0, -10.0)), NearbyMove(2, -1.0, 1.0, None)]:
+        assert NearbyMove.decode(move.encode()) == move
+
+
+def test_subscriptions_are_registered_in_the_cells_they_overlap():
+    feed = _feed()
+    subscription = feed.subscribe(1, 50.2, 10.2, 10)
+    assert len(subscription.cells) == 1
+    assert len(feed.subscribe(2, 50.0, 10.0, 10).cells) == 4
+    assert feed.stats().subscribers == 2
+
+    feed.unsubscribe(subscription)
+    feed.unsubscribe(subscription)
+    stats = feed.stats()
+    assert (stats.subscribers, stats.cells) == (1, 4)
+
+
+def test_subscribers_are_limited():
+    feed = _feed(max_subscribers=1)
+    feed.subscribe(1, 50.0, 10.0, 10)
+    with pytest.raises(HTTPException) as exc_info:
+        feed.subscribe(2, 50.0, 10.0, 10)
+    assert exc_info.value.status_code == 503
+    assert feed.stats().rejected == 1
+
+
+async def test_streaming_moves():
+    feed = _feed()
+    subscription = feed.subscribe(1, 50.0, 10.0, 10)
+    # queued before the snapshot is sent, applied on top of it
+    feed.dispatch(NearbyMove(2, 50.01, 10.0, (50.02, 10.0)))
+    stream = feed.stream(subscription, _snapshot((2, 2.2)))
+    event, snapshot = _parse(await anext(stream))
+    assert (event, snapshot["total"]) == ("snapshot", 1)
+    assert _parse(await anext(stream)) == ("move", {"id": 2, "distance": pytest.approx(1.11, 0.01)})
+
+    # not anywhere near
+    feed.dispatch(NearbyMove(3, 10.0, 10.0, None))
+    feed.dispatch(NearbyMove(3, 50.05, 10.0, (10.0, 10.0)))
+    assert _parse(await anext(stream)) == (
+        "enter",
+        {"id": 3, "distance": pytest.approx(5.56, 0.01)},
+    )
+    # in a neighbouring cell, but outside the radius
+    feed.dispatch(NearbyMove(2, 49.5, 10.0, (50.01, 10.0)))
+    assert _parse(await anext(stream)) == ("leave", {"id": 2})
+
+    feed.dispatch(NearbyMove(1, 51.0, 10.0, (50.0, 10.0)))
+    assert _parse(await anext(stream)) == ("recenter", {})
+    with pytest.raises(StopAsyncIteration):
+        await anext(stream)
+    stats = feed.stats()
+    assert (stats.subscribers, stats.published, stats.delivered) == (0, 5, 3)
+
+
+async def test_subscribing_once_the_stream_is_iterated():
+    feed = _feed(max_subscribers=1)
+
+    async def read_snapshot():
+        # subscribed by now, applied on top of the snapshot
+        feed.dispatch(NearbyMove(2, 50.01, 10.0, None))
+        return _snapshot()
+
+    # a response the client left before it was sent
+    feed.subscribe_stream(1, 50.0, 10.0, 10, read_snapshot)
+    assert feed.stats().subscribers == 0
+
+    stream = feed.subscribe_stream(1, 50.0, 10.0, 10, read_snapshot)
+    assert _parse(await anext(stream))[0] == "snapshot"
+    assert feed.stats().subscribers == 1
+    assert _parse(await anext(stream))[0] == "enter"
+
+    # the last slot was taken since the request was admitted
+    other = feed.subscribe_stream(3, 50.0, 10.0, 10, read_snapshot)
+    assert _parse(await anext(other)) == ("resync", {})
+    with pytest.raises(StopAsyncIteration):
+        await anext(other)
+
+    await stream.aclose()
+    stats = feed.stats()
+    assert (stats.subscribers, stats.rejected) == (0, 1)
+
+
+async def test_slow_subscribers_resync():
+    feed = _feed(queue_size=2)
+    subscription = feed.subscribe(1, 50.0, 10.0, 10)
+    for user_id in range(2, 5):
+        feed.dispatch(NearbyMove(user_id, 50.01, 10.0, None))
+    stream = feed.stream(subscription, _snapshot())
+    assert _parse(await anext(stream))[0] == "snapshot"
+    assert _parse(await anext(stream)) == ("resync", {})
+    assert feed.stats().overflowed == 1
+
+
+async def test_heartbeats():
+    feed = _feed(heartbeat_seconds=0.01)
+    stream = feed.stream(feed.subscribe(1, 50.0, 10.0, 10), _snapshot())
+    await anext(stream)
+    assert await anext(stream) == b": heartbeat\n\n"
+    await stream.aclose()
+    assert feed.stats().subscribers == 0
+
+
+async def test_moves_are_published_to_every_listener():
+    engine = create_async_engine(settings.TEST_DATABASE_URI.unicode_string())
+    feeds = [_feed(queue_size=200), _feed(queue_size=200)]
+    try:
+        for feed in feeds:
+            await feed.listen(engine)
+        subscriptions = [feed.subscribe(1, 50.0, 10.0, 10) for feed in feeds]
+        async with AsyncSession(engine) as session:
+            # more than fit a single notification
+            moves = [NearbyMove(user_id, 50.01, 10.0, None) for user_id in range(2, 152)]
+            await feeds[0].publish(session, moves)
+            # nothing is sent until the transaction commits
+            await asyncio.sleep(0.1)
+            assert feeds[0].stats().published == 0
+            await session.commit()
+
+        for feed, subscription in zip(feeds, subscriptions):
+            for _ in range(10):
+                if feed.stats().published == len(moves):
+                    break
+                await asyncio.sleep(0.05)
+            assert feed.stats().published == len(moves)
+            assert (await subscription.get())[0] == 2
+    finally:
+        for feed in feeds:
+            await feed.stop()
+        await engine.dispose()
@@ -1,12 +1,103 @@
-from typing import Generic, List, TypeVar
+from datetime import datetime
+from enum import StrEnum
+from typing import Dict, Generic, List, TypeVar
 
 from pydantic import BaseModel
 
 D = TypeVar("D")
 
 
+class CountStrategy(StrEnum):
+    # a separate COUNT(*) query
+    EXACT = "exact"
+    # count(*) OVER () in the page query itself, not available for cursor pages
+    WINDOW = "window"
+    # an exact count, reused for a while by identical queries
+    CACHED = "cached"
+    # the planner's row estimate, can be far off
+    ESTIMATED = "estimated"
+    # no total, only has_more
+    NONE = "none"
+
+
 class PaginationDto(BaseModel, Generic[D]):
-    total: int
-    page: int
+    # None when total_strategy is "none"
+    total: int | None
+    # how total was obtained, see CountStrategy
+    total_strategy: CountStrategy = CountStrategy.EXACT
+    has_more: bool = False
+    # None when the page was fetched with a cursor
+    page: int | None
     size: int
     results: List[D]
+    # pass back as `cursor` to fetch the next page, None on the last page
+    next_cursor: str | None = None
+
+
+class CacheStatsDto(BaseModel):
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    evictions: int
+    hit_rate: float
+
+
+class HistogramDto(BaseModel):
+    count: int
+    sum: float
+    max: float
+    buckets: Dict[str, int]
+
+
+class PoolStatsDto(BaseModel):
+    size: int
+    checked_in: int
+    checked_out: int
+    overflow: int
+    checkouts: int
+    timeouts: int
+    wait_time_ms: HistogramDto
+    checkout_latency_ms: HistogramDto
+
+
+class EventStatsDto(BaseModel):
+    queued: int
+    max_queued: int
+    workers: int
+    sent: int
+    # handler runs that succeeded, and that raised
+    handled: int
+    failed: int
+    # sent to a full queue with the "drop" policy
+    dropped: int
+    # sent to a full queue and handled by the sender, with the "inline" policy, which
+    # raises the handlers' errors to it
+    handled_inline: int
+    handler_latency_ms: HistogramDto
+
+
+class OutboxStatsDto(BaseModel):
+    dispatching: bool
+    batches: int
+    claimed: int
+    dispatched: int
+    failed: int
+    # failed for the last allowed time, left in the outbox
+    given_up: int
+    last_dispatched_at: datetime | None
+
+
+class EmailSenderStatsDto(BaseModel):
+    connections: int
+    connected: int
+    queued: int
+    max_queued: int
+    sent: int
+    failed: int
+    # dropped with EMAIL_SUPRESS_SEND
+    suppressed: int
+    # connections opened, the first one of every connection included
+    connects: int
+    sent_per_second: float
+    send_latency_ms: HistogramDto
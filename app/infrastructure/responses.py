@@ -0,0 +1,13 @@
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+class ModelResponse(JSONResponse):
+    """
+    Renders an already validated pydantic model straight to JSON.
+    FastAPI doesn't validate a returned Response against the route's response_model,
+    so endpoints returning it should declare response_model for the docs.
+    """
+
+    def render(self, content: BaseModel) -> bytes:
+        return content.model_dump_json().encode()
@@ -0,0 +1,84 @@
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, Tuple, TypeVar
+
+from app.infrastructure.dtos import CacheStatsDto
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    Bounded in-process LRU cache, every entry expires after `ttl` seconds at the latest
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[K, Tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> V | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            self.pop(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V, ttl: float | None = None) -> None:
+        """
+        ttl : seconds until the entry expires, capped at the cache's own ttl
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            old_key, (_, old_value) = self._entries.popitem(last=False)
+            self.evictions += 1
+            self._on_remove(old_key, old_value)
+
+    def pop(self, key: K) -> V | None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+
+        self._on_remove(key, entry[1])
+        return entry[1]
+
+    def clear(self) -> None:
+        for key in list(self._entries):
+            self.pop(key)
+
+    def stats(self) -> CacheStatsDto:
+        lookups = self.hits + self.misses
+        return CacheStatsDto(
+            size=len(self._entries),
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            hit_rate=self.hits / lookups if lookups else 0.0,
+        )
+
+    def _on_remove(self, key: K, value: V) -> None:
+        """
+        Called whenever an entry leaves the cache, override to keep secondary indexes in sync
+        """
@@ -0,0 +1,55 @@
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import (
+    AsyncAdaptedQueuePool,
+    ConnectionPoolEntry,
+    PoolProxiedConnection,
+)
+
+from app.infrastructure.dtos import PoolStatsDto
+from app.infrastructure.services.metrics import Histogram
+
+
+class PoolMetrics:
+    def __init__(self) -> None:
+        self.checkouts = 0
+        self.timeouts = 0
+        # time spent waiting for a free (or new) connection
+        self.wait_time = Histogram()
+        # the whole checkout, including the pre-ping
+        self.checkout_latency = Histogram()
+
+    def stats(self, pool: AsyncAdaptedQueuePool) -> PoolStatsDto:
+        return PoolStatsDto(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            checkouts=self.checkouts,
+            timeouts=self.timeouts,
+            wait_time_ms=self.wait_time.stats(),
+            checkout_latency_ms=self.checkout_latency.stats(),
+        )
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    def connect(self) -> PoolProxiedConnection:
+        started = time.perf_counter()
+        connection = super().connect()
+        pool_metrics.checkout_latency.observe((time.perf_counter() - started) * 1000)
+        pool_metrics.checkouts += 1
+        return connection
+
+    def _do_get(self) -> ConnectionPoolEntry:
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.timeouts += 1
+            raise
+        finally:
+            pool_metrics.wait_time.observe((time.perf_counter() - started) * 1000)
@@ -0,0 +1,213 @@
+import asyncio
+import contextlib
+import logging
+import time
+from email.message import EmailMessage
+from typing import List, Tuple
+
+import aiosmtplib
+
+from app.config import settings
+from app.infrastructure.dtos import EmailSenderStatsDto
+from app.infrastructure.services.metrics import Histogram, RateMeter
+
+logger = logging.getLogger(__name__)
+
+
+class _Connection(aiosmtplib.SMTP):
+    # whether the last message got as far as DATA, the server may have accepted it
+    # even if the connection dropped before its reply
+    sent_data = False
+
+    async def data(self, *args, **kwargs):
+        self.sent_data = True
+        return await super().data(*args, **kwargs)
+
+
+class EmailSender:
+    """
+    Sends messages over a pool of persistent SMTP connections.
+
+    `send` queues the message and waits until the server accepts it. `connections` tasks,
+    one per connection, take up to `batch_size` queued messages at a time and send them one
+    after another over their connection, logged in once when it's opened. At most
+    `connections` messages are in flight at once, senders wait once `queue_size` are queued.
+
+    A connection the server dropped, after being idle for a while for example, is opened
+    again and the message sent once more, unless it was dropped after the message's DATA,
+    so a message is never delivered twice. Other errors fail the message.
+    """
+
+    def __init__(
+        self,
+        hostname: str,
+        port: int,
+        username: str | None,
+        password: str | None,
+        use_tls: bool,
+        start_tls: bool,
+        validate_certs: bool,
+        suppress_send: bool,
+        connections: int,
+        queue_size: int,
+        batch_size: int,
+        timeout: float,
+    ) -> None:
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.start_tls = start_tls
+        self.validate_certs = validate_certs
+        self.suppress_send = suppress_send
+        self.connections = connections
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._queue: asyncio.Queue[Tuple[EmailMessage, asyncio.Future]] | None = None
+        self._clients: List[_Connection] = []
+        self._tasks: List[asyncio.Task] = []
+        self.sent = 0
+        self.failed = 0
+        self.suppressed = 0
+        self.connects = 0
+        self.send_rate = RateMeter()
+        self.send_latency = Histogram()
+
+    async def send(self, message: EmailMessage) -> None:
+        """
+        Queues the message, and waits until the server accepted it
+        """
+        if self.suppress_send:
+            self.suppressed += 1
+            return
+        if self._queue is None:
+            raise RuntimeError("The email sender isn't started")
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((message, future))
+        await future
+
+    def _client(self) -> _Connection:
+        return _Connection(
+            hostname=self.hostname,
+            port=self.port,
+            username=self.username,
+            password=self.password,
+            use_tls=self.use_tls,
+            # False rather than None, aiosmtplib would upgrade to TLS whenever the server offers it
+            start_tls=self.start_tls,
+            validate_certs=self.validate_certs,
+            timeout=self.timeout,
+        )
+
+    async def _send_over(self, client: _Connection, message: EmailMessage) -> None:
+        for attempt in range(2):
+            if not client.is_connected:
+                # logs in as well
+                await client.connect()
+                self.connects += 1
+            client.sent_data = False
+            try:
+                await client.send_message(message)
+                return
+            except aiosmtplib.SMTPServerDisconnected:
+                client.close()
+                if attempt or client.sent_data:
+                    raise
+                logger.info("The SMTP server dropped a connection, opening it again")
+
+    async def _work(self, client: _Connection) -> None:
+        assert self._queue is not None
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                while len(batch) < self.batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+
+                try:
+                    for message, future in batch:
+                        await self._send(client, message, future)
+                        self._queue.task_done()
+                finally:
+                    # stopped in the middle of the batch
+                    for _, future in batch:
+                        future.cancel()
+        finally:
+            client.close()
+
+    async def _send(
+        self, client: _Connection, message: EmailMessage, future: asyncio.Future
+    ) -> None:
+        started = time.perf_counter()
+        try:
+            await self._send_over(client, message)
+        except Exception as exc:
+            self.failed += 1
+            if not future.done():
+                future.set_exception(exc)
+        else:
+            self.sent += 1
+            self.send_rate.mark()
+            if not future.done():
+                future.set_result(None)
+        self.send_latency.observe((time.perf_counter() - started) * 1000)
+
+    def start(self) -> None:
+        if self.suppress_send or self._queue is not None:
+            return
+        self._queue = asyncio.Queue(self.queue_size)
+        self._clients = [self._client() for _ in range(self.connections)]
+        self._tasks = [asyncio.create_task(self._work(client)) for client in self._clients]
+
+    async def stop(self, timeout: float) -> None:
+        """
+        Sends the queued messages for at most timeout seconds, then closes the connections
+        """
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropped %d emails still queued after %ss", self._queue.qsize(), timeout)
+
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+        self._queue, self._clients, self._tasks = None, [], []
+
+    def stats(self) -> EmailSenderStatsDto:
+        return EmailSenderStatsDto(
+            connections=len(self._clients),
+            connected=sum(client.is_connected for client in self._clients),
+            queued=self._queue.qsize() if self._queue is not None else 0,
+            max_queued=self.queue_size,
+            sent=self.sent,
+            failed=self.failed,
+            suppressed=self.suppressed,
+            connects=self.connects,
+            sent_per_second=self.send_rate.rate(),
+            send_latency_ms=self.send_latency.stats(),
+        )
+
+
+email_sender = EmailSender(
+    hostname=settings.EMAIL_SERVER,
+    port=settings.EMAIL_PORT,
+    username=settings.EMAIL_USERNAME if settings.EMAIL_USE_CREDENTIALS else None,
+    password=settings.EMAIL_PASSWORD if settings.EMAIL_USE_CREDENTIALS else None,
+    use_tls=settings.EMAIL_SSL_TLS,
+    start_tls=settings.EMAIL_STARTTLS,
+    validate_certs=settings.EMAIL_VALIDATE_CERTS,
+    suppress_send=settings.EMAIL_SUPRESS_SEND,
+    connections=settings.EMAIL_CONNECTIONS,
+    queue_size=settings.EMAIL_QUEUE_SIZE,
+    batch_size=settings.EMAIL_BATCH_SIZE,
+    timeout=settings.EMAIL_TIMEOUT_SECONDS,
+)
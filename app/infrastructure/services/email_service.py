@@ -1,32 +1,91 @@
 import asyncio
+from email.message import EmailMessage
+from enum import StrEnum
+from typing import Dict
 
-from fastapi_mail import ConnectionConfig, FastMail, MessageSchema
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    Template,
+    TemplateNotFound,
+    select_autoescape,
+)
 
 from app.config import settings
+from app.infrastructure.services.email_sender import EmailSender, email_sender
+
+
+class EmailTemplate(StrEnum):
+    PASSWORD_RESET = "password-reset.html"
+    CONFIRMATION = "confirmation.html"
 
 
 class EmailService:
-    def __init__(self) -> None:
-        config = ConnectionConfig(
-            MAIL_USERNAME=settings.EMAIL_USERNAME,
-            MAIL_PASSWORD=settings.EMAIL_PASSWORD,
-            MAIL_FROM=settings.EMAIL_FROM,
-            MAIL_PORT=settings.EMAIL_PORT,
-            MAIL_SERVER=settings.EMAIL_SERVER,
-            MAIL_SSL_TLS=settings.EMAIL_SSL_TLS,
-            MAIL_STARTTLS=settings.EMAIL_STARTTLS,
-            USE_CREDENTIALS=settings.EMAIL_USE_CREDENTIALS,
-            VALIDATE_CERTS=settings.EMAIL_VALIDATE_CERTS,
-            SUPPRESS_SEND=settings.EMAIL_SUPRESS_SEND,
-            TEMPLATE_FOLDER="app/templates",
-        )
-        self._fm = FastMail(config)
-
-    async def send_email(self, template_name: str, email_to: str, subject: str, **template_data):
-        message = MessageSchema(
-            subject=subject,
-            recipients=[email_to],
-            template_body=template_data,
-            subtype="html",
+    """
+    Renders emails from the templates and hands them to the process wide EmailSender.
+
+    Every EmailTemplate is compiled once, by `load_templates` at startup, into an environment
+    that caches the compiled templates on disk for the other workers and the next restarts.
+    Templates are rendered on a worker thread, a large one doesn't hold up the event loop.
+    """
+
+    def __init__(
+        self,
+        sender: EmailSender,
+        sender_address: str,
+        template_folder: str,
+        bytecode_cache: bool,
+    ) -> None:
+        self._sender = sender
+        self._sender_address = sender_address
+        self.template_folder = template_folder
+        self._environment = Environment(
+            loader=FileSystemLoader(template_folder),
+            autoescape=select_autoescape(),
+            bytecode_cache=FileSystemBytecodeCache() if bytecode_cache else None,
+            # the templates are compiled once, their files aren't checked for changes
+            auto_reload=False,
         )
-        asyncio.create_task(self._fm.send_message(message, template_name=template_name))
+        self._templates: Dict[EmailTemplate, Template] = {}
+
+    def load_templates(self) -> None:
+        """
+        Compiles every EmailTemplate, raises if one of them is missing
+        """
+        templates = {}
+        for template in EmailTemplate:
+            try:
+                templates[template] = self._environment.get_template(template.value)
+            except TemplateNotFound:
+                raise RuntimeError(
+                    f"The {template.name} email template {template.value} "
+                    f"is missing from {self.template_folder}"
+                )
+        self._templates = templates
+
+    async def render(self, template: EmailTemplate, **template_data) -> str:
+        if not self._templates:
+            self.load_templates()
+        return await asyncio.to_thread(self._templates[template].render, **template_data)
+
+    async def send_email(
+        self, template: EmailTemplate, email_to: str, subject: str, **template_data
+    ) -> None:
+        """
+        Sends the email, returns once the SMTP server accepted it
+        """
+        message = EmailMessage()
+        message["From"] = self._sender_address
+        message["To"] = email_to
+        message["Subject"] = subject
+        message.set_content(await self.render(template, **template_data), subtype="html")
+        await self._sender.send(message)
+
+
+email_service = EmailService(
+    sender=email_sender,
+    sender_address=settings.EMAIL_FROM,
+    template_folder=settings.EMAIL_TEMPLATE_FOLDER,
+    bytecode_cache=settings.EMAIL_TEMPLATE_BYTECODE_CACHE,
+)
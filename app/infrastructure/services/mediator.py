@@ -1,13 +1,64 @@
+import asyncio
+import contextlib
+import logging
+import time
 from collections import defaultdict
+from enum import StrEnum
 from typing import Dict, List, Type
 
 from pydantic import BaseModel
 
+from app.config import settings
+from app.infrastructure.dtos import EventStatsDto
 from app.infrastructure.event_handlers.base_event_handler import BaseEventHandler
+from app.infrastructure.services.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class DispatchMode(StrEnum):
+    # the sender awaits the handlers one after another
+    INLINE = "inline"
+    QUEUED = "queued"
+
+
+class Backpressure(StrEnum):
+    BLOCK = "block"
+    DROP = "drop"
+    INLINE = "inline"
+
+
+class EventMetrics:
+    def __init__(self) -> None:
+        self.sent = 0
+        self.handled = 0
+        self.failed = 0
+        self.dropped = 0
+        self.handled_inline = 0
+        self.handler_latency = Histogram()
 
 
 class Mediator:
+    """
+    Hands events to the handlers registered for their type.
+
+    Until `start` runs, or with the "inline" dispatch, `send` awaits the handlers one after
+    another and raises their errors. Once started with the "queued" dispatch, `send` puts the
+    event on the bounded queue of its type and returns, `workers` tasks per type take the
+    events off and run their handlers concurrently. Their errors are logged and counted.
+    Events sent to a full queue wait for room, are dropped or are handled by the sender,
+    depending on `backpressure`, the sender handles them the same way as the inline dispatch.
+    `drain` handles what is left on the queues at shutdown.
+    """
+
     events_map: Dict[Type[BaseModel], List[BaseEventHandler]] = defaultdict(list)
+    dispatch = DispatchMode(settings.MEDIATOR_DISPATCH)
+    workers = settings.MEDIATOR_WORKERS
+    queue_size = settings.MEDIATOR_QUEUE_SIZE
+    backpressure = Backpressure(settings.MEDIATOR_BACKPRESSURE)
+    _queues: Dict[Type[BaseModel], asyncio.Queue] = {}
+    _tasks: List[asyncio.Task] = []
+    _metrics: Dict[Type[BaseModel], EventMetrics] = defaultdict(EventMetrics)
 
     @classmethod
     def register(cls, event_type: Type[BaseModel], handler: BaseEventHandler) -> None:
@@ -15,5 +66,128 @@ class Mediator:
 
     @classmethod
     async def send(cls, event: BaseModel) -> None:
+        event_type = event.__class__
+        metrics = cls._metrics[event_type]
+        metrics.sent += 1
+        queue = cls._queues.get(event_type)
+        if queue is None:
+            await cls._handle_inline(event, metrics)
+            return
+
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            if cls.backpressure == Backpressure.BLOCK:
+                await queue.put(event)
+            elif cls.backpressure == Backpressure.DROP:
+                metrics.dropped += 1
+                logger.warning("Dropped a %s, its queue is full", event_type.__name__)
+            else:
+                metrics.handled_inline += 1
+                await cls._handle_inline(event, metrics)
+
+    @classmethod
+    async def _handle_inline(cls, event: BaseModel, metrics: EventMetrics) -> None:
+        """
+        Runs the event's handlers one after another, the first error stops them and is raised
+        """
         for handler in cls.events_map[event.__class__]:
+            await cls._run(handler, event, metrics)
+
+    @classmethod
+    async def _run(cls, handler: BaseEventHandler, event: BaseModel, metrics: EventMetrics):
+        started = time.perf_counter()
+        try:
             await handler.handle(event)
+        except Exception:
+            metrics.failed += 1
+            raise
+        else:
+            metrics.handled += 1
+        finally:
+            metrics.handler_latency.observe((time.perf_counter() - started) * 1000)
+
+    @classmethod
+    async def handle(cls, event: BaseModel) -> bool:
+        """
+        Runs the event's handlers concurrently, their errors are logged.
+        Returns whether every handler succeeded.
+        """
+        metrics = cls._metrics[event.__class__]
+        handlers = cls.events_map[event.__class__]
+        results = await asyncio.gather(
+            *(cls._run(handler, event, metrics) for handler in handlers), return_exceptions=True
+        )
+        for handler, result in zip(handlers, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    "%s failed to handle a %s",
+                    handler.__class__.__name__,
+                    event.__class__.__name__,
+                    exc_info=result,
+                )
+        return not any(isinstance(result, Exception) for result in results)
+
+    @classmethod
+    async def _work(cls, queue: asyncio.Queue) -> None:
+        while True:
+            event = await queue.get()
+            try:
+                await cls.handle(event)
+            finally:
+                queue.task_done()
+
+    @classmethod
+    def start(cls) -> None:
+        """
+        Queues the events of the registered types from now on, with the "queued" dispatch
+        """
+        if cls.dispatch != DispatchMode.QUEUED or cls._queues:
+            return
+        for event_type in cls.events_map:
+            queue: asyncio.Queue = asyncio.Queue(cls.queue_size)
+            cls._queues[event_type] = queue
+            cls._tasks.extend(asyncio.create_task(cls._work(queue)) for _ in range(cls.workers))
+
+    @classmethod
+    async def drain(cls, timeout: float) -> None:
+        """
+        Waits for the queued events to be handled, for at most timeout seconds,
+        then stops the workers. Events sent afterwards are handled inline.
+        """
+        queues, cls._queues = cls._queues, {}
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in queues.values())), timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Dropped %d events still queued after %ss",
+                sum(queue.qsize() for queue in queues.values()),
+                timeout,
+            )
+
+        tasks, cls._tasks = cls._tasks, []
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    @classmethod
+    def stats(cls) -> Dict[str, EventStatsDto]:
+        stats = {}
+        for event_type in cls.events_map:
+            metrics = cls._metrics[event_type]
+            stats[event_type.__name__] = EventStatsDto(
+                queued=cls._queues[event_type].qsize() if event_type in cls._queues else 0,
+                max_queued=cls.queue_size,
+                workers=cls.workers if event_type in cls._queues else 0,
+                sent=metrics.sent,
+                handled=metrics.handled,
+                failed=metrics.failed,
+                dropped=metrics.dropped,
+                handled_inline=metrics.handled_inline,
+                handler_latency_ms=metrics.handler_latency.stats(),
+            )
+        return stats
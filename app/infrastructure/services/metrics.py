@@ -0,0 +1,63 @@
+import bisect
+import time
+from collections import deque
+from typing import Deque, List, Sequence
+
+from app.infrastructure.dtos import HistogramDto
+
+
+class Histogram:
+    """
+    Fixed bucket histogram of durations in milliseconds
+    """
+
+    DEFAULT_BUCKETS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def stats(self) -> HistogramDto:
+        # cumulative counts per upper bound, the same way prometheus reports them
+        buckets, cumulative = {}, 0
+        for upper_bound, count in zip([*self.buckets, "+Inf"], self._counts):
+            cumulative += count
+            buckets[str(upper_bound)] = cumulative
+
+        return HistogramDto(count=self.count, sum=self.total, max=self.max, buckets=buckets)
+
+
+class RateMeter:
+    """
+    Events per second over the last `window_seconds` seconds
+    """
+
+    def __init__(self, window_seconds: int = 10) -> None:
+        self.window_seconds = window_seconds
+        # [second, events] pairs, oldest first
+        self._seconds: Deque[List[int]] = deque()
+
+    def _trim(self, now: int) -> None:
+        while self._seconds and self._seconds[0][0] <= now - self.window_seconds:
+            self._seconds.popleft()
+
+    def mark(self, events: int = 1) -> None:
+        now = int(time.monotonic())
+        if self._seconds and self._seconds[-1][0] == now:
+            self._seconds[-1][1] += events
+        else:
+            self._seconds.append([now, events])
+        self._trim(now)
+
+    def rate(self) -> float:
+        self._trim(int(time.monotonic()))
+        return sum(events for _, events in self._seconds) / self.window_seconds
@@ -0,0 +1,25 @@
+from typing import AsyncIterator, Type
+
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.infrastructure.services.paginator import list_adapter
+
+
+async def stream_ndjson(
+    session: AsyncSession,
+    qs,
+    serializer: Type[BaseModel],
+    batch_size: int = 500,
+) -> AsyncIterator[bytes]:
+    """
+    Runs qs, which selects plain labelled columns matching the serializer's fields,
+    on a server-side cursor and yields the rows as newline-delimited JSON.
+    Only one batch of rows is held at a time, the next batch isn't fetched until
+    the previous one is consumed, so a slow consumer slows down the cursor as well.
+    """
+    result = await session.stream(qs.execution_options(yield_per=batch_size))
+    adapter = list_adapter(serializer)
+    async for rows in result.mappings().partitions():
+        items = adapter.validate_python(rows)
+        yield b"".join(item.model_dump_json().encode() + b"\n" for item in items)
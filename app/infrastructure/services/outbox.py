@@ -0,0 +1,228 @@
+import asyncio
+import contextlib
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import List, Sequence, Type
+
+from pydantic import BaseModel
+from sqlalchemy import (
+    BigInteger,
+    Interval,
+    any_,
+    bindparam,
+    delete,
+    func,
+    insert,
+    select,
+    update,
+)
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.infrastructure.dtos import OutboxStatsDto
+from app.infrastructure.services.mediator import Mediator
+from app.infrastructure.services.session_service import after_commit
+from app.repositories.outbox.models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Domain events delivered at least once, whatever happens to the worker raising them.
+
+    `add` writes the event in the caller's transaction, so it's committed or rolled back
+    with the change raising it. Dispatchers claim batches of events with FOR UPDATE SKIP
+    LOCKED, which pushes their available_at past a lease, hand them to the Mediator's
+    handlers and delete the handled ones, one claim and one acknowledgement per batch.
+    Concurrent dispatchers skip each other's rows, an event is only claimed again once its
+    lease runs out, when its dispatcher died or took longer than the lease.
+
+    Failed events are retried later, with all their handlers, until max_attempts.
+    """
+
+    def __init__(
+        self,
+        mediator: Type[Mediator],
+        enabled: bool,
+        batch_size: int,
+        poll_seconds: float,
+        lease_seconds: float,
+        retry_seconds: float,
+        max_attempts: int,
+    ) -> None:
+        self.mediator = mediator
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.retry_seconds = retry_seconds
+        self.max_attempts = max_attempts
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+        self.batches = 0
+        self.claimed = 0
+        self.dispatched = 0
+        self.failed = 0
+        self.given_up = 0
+        self.last_dispatched_at: datetime | None = None
+
+    async def add(self, session: AsyncSession, event: BaseModel) -> None:
+        """
+        Writes the event in the session's transaction, this worker dispatches it once committed
+        """
+        await session.execute(
+            insert(OutboxEvent.__table__).values(
+                event_type=event.__class__.__name__, payload=event.model_dump(mode="json")
+            )
+        )
+        after_commit(session, self._wake.set)
+
+    def claim_query(self):
+        events = OutboxEvent.__table__
+        claimable = (
+            select(events.c.id)
+            .where(events.c.available_at <= func.now(), events.c.attempts < self.max_attempts)
+            .order_by(events.c.available_at, events.c.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        lease = func.now() + bindparam("lease", timedelta(seconds=self.lease_seconds), Interval)
+        return (
+            update(events)
+            .where(events.c.id.in_(claimable.scalar_subquery()))
+            .values(available_at=lease, attempts=events.c.attempts + 1)
+            .returning(events.c.id, events.c.event_type, events.c.payload, events.c.attempts)
+        )
+
+    async def claim(self, session: AsyncSession) -> Sequence[Row]:
+        """
+        Leases the next batch of events to this dispatcher, and commits
+        """
+        rows = (await session.execute(self.claim_query())).all()
+        await session.commit()
+        self.claimed += len(rows)
+        return rows
+
+    def acknowledge_query(self, done: List[int], failed: List[int]):
+        events = OutboxEvent.__table__
+        retry = func.now() + events.c.attempts * bindparam(
+            "retry", timedelta(seconds=self.retry_seconds), Interval
+        )
+        retried = (
+            update(events)
+            .where(events.c.id == any_(bindparam("failed", failed, ARRAY(BigInteger))))
+            .values(available_at=retry)
+        )
+        return (
+            delete(events)
+            .where(events.c.id == any_(bindparam("done", done, ARRAY(BigInteger))))
+            .add_cte(retried.cte("retried"))
+        )
+
+    async def acknowledge(self, session: AsyncSession, done: List[int], failed: List[int]) -> None:
+        """
+        Deletes the handled events and schedules the failed ones again, and commits
+        """
+        await session.execute(self.acknowledge_query(done, failed))
+        await session.commit()
+
+    async def _handle(self, row: Row) -> bool:
+        event_type = next(
+            (type_ for type_ in self.mediator.events_map if type_.__name__ == row.event_type),
+            None,
+        )
+        if event_type is None:
+            logger.error("No handlers for the outbox event %d, a %s", row.id, row.event_type)
+            return False
+        try:
+            event = event_type.model_validate(row.payload)
+        except ValueError:
+            logger.exception("Couldn't read the outbox event %d", row.id)
+            return False
+        return await self.mediator.handle(event)
+
+    async def dispatch(self, session_maker) -> int:
+        """
+        Handles a batch of events, returns how many were claimed
+        """
+        async with session_maker() as session:
+            rows = await self.claim(session)
+        if not rows:
+            return 0
+
+        results = await asyncio.gather(*(self._handle(row) for row in rows))
+        done = [row.id for row, handled in zip(rows, results) if handled]
+        failed = [row.id for row, handled in zip(rows, results) if not handled]
+        async with session_maker() as session:
+            await self.acknowledge(session, done, failed)
+
+        for row, handled in zip(rows, results):
+            if not handled and row.attempts >= self.max_attempts:
+                self.given_up += 1
+                logger.error(
+                    "Gave up on the outbox event %d after %d attempts", row.id, row.attempts
+                )
+        self.batches += 1
+        self.dispatched += len(done)
+        self.failed += len(failed)
+        self.last_dispatched_at = datetime.now(timezone.utc)
+        return len(rows)
+
+    async def _dispatch_continuously(self, session_maker) -> None:
+        while not self._stopping:
+            # events committed from now on wake the dispatcher, other workers' are polled for
+            self._wake.clear()
+            try:
+                claimed = await self.dispatch(session_maker)
+            except Exception:
+                logger.exception("Couldn't dispatch the outbox events")
+                claimed = 0
+            if claimed < self.batch_size:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wake.wait(), self.poll_seconds)
+
+    def start(self, session_maker) -> None:
+        if self.enabled:
+            self._stopping = False
+            self._task = asyncio.create_task(self._dispatch_continuously(session_maker))
+
+    async def stop(self, timeout: float) -> None:
+        """
+        Lets the dispatcher finish its batch, for at most timeout seconds. The events of
+        a batch cut short are claimed again once their lease runs out.
+        """
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Stopped dispatching the outbox events in the middle of a batch")
+        self._task = None
+
+    def stats(self) -> OutboxStatsDto:
+        return OutboxStatsDto(
+            dispatching=self._task is not None,
+            batches=self.batches,
+            claimed=self.claimed,
+            dispatched=self.dispatched,
+            failed=self.failed,
+            given_up=self.given_up,
+            last_dispatched_at=self.last_dispatched_at,
+        )
+
+
+outbox = Outbox(
+    mediator=Mediator,
+    enabled=settings.OUTBOX_DISPATCHER_ENABLED,
+    batch_size=settings.OUTBOX_BATCH_SIZE,
+    poll_seconds=settings.OUTBOX_POLL_SECONDS,
+    lease_seconds=settings.OUTBOX_LEASE_SECONDS,
+    retry_seconds=settings.OUTBOX_RETRY_SECONDS,
+    max_attempts=settings.OUTBOX_MAX_ATTEMPTS,
+)
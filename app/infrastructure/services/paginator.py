@@ -1,15 +1,134 @@
-from typing import Type
+import base64
+import binascii
+import hashlib
+import json
+from decimal import Decimal
+from typing import Any, Dict, List, Sequence, Tuple, Type
 
-from pydantic import BaseModel
-from sqlalchemy import func, select
+from fastapi import HTTPException, status
+from pydantic import BaseModel, TypeAdapter
+from sqlalchemy import ClauseElement, ColumnElement, Executable, func, select, tuple_
+from sqlalchemy.ext.compiler import compiles
 
 from app.config import settings
-from app.infrastructure.dtos import PaginationDto
+from app.infrastructure.dtos import CountStrategy, PaginationDto
+from app.infrastructure.services.cache import LRUCache
+
+count_cache: LRUCache[bytes, int] = LRUCache(
+    max_size=settings.PAGINATION_COUNT_CACHE_MAX_SIZE,
+    ttl=settings.PAGINATION_COUNT_CACHE_TTL_SECONDS,
+)
+
+
+class Explain(Executable, ClauseElement):
+    """
+    EXPLAIN (FORMAT JSON) of a statement, returns its plan without running it
+    """
+
+    inherit_cache = False
+
+    def __init__(self, statement) -> None:
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def _compile_explain(element: Explain, compiler, **kw) -> str:
+    return f"EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kw)}"
+
+
+_list_adapters: Dict[Type[BaseModel], TypeAdapter] = {}
+
+
+def list_adapter(serializer: Type[BaseModel]) -> TypeAdapter:
+    """
+    TypeAdapter of a list of serializer, built once per serializer
+    """
+    adapter = _list_adapters.get(serializer)
+    if adapter is None:
+        adapter = _list_adapters[serializer] = TypeAdapter(
+            List[serializer]  # type: ignore[valid-type]
+        )
+    return adapter
+
+
+def _selects_entity(qs) -> bool:
+    column = qs.column_descriptions[0]
+    return column["expr"] is column["entity"]
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode()
+
+
+# a cursor value of a float sort key may have been encoded as an int, i.e. 0
+NUMBER: Tuple[type, ...] = (int, float)
+
+
+def cursor_type(key: ColumnElement) -> Tuple[type, ...]:
+    """
+    The JSON types a cursor value of the sort key may have
+    """
+    try:
+        python_type = key.type.python_type
+    except NotImplementedError:
+        return (str, *NUMBER)
+    if python_type is int:
+        return (int,)
+    if python_type in (float, Decimal):
+        return NUMBER
+    return (str,)
+
+
+def decode_cursor(cursor: str, types: Sequence[Tuple[type, ...]]) -> List[Any]:
+    """
+    Decodes the values of a cursor, one of each of types, 400 when they don't match.
+    Left to the database, a value of the wrong type would fail the query with a 500.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        values = None
+    if (
+        not isinstance(values, list)
+        or len(values) != len(types)
+        # bool is an int too
+        or any(
+            isinstance(value, bool) or not isinstance(value, type_)
+            for value, type_ in zip(values, types)
+        )
+    ):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    return values
 
 
 class Paginator:
     MAX_PAGE = 2**31 - 1
 
+    @staticmethod
+    async def count(session, qs) -> int:
+        return await session.scalar(select(func.count()).select_from(qs.subquery()))
+
+    @staticmethod
+    async def cached_count(session, qs) -> int:
+        """
+        Counts qs, identical queries with identical parameters reuse the count for a while
+        """
+        compiled = qs.compile()
+        params = sorted(compiled.params.items())
+        key = hashlib.sha256(f"{compiled}{params!r}".encode()).digest()
+        count = count_cache.get(key)
+        if count is None:
+            count = await Paginator.count(session, qs)
+            count_cache.set(key, count)
+        return count
+
+    @staticmethod
+    async def estimated_count(session, qs) -> int:
+        plan = await session.scalar(Explain(qs))
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
     @staticmethod
     async def get_paginated_response(
         session,
@@ -17,20 +136,77 @@ class Paginator:
         serializer: Type[BaseModel],
         limit: int = 100,
         page: int = 1,
+        cursor: str | None = None,
+        sort_keys: Sequence[ColumnElement] = (),
+        count: CountStrategy = CountStrategy.EXACT,
     ) -> PaginationDto:
+        """
+        Paginates qs, which selects either an ORM entity, or plain labelled columns matching
+        the serializer's fields. The latter skips building ORM objects altogether,
+        each page is validated from the row mappings in one go.
+
+        Paginates with limit/offset, or when sort_keys are given, also returns a `next_cursor`.
+        sort_keys must be the unique, ascending order of qs, i.e. (distance, id).
+        Passing the cursor back seeks past the last row of the previous page instead of
+        offsetting, so deep pages cost the same as the first one.
+
+        `count` picks how the total is obtained, see CountStrategy.
+        """
         # maximum of 100 items per page
         page_size = min(settings.MAX_PAGE_SIZE, limit)
         # maximum arg for page is 2**31 - 1 to avoid internal server error
         page = min(Paginator.MAX_PAGE, page)
-        # get the total count for the query
-        count = await session.scalar(select(func.count()).select_from(qs.subquery()))
-        # limit offset for given page and limit
-        qs = qs.limit(page_size).offset((page - 1) * page_size)
-        objects = await session.scalars(qs)
-        data = [serializer.model_validate(obj) for obj in objects.unique()]
+        if count == CountStrategy.WINDOW and cursor is not None:
+            # the window would only count the rows after the cursor
+            count = CountStrategy.NONE
+
+        total = None
+        if count == CountStrategy.EXACT:
+            total = await Paginator.count(session, qs)
+        elif count == CountStrategy.CACHED:
+            total = await Paginator.cached_count(session, qs)
+        elif count == CountStrategy.ESTIMATED:
+            total = await Paginator.estimated_count(session, qs)
+
+        page_qs = qs
+        if cursor is not None:
+            values = decode_cursor(cursor, [cursor_type(key) for key in sort_keys])
+            page_qs = qs.where(tuple_(*sort_keys) > tuple_(*values))
+        else:
+            page_qs = qs.offset((page - 1) * page_size)
+        keys = [key.label(f"cursor_key_{i}") for i, key in enumerate(sort_keys)]
+        if count == CountStrategy.WINDOW:
+            keys.append(func.count().over().label("window_total"))
+        # one extra row tells whether there is a next page
+        page_qs = page_qs.add_columns(*keys).limit(page_size + 1)
+        result = await session.execute(page_qs)
+        entities = _selects_entity(qs)
+        # joined eager loads of entities may repeat rows
+        rows = (result.unique() if entities else result).all()
+
+        if count == CountStrategy.WINDOW:
+            # past the last page there's no row to carry the count
+            total = rows[0].window_total if rows else await Paginator.count(session, qs)
+
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        next_cursor = None
+        if sort_keys and has_more:
+            last = rows[-1]._mapping
+            next_cursor = encode_cursor([last[f"cursor_key_{i}"] for i in range(len(sort_keys))])
+        if entities:
+            results = list_adapter(serializer).validate_python(
+                [row[0] for row in rows], from_attributes=True
+            )
+        else:
+            # extra columns like the cursor keys are ignored by the serializer
+            results = list_adapter(serializer).validate_python([row._mapping for row in rows])
         return PaginationDto(
-            results=data,
-            page=page,
+            results=results,
+            total=total,
+            total_strategy=count,
+            has_more=has_more,
+            page=None if cursor is not None else page,
             size=page_size,
-            total=count,
+            next_cursor=next_cursor,
         )
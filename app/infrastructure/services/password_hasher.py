@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from enum import StrEnum
+from typing import Any, Callable
+
+from fastapi import HTTPException, status
+from passlib.hash import pbkdf2_sha256
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class HasherExecutor(StrEnum):
+    PROCESS = "process"
+    THREAD = "thread"
+    # hashes on the event loop itself, only meant for comparison and debugging
+    INLINE = "inline"
+
+
+def _hash(password: str) -> str:
+    return pbkdf2_sha256.hash(password)
+
+
+def _verify(password: str, hashed_password: str) -> bool:
+    return pbkdf2_sha256.verify(password, hashed_password)
+
+
+class PasswordHasher:
+    """
+    Runs PBKDF2 hashing and verification on a worker pool instead of the event loop.
+    At most `max_in_flight` hashes run at once, up to `max_queued` more wait for a slot,
+    anything beyond that is rejected with 503 so a login storm can't starve other requests.
+    """
+
+    def __init__(
+        self,
+        executor: HasherExecutor,
+        workers: int,
+        max_in_flight: int,
+        max_queued: int,
+    ) -> None:
+        self.executor_type = executor
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self._executor: Executor | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._queued = 0
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run(_verify, password, hashed_password)
+
+    def start(self) -> None:
+        if self.executor_type == HasherExecutor.INLINE or self._executor is not None:
+            return
+
+        if self.executor_type == HasherExecutor.PROCESS:
+            try:
+                # spawn, forking a process that runs an event loop isn't safe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+                return
+            except (NotImplementedError, OSError) as exc:
+                logger.warning("Process pool unavailable (%s), hashing on threads instead", exc)
+                self.executor_type = HasherExecutor.THREAD
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="password-hasher"
+        )
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._queued = 0
+        return self._semaphore
+
+    async def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.executor_type == HasherExecutor.INLINE:
+            return fn(*args)
+
+        semaphore = self._get_semaphore()
+        if semaphore.locked():
+            if self._queued >= self.max_queued:
+                raise HTTPException(
+                    status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many concurrent logins, try again later",
+                    headers={"Retry-After": "1"},
+                )
+            self._queued += 1
+            try:
+                await semaphore.acquire()
+            finally:
+                self._queued -= 1
+        else:
+            await semaphore.acquire()
+
+        try:
+            self.start()
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(self._executor, fn, *args)
+            except BrokenProcessPool:
+                logger.warning("Password hashing process pool broke, hashing on threads instead")
+                self.shutdown()
+                self.executor_type = HasherExecutor.THREAD
+                self.start()
+                return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            semaphore.release()
+
+
+password_hasher = PasswordHasher(
+    executor=HasherExecutor(settings.PASSWORD_HASHER_EXECUTOR),
+    workers=settings.PASSWORD_HASHER_WORKERS,
+    max_in_flight=settings.PASSWORD_HASHER_MAX_IN_FLIGHT,
+    max_queued=settings.PASSWORD_HASHER_MAX_QUEUED,
+)
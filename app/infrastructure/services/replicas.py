@@ -0,0 +1,89 @@
+import functools
+import inspect
+import itertools
+import time
+from contextvars import ContextVar
+from typing import Dict, List
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+_read_only: ContextVar[bool] = ContextVar("read_only", default=False)
+
+
+def read_only(fn):
+    """
+    Marks a service method as read-only, the queries it runs may go to a replica.
+    Async generators are marked while they run, not in between the items they yield.
+    """
+
+    if inspect.isasyncgenfunction(fn):
+
+        @functools.wraps(fn)
+        async def generator_wrapper(*args, **kwargs):
+            generator = fn(*args, **kwargs)
+            try:
+                while True:
+                    token = _read_only.set(True)
+                    try:
+                        item = await generator.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    finally:
+                        _read_only.reset(token)
+                    yield item
+            finally:
+                await generator.aclose()
+
+        return generator_wrapper
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        token = _read_only.set(True)
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            _read_only.reset(token)
+
+    return wrapper
+
+
+def is_read_only() -> bool:
+    return _read_only.get()
+
+
+class ReplicaRouter:
+    """
+    Picks the replica read-only queries run on,
+    and remembers who wrote recently so they keep reading from the primary for a while
+    """
+
+    def __init__(self, engines: List[AsyncEngine], selection: str, read_your_writes: float) -> None:
+        self.engines = engines
+        self.selection = selection
+        self.read_your_writes = read_your_writes
+        self._round_robin = itertools.cycle(engines)
+        # user id -> time.monotonic() of their last write
+        self._writes: Dict[int, float] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.engines)
+
+    def pick(self) -> AsyncEngine:
+        if self.selection == "least_connections":
+            return min(self.engines, key=lambda engine: engine.pool.checkedout())
+        return next(self._round_robin)
+
+    def record_write(self, user_id: int) -> None:
+        now = time.monotonic()
+        self._writes[user_id] = now
+        if len(self._writes) > 10_000:
+            self._writes = {
+                user_id: written_at
+                for user_id, written_at in self._writes.items()
+                if now - written_at < self.read_your_writes
+            }
+
+    def wrote_recently(self, user_id: int) -> bool:
+        written_at = self._writes.get(user_id)
+        return written_at is not None and time.monotonic() - written_at < self.read_your_writes
@@ -1,20 +1,185 @@
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import sessionmaker
+from typing import Any, AsyncIterator, Callable, Coroutine
+
+import anyio
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.orm import ORMExecuteState, Session, sessionmaker
 
 from app.config import settings
+from app.infrastructure.services.db_pool import InstrumentedQueuePool
+from app.infrastructure.services.replicas import ReplicaRouter, is_read_only
+
+
+def _create_engine(database_uri: str, **kwargs) -> AsyncEngine:
+    return create_async_engine(
+        database_uri,
+        echo=settings.DB_ECHO,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        connect_args={"prepared_statement_cache_size": settings.DB_PREPARED_STATEMENT_CACHE_SIZE},
+        **kwargs,
+    )
+
 
-engine = create_async_engine(settings.DATABASE_URI.unicode_string(), echo=True, future=True)  # type: ignore # noqa
+engine = _create_engine(settings.DATABASE_URI.unicode_string(), poolclass=InstrumentedQueuePool)  # type: ignore # noqa
 
 async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+replica_router = ReplicaRouter(
+    engines=[_create_engine(uri.unicode_string()) for uri in settings.DATABASE_REPLICA_URIS],
+    selection=settings.DB_REPLICA_SELECTION,
+    read_your_writes=settings.DB_READ_YOUR_WRITES_SECONDS,
+)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_orm_writes(orm_execute_state: ORMExecuteState) -> None:
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info["wrote"] = True
+
+
+@event.listens_for(Session, "after_flush")
+def _track_flushes(session: Session, flush_context) -> None:
+    session.info["wrote"] = True
+
+
+def after_commit(session: AsyncSession, callback: Callable[[], None]) -> None:
+    """
+    Runs callback once the session's current transaction is committed
+    """
+    event.listen(session.sync_session, "after_commit", lambda _: callback(), once=True)
+
 
 class SessionMaker:
+    """
+    Unit of work, every service resolved for a request shares the same instance and session.
+    The session only checks out a connection once it is first used.
+
+    When created for a request, it is committed or rolled back once at the end of the request
+    by UnitOfWorkRoute, otherwise when its `async with` block exits.
+
+    Methods marked with @read_only read from a replica, unless this unit of work
+    already wrote, or its user wrote within the read-your-writes window.
+    """
+
+    def __init__(self, request: Request = None) -> None:
+        self.session: AsyncSession | None = None
+        self.replica_session: AsyncSession | None = None
+        self.user_id: int | None = None
+        self._request_scoped = request is not None
+        if request is not None:
+            request.state.unit_of_work = self
+
+    def _create_session(self) -> AsyncSession:
+        return async_session_maker()
+
+    def _create_replica_session(self) -> AsyncSession:
+        return async_session_maker(bind=replica_router.pick())
+
+    def bind_user(self, user_id: int) -> None:
+        """
+        Sets the user this unit of work acts for, their recent writes are read from the primary
+        """
+        self.user_id = user_id
+
+    def _wrote(self) -> bool:
+        return self.session is not None and self.session.info.get("wrote", False)
+
+    def _reads_from_replica(self) -> bool:
+        if not replica_router.enabled or not is_read_only() or self._wrote():
+            return False
+        return self.user_id is None or not replica_router.wrote_recently(self.user_id)
+
     async def __aenter__(self) -> AsyncSession:
-        self.session = async_session_maker()
+        if self._reads_from_replica():
+            if self.replica_session is None:
+                self.replica_session = self._create_replica_session()
+            return self.replica_session
+
+        if self.session is None:
+            self.session = self._create_session()
         return self.session
 
     async def __aexit__(self, exc, exc_val, exc_tb):
+        if self._request_scoped:
+            return
+
         if exc:
+            await self.rollback()
+        await self.close()
+
+    async def commit(self) -> None:
+        if self.session is not None:
+            wrote = self._wrote()
+            await self.session.commit()
+            if wrote and self.user_id is not None:
+                replica_router.record_write(self.user_id)
+
+    async def rollback(self) -> None:
+        if self.session is not None:
             await self.session.rollback()
 
-        await self.session.close()
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self.replica_session is not None:
+            await self.replica_session.close()
+            self.replica_session = None
+
+
+async def _finish_after_streaming(body: AsyncIterator, unit_of_work: SessionMaker) -> AsyncIterator:
+    try:
+        async for chunk in body:
+            yield chunk
+    except BaseException:
+        with anyio.CancelScope(shield=True):
+            await unit_of_work.rollback()
+            await unit_of_work.close()
+        raise
+    with anyio.CancelScope(shield=True):
+        try:
+            await unit_of_work.commit()
+        finally:
+            await unit_of_work.close()
+
+
+class UnitOfWorkRoute(APIRoute):
+    """
+    Commits the request's unit of work before the response is sent,
+    or rolls it back if the endpoint raised.
+    Streaming responses keep it open until their body is sent, so they can read from it.
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        route_handler = super().get_route_handler()
+
+        async def unit_of_work_route_handler(request: Request) -> Response:
+            try:
+                response = await route_handler(request)
+            except Exception:
+                unit_of_work = getattr(request.state, "unit_of_work", None)
+                if unit_of_work is not None:
+                    await unit_of_work.rollback()
+                    await unit_of_work.close()
+                raise
+
+            unit_of_work = getattr(request.state, "unit_of_work", None)
+            if unit_of_work is not None and isinstance(response, StreamingResponse):
+                response.body_iterator = _finish_after_streaming(
+                    response.body_iterator, unit_of_work
+                )
+            elif unit_of_work is not None:
+                try:
+                    await unit_of_work.commit()
+                finally:
+                    await unit_of_work.close()
+            return response
+
+        return unit_of_work_route_handler
@@ -0,0 +1,12 @@
+# a comment line, keeps idle connections and the proxies in between from timing out
+SSE_HEARTBEAT = b": heartbeat\n\n"
+
+# the response headers of an event stream, proxies mustn't buffer or cache it
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def format_sse(event: str, data: str) -> bytes:
+    """
+    A server-sent event, data must be a single line, i.e. compact JSON
+    """
+    return f"event: {event}\ndata: {data}\n\n".encode()
@@ -0,0 +1,164 @@
+import asyncio
+import socket
+from email.message import EmailMessage
+from typing import List, Set
+
+import aiosmtplib
+import pytest
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult, Session
+
+from app.infrastructure.services.email_sender import EmailSender
+
+pytestmark = pytest.mark.anyio
+
+
+class SmtpHandler:
+    def __init__(self) -> None:
+        self.messages: List[str] = []
+        self.sessions: Set[Session] = set()
+        self.logins = 0
+        # drops the connection before replying to the next DATA
+        self.drop_at_data = False
+
+    def authenticate(self, server, session, envelope, mechanism, auth_data) -> AuthResult:
+        self.logins += 1
+        return AuthResult(success=auth_data.login == b"user" and auth_data.password == b"pass")
+
+    async def handle_DATA(self, server, session, envelope) -> str:
+        self.sessions.add(session)
+        self.messages.append(envelope.rcpt_tos[0])
+        if self.drop_at_data:
+            self.drop_at_data = False
+            server.transport.close()
+        return "250 OK"
+
+
+class SmtpServer:
+    """
+    A local SMTP server, on a thread of its own
+    """
+
+    def __init__(self) -> None:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.handler = SmtpHandler()
+        self._controller: Controller | None = None
+
+    def start(self) -> None:
+        self._controller = Controller(
+            self.handler,
+            hostname="127.0.0.1",
+            port=self.port,
+            authenticator=self.handler.authenticate,
+            auth_require_tls=False,
+        )
+        self._controller.start()
+
+    def stop(self) -> None:
+        if self._controller is not None:
+            self._controller.stop()
+            self._controller = None
+
+
+@pytest.fixture()
+def smtp_server():
+    server = SmtpServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture()
+async def email_sender(smtp_server):
+    sender = EmailSender(
+        hostname="127.0.0.1",
+        port=smtp_server.port,
+        username="user",
+        password="pass",
+        use_tls=False,
+        start_tls=False,
+        validate_certs=False,
+        suppress_send=False,
+        connections=2,
+        queue_size=100,
+        batch_size=10,
+        timeout=5,
+    )
+    sender.start()
+    yield sender
+    await sender.stop(1)
+
+
+def _message(email_to: str) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = "sender@test.com"
+    message["To"] = email_to
+    message["Subject"] = "Test"
+    message.set_content("<p>Test</p>", subtype="html")
+    return message
+
+
+async def _send(email_sender, count: int):
+    await asyncio.gather(*(email_sender.send(_message(f"user{i}@test.com")) for i in range(count)))
+
+
+async def test_sends_over_persistent_connections(email_sender, smtp_server):
+    await _send(email_sender, 30)
+    await _send(email_sender, 10)
+
+    assert len(smtp_server.handler.messages) == 40
+    # logged in once per connection
+    assert len(smtp_server.handler.sessions) <= 2
+    assert smtp_server.handler.logins == email_sender.connects <= 2
+    stats = email_sender.stats()
+    assert (stats.sent, stats.failed, stats.queued) == (40, 0, 0)
+    assert stats.sent_per_second > 0
+    assert stats.send_latency_ms.count == 40
+
+
+async def test_reconnects_after_the_server_dropped_the_connection(email_sender, smtp_server):
+    await email_sender.send(_message("first@test.com"))
+    smtp_server.stop()
+    smtp_server.start()
+
+    await email_sender.send(_message("second@test.com"))
+    assert smtp_server.handler.messages == ["first@test.com", "second@test.com"]
+    assert email_sender.connects == 2
+
+
+async def test_messages_are_not_resent_after_data(email_sender, smtp_server):
+    smtp_server.handler.drop_at_data = True
+    # the server may have delivered it
+    with pytest.raises(aiosmtplib.SMTPServerDisconnected):
+        await email_sender.send(_message("first@test.com"))
+    await email_sender.send(_message("second@test.com"))
+    assert smtp_server.handler.messages == ["first@test.com", "second@test.com"]
+
+
+async def test_failures_are_raised_to_the_sender(email_sender, smtp_server):
+    smtp_server.stop()
+    with pytest.raises(aiosmtplib.SMTPConnectError):
+        await email_sender.send(_message("user@test.com"))
+    assert email_sender.stats().failed == 1
+
+    # the next message opens the connection again
+    smtp_server.start()
+    await email_sender.send(_message("user@test.com"))
+    assert smtp_server.handler.messages == ["user@test.com"]
+
+
+async def test_suppressed_messages_are_not_sent(email_sender, smtp_server):
+    email_sender.suppress_send = True
+    await _send(email_sender, 3)
+    assert smtp_server.handler.messages == []
+    assert email_sender.stats().suppressed == 3
+
+
+async def test_sending_before_start_fails(smtp_server):
+    sender = EmailSender(
+        "127.0.0.1", smtp_server.port, None, None, False, False, False, False, 1, 1, 1, 1
+    )
+    with pytest.raises(RuntimeError):
+        await sender.send(_message("user@test.com"))
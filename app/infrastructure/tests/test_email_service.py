@@ -0,0 +1,71 @@
+import shutil
+from email.message import EmailMessage
+from typing import List
+
+import pytest
+
+from app.config import settings
+from app.infrastructure.services.email_service import EmailService, EmailTemplate
+
+pytestmark = pytest.mark.anyio
+
+
+class Sender:
+    def __init__(self) -> None:
+        self.messages: List[EmailMessage] = []
+
+    async def send(self, message: EmailMessage) -> None:
+        self.messages.append(message)
+
+
+def _service(template_folder=settings.EMAIL_TEMPLATE_FOLDER, sender=None):
+    return EmailService(
+        sender=sender or Sender(),
+        sender_address="sender@test.com",
+        template_folder=template_folder,
+        bytecode_cache=False,
+    )
+
+
+def test_every_template_is_loaded():
+    service = _service()
+    service.load_templates()
+    assert set(service._templates) == set(EmailTemplate)
+
+
+def test_a_missing_template_fails_the_startup(tmp_path):
+    shutil.copy(f"{settings.EMAIL_TEMPLATE_FOLDER}/confirmation.html", tmp_path)
+    with pytest.raises(RuntimeError, match="password-reset.html"):
+        _service(template_folder=str(tmp_path)).load_templates()
+
+
+async def test_sends_the_rendered_template():
+    sender = Sender()
+    service = _service(sender=sender)
+    service.load_templates()
+    await service.send_email(
+        EmailTemplate.CONFIRMATION,
+        "user@test.com",
+        "Confirmation",
+        user="<user>@test.com",
+        url="http://test/confirm-email/token/",
+    )
+
+    (message,) = sender.messages
+    assert (message["To"], message["Subject"]) == ("user@test.com", "Confirmation")
+    html = message.get_content()
+    assert 'href="http://test/confirm-email/token/"' in html
+    # escaped, the templates are html
+    assert "Hello &lt;user&gt;@test.com" in html
+
+
+async def test_templates_are_compiled_once(tmp_path):
+    for template in EmailTemplate:
+        shutil.copy(f"{settings.EMAIL_TEMPLATE_FOLDER}/{template.value}", tmp_path)
+    service = _service(template_folder=str(tmp_path))
+    service.load_templates()
+
+    # changes to the files aren't picked up, nor is their removal
+    (tmp_path / EmailTemplate.CONFIRMATION.value).unlink()
+    html = await service.render(EmailTemplate.CONFIRMATION, user="user", url="url")
+    assert "Hello user" in html
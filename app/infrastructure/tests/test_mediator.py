@@ -0,0 +1,184 @@
+import asyncio
+from collections import defaultdict
+from typing import List
+
+import pytest
+from pydantic import BaseModel
+
+from app.infrastructure.event_handlers.base_event_handler import BaseEventHandler
+from app.infrastructure.services.mediator import (
+    Backpressure,
+    DispatchMode,
+    EventMetrics,
+    Mediator,
+)
+
+pytestmark = pytest.mark.anyio
+
+
+class Event(BaseModel):
+    id: int
+
+
+class Handler(BaseEventHandler):
+    def __init__(self, fails: bool = False) -> None:
+        self.fails = fails
+        self.handled: List[int] = []
+        self.release = asyncio.Event()
+        self.release.set()
+        self.running = 0
+        self.max_running = 0
+
+    async def handle(self, event: Event) -> None:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await self.release.wait()
+            if self.fails:
+                raise ValueError(event.id)
+            self.handled.append(event.id)
+        finally:
+            self.running -= 1
+
+
+async def _settle():
+    """
+    Lets the workers take the queued events and start their handlers
+    """
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+@pytest.fixture()
+def mediator():
+    class TestMediator(Mediator):
+        events_map = defaultdict(list)
+        dispatch = DispatchMode.QUEUED
+        workers = 2
+        queue_size = 2
+        backpressure = Backpressure.BLOCK
+        _queues = {}
+        _tasks = []
+        _metrics = defaultdict(EventMetrics)
+
+    return TestMediator
+
+
+async def test_handles_inline_until_started(mediator):
+    first, second = Handler(fails=True), Handler()
+    mediator.register(Event, first)
+    mediator.register(Event, second)
+
+    with pytest.raises(ValueError):
+        await mediator.send(Event(id=1))
+    # the handlers run one after another, the error stops them
+    assert second.handled == []
+    stats = mediator.stats()["Event"]
+    assert (stats.handled, stats.failed) == (0, 1)
+
+
+async def test_queued_events_are_handled_by_the_workers(mediator):
+    handler = Handler()
+    handler.release.clear()
+    mediator.register(Event, handler)
+    mediator.start()
+
+    for id in range(2):
+        await mediator.send(Event(id=id))
+    stats = mediator.stats()["Event"]
+    assert (stats.workers, stats.sent, stats.handled) == (2, 2, 0)
+
+    # handled concurrently by both workers
+    await _settle()
+    assert handler.max_running == 2
+    handler.release.set()
+    await mediator.drain(1)
+    assert sorted(handler.handled) == [0, 1]
+    stats = mediator.stats()["Event"]
+    assert (stats.queued, stats.workers, stats.handled) == (0, 0, 2)
+    assert stats.handler_latency_ms.count == 2
+
+
+async def test_handlers_run_concurrently_and_failures_are_counted(mediator):
+    failing, handler = Handler(fails=True), Handler()
+    mediator.register(Event, failing)
+    mediator.register(Event, handler)
+    mediator.start()
+
+    await mediator.send(Event(id=1))
+    await mediator.drain(1)
+    assert handler.handled == [1]
+    stats = mediator.stats()["Event"]
+    assert (stats.handled, stats.failed) == (1, 1)
+
+
+@pytest.mark.parametrize(
+    "backpressure, handled, dropped, handled_inline",
+    [
+        (Backpressure.BLOCK, [0, 1, 2, 3, 4], 0, 0),
+        (Backpressure.DROP, [0, 1, 2, 3], 1, 0),
+        (Backpressure.INLINE, [0, 1, 2, 3, 4], 0, 1),
+    ],
+)
+async def test_backpressure(mediator, backpressure, handled, dropped, handled_inline):
+    mediator.backpressure = backpressure
+    handler = Handler()
+    handler.release.clear()
+    mediator.register(Event, handler)
+    mediator.start()
+
+    # the workers hold two events and the queue two more
+    for id in range(4):
+        await mediator.send(Event(id=id))
+        await _settle()
+    sent = asyncio.create_task(mediator.send(Event(id=4)))
+    await _settle()
+    # blocked until there's room, or handled by the sender
+    assert sent.done() is (backpressure == Backpressure.DROP)
+
+    handler.release.set()
+    await sent
+    await mediator.drain(1)
+    assert sorted(handler.handled) == handled
+    stats = mediator.stats()["Event"]
+    assert (stats.dropped, stats.handled_inline) == (dropped, handled_inline)
+
+
+async def test_events_handled_by_the_sender_raise_like_inline_ones(mediator):
+    mediator.backpressure = Backpressure.INLINE
+    blocked = Handler()
+    blocked.release.clear()
+    mediator.register(Event, blocked)
+    mediator.start()
+    for id in range(4):
+        await mediator.send(Event(id=id))
+        await _settle()
+
+    # the queue is full, the handlers run one after another in the sender
+    failing, after = Handler(fails=True), Handler()
+    mediator.events_map[Event] = [failing, after]
+    with pytest.raises(ValueError):
+        await mediator.send(Event(id=4))
+    assert after.handled == []
+    stats = mediator.stats()["Event"]
+    assert (stats.handled_inline, stats.handled, stats.failed) == (1, 0, 1)
+
+    blocked.release.set()
+    await mediator.drain(1)
+
+
+async def test_drain_gives_up_after_the_timeout(mediator):
+    handler = Handler()
+    handler.release.clear()
+    mediator.register(Event, handler)
+    mediator.start()
+
+    await mediator.send(Event(id=1))
+    await mediator.drain(0.01)
+    assert handler.handled == []
+    assert mediator._tasks == []
+
+    # handled inline once drained
+    handler.release.set()
+    await mediator.send(Event(id=2))
+    assert handler.handled == [2]
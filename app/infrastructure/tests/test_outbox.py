@@ -0,0 +1,153 @@
+from collections import defaultdict
+from typing import List
+
+import pytest
+from pydantic import BaseModel
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+
+from app.infrastructure.event_handlers.base_event_handler import BaseEventHandler
+from app.infrastructure.services.mediator import EventMetrics, Mediator
+from app.infrastructure.services.outbox import Outbox
+from app.repositories.outbox.models import OutboxEvent
+
+pytestmark = pytest.mark.anyio
+
+
+class Event(BaseModel):
+    id: int
+
+
+class Handler(BaseEventHandler):
+    def __init__(self) -> None:
+        self.handled: List[int] = []
+        self.fails = False
+
+    async def handle(self, event: Event) -> None:
+        if self.fails:
+            raise ValueError(event.id)
+        self.handled.append(event.id)
+
+
+@pytest.fixture()
+def handler():
+    return Handler()
+
+
+@pytest.fixture()
+def outbox(handler):
+    class TestMediator(Mediator):
+        events_map = defaultdict(list)
+        _queues = {}
+        _tasks = []
+        _metrics = defaultdict(EventMetrics)
+
+    TestMediator.register(Event, handler)
+    # the test's transaction never ends, now() doesn't move, retried events are due at once
+    return Outbox(
+        mediator=TestMediator,
+        enabled=True,
+        batch_size=2,
+        poll_seconds=1,
+        lease_seconds=60,
+        retry_seconds=0,
+        max_attempts=2,
+    )
+
+
+@pytest.fixture()
+def statements():
+    executed = []
+
+    def on_execute(orm_execute_state):
+        executed.append(orm_execute_state.statement)
+
+    event.listen(Session, "do_orm_execute", on_execute)
+    yield executed
+    event.remove(Session, "do_orm_execute", on_execute)
+
+
+async def _add(session_maker, outbox, *ids):
+    async with session_maker() as session:
+        for id in ids:
+            await outbox.add(session, Event(id=id))
+        await session.commit()
+
+
+async def _pending(session_maker):
+    async with session_maker() as session:
+        return await session.scalar(select(func.count()).select_from(OutboxEvent))
+
+
+async def test_events_are_written_in_the_callers_transaction(session_maker, outbox):
+    async with session_maker() as session:
+        await outbox.add(session, Event(id=1))
+        await session.rollback()
+    assert await _pending(session_maker) == 0
+
+
+async def test_dispatches_a_batch_in_two_statements(session_maker, outbox, handler, statements):
+    await _add(session_maker, outbox, 1, 2, 3)
+
+    statements.clear()
+    assert await outbox.dispatch(session_maker) == 2
+    # the claim and the acknowledgement
+    assert len(statements) == 2
+    assert sorted(handler.handled) == [1, 2]
+    assert await _pending(session_maker) == 1
+
+    assert await outbox.dispatch(session_maker) == 1
+    assert await outbox.dispatch(session_maker) == 0
+    assert sorted(handler.handled) == [1, 2, 3]
+    assert await _pending(session_maker) == 0
+    stats = outbox.stats()
+    assert (stats.batches, stats.claimed, stats.dispatched) == (2, 3, 3)
+
+
+async def test_claimed_events_are_skipped_by_other_dispatchers(session_maker, outbox):
+    await _add(session_maker, outbox, 1)
+
+    async with session_maker() as session:
+        assert [row.event_type for row in await outbox.claim(session)] == ["Event"]
+    # leased to the first dispatcher
+    async with session_maker() as session:
+        assert await outbox.claim(session) == []
+
+
+async def test_failed_events_are_retried(session_maker, outbox, handler):
+    await _add(session_maker, outbox, 1)
+
+    handler.fails = True
+    assert await outbox.dispatch(session_maker) == 1
+    assert await _pending(session_maker) == 1
+
+    handler.fails = False
+    assert await outbox.dispatch(session_maker) == 1
+    assert handler.handled == [1]
+    assert await _pending(session_maker) == 0
+    stats = outbox.stats()
+    assert (stats.failed, stats.dispatched, stats.given_up) == (1, 1, 0)
+
+
+async def test_gives_up_after_max_attempts(session_maker, outbox, handler):
+    await _add(session_maker, outbox, 1)
+
+    handler.fails = True
+    assert await outbox.dispatch(session_maker) == 1
+    assert await outbox.dispatch(session_maker) == 1
+    assert await outbox.dispatch(session_maker) == 0
+    # left in the outbox
+    assert await _pending(session_maker) == 1
+    assert outbox.stats().given_up == 1
+
+
+async def test_events_without_handlers_are_retried(session_maker, outbox, handler):
+    class Unhandled(BaseModel):
+        id: int
+
+    async with session_maker() as session:
+        await outbox.add(session, Unhandled(id=1))
+        await session.commit()
+    assert await outbox.dispatch(session_maker) == 1
+    assert await _pending(session_maker) == 1
+    assert outbox.stats().failed == 1
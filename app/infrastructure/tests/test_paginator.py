@@ -0,0 +1,95 @@
+import pytest
+from fastapi import HTTPException
+from mimesis import Locale, Person
+from sqlalchemy import select
+
+from app.domain.auth.dtos import UserDto
+from app.infrastructure.dtos import CountStrategy
+from app.infrastructure.services.paginator import Paginator, count_cache, encode_cursor
+from app.repositories.users.models import User, UserProfile
+
+pytestmark = pytest.mark.anyio
+
+person = Person(Locale.EN)
+
+
+@pytest.fixture()
+async def users_query(session_maker):
+    async with session_maker() as session:
+        users = []
+        for _ in range(5):
+            user = User(username=person.username(), email=person.email(), password="-")
+            user.profile = UserProfile()
+            users.append(user)
+        session.add_all(users)
+        await session.commit()
+
+    ids = [user.id for user in users]
+    return select(User).where(User.id.in_(ids)).order_by(User.id)
+
+
+async def _paginate(session_maker, query, **kwargs):
+    async with session_maker() as session:
+        return await Paginator.get_paginated_response(
+            session, query, serializer=UserDto, limit=2, **kwargs
+        )
+
+
+@pytest.mark.parametrize("count", [CountStrategy.EXACT, CountStrategy.WINDOW])
+async def test_exact_totals(session_maker, users_query, count):
+    result = await _paginate(session_maker, users_query, count=count)
+    assert (result.total, result.total_strategy, result.has_more) == (5, count, True)
+
+    result = await _paginate(session_maker, users_query, count=count, page=3)
+    assert (result.total, len(result.results), result.has_more) == (5, 1, False)
+
+    # no row past the last page carries the window count
+    result = await _paginate(session_maker, users_query, count=count, page=4)
+    assert (result.total, result.results) == (5, [])
+
+
+async def test_cached_total(session_maker, users_query):
+    count_cache.clear()
+    result = await _paginate(session_maker, users_query, count=CountStrategy.CACHED)
+    assert result.total == 5
+    result = await _paginate(session_maker, users_query, count=CountStrategy.CACHED, page=2)
+    assert result.total == 5
+    assert (count_cache.hits, count_cache.misses) == (1, 1)
+
+
+async def test_estimated_total(session_maker, users_query):
+    result = await _paginate(session_maker, users_query, count=CountStrategy.ESTIMATED)
+    assert result.total_strategy == CountStrategy.ESTIMATED
+    assert result.total >= 0
+    assert len(result.results) == 2
+
+
+async def test_no_total(session_maker, users_query):
+    result = await _paginate(session_maker, users_query, count=CountStrategy.NONE)
+    assert (result.total, result.has_more) == (None, True)
+    result = await _paginate(session_maker, users_query, count=CountStrategy.NONE, page=3)
+    assert (result.total, result.has_more) == (None, False)
+
+
+async def test_window_total_with_cursor(session_maker, users_query):
+    first = await _paginate(
+        session_maker, users_query, count=CountStrategy.WINDOW, sort_keys=(User.id,)
+    )
+    result = await _paginate(
+        session_maker,
+        users_query,
+        count=CountStrategy.WINDOW,
+        sort_keys=(User.id,),
+        cursor=first.next_cursor,
+    )
+    assert (result.total, result.total_strategy, result.page) == (None, CountStrategy.NONE, None)
+    assert [user.id for user in result.results] > [user.id for user in first.results]
+
+
+@pytest.mark.parametrize("values", [["x"], [1.5], [True], [None], [1, 2]])
+async def test_invalid_cursor(session_maker, users_query, values):
+    with pytest.raises(HTTPException) as exc:
+        await _paginate(
+            session_maker, users_query, sort_keys=(User.id,), cursor=encode_cursor(values)
+        )
+    assert exc.value.status_code == 400
@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from fastapi import HTTPException
+
+from app.infrastructure.services.password_hasher import HasherExecutor, PasswordHasher
+
+pytestmark = pytest.mark.anyio
+
+
+def _hasher(**kwargs):
+    return PasswordHasher(
+        **{
+            "executor": HasherExecutor.THREAD,
+            "workers": 4,
+            "max_in_flight": 1,
+            "max_queued": 10,
+            **kwargs,
+        }
+    )
+
+
+class Work:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+        self.running = 0
+        self.max_running = 0
+
+    def __call__(self, value: str) -> str:
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        self.release.wait(timeout=5)
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+        return value
+
+
+async def _wait_until(predicate):
+    for _ in range(500):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("timed out")
+
+
+async def test_hashes_and_verifies():
+    hasher = _hasher()
+    try:
+        hashed = await hasher.hash("password")
+        assert await hasher.verify("password", hashed)
+        assert not await hasher.verify("other", hashed)
+    finally:
+        hasher.shutdown()
+
+
+async def test_runs_at_most_max_in_flight():
+    hasher = _hasher(max_in_flight=2)
+    work = Work()
+    work.release.set()
+    try:
+        results = await asyncio.gather(*(hasher._run(work, str(i)) for i in range(8)))
+    finally:
+        hasher.shutdown()
+    assert results == [str(i) for i in range(8)]
+    assert work.max_running == 2
+
+
+async def test_rejects_beyond_max_queued():
+    hasher = _hasher(max_in_flight=1, max_queued=1)
+    work = Work()
+    try:
+        running = asyncio.create_task(hasher._run(work, "running"))
+        await _wait_until(lambda: work.running == 1)
+        queued = asyncio.create_task(hasher._run(work, "queued"))
+        await _wait_until(lambda: hasher._queued == 1)
+
+        with pytest.raises(HTTPException) as exc_info:
+            await hasher._run(work, "rejected")
+        assert exc_info.value.status_code == 503
+        assert exc_info.value.headers == {"Retry-After": "1"}
+
+        work.release.set()
+        assert await asyncio.gather(running, queued) == ["running", "queued"]
+        assert hasher._queued == 0
+    finally:
+        work.release.set()
+        hasher.shutdown()
+
+
+class BrokenExecutor(ThreadPoolExecutor):
+    def submit(self, *args, **kwargs):
+        raise BrokenProcessPool("a worker died")
+
+
+async def test_falls_back_to_threads_when_the_process_pool_breaks():
+    hasher = _hasher(executor=HasherExecutor.PROCESS)
+    broken = BrokenExecutor()
+    hasher._executor = broken
+    try:
+        hashed = await hasher.hash("password")
+        assert hasher.executor_type == HasherExecutor.THREAD
+        assert isinstance(hasher._executor, ThreadPoolExecutor)
+        assert hasher._executor is not broken
+        assert await hasher.verify("password", hashed)
+    finally:
+        hasher.shutdown()
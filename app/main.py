@@ -1,14 +1,57 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.api.auth.v1 import router as auth_router
+from app.api.internal.v1 import router as internal_router
 from app.api.users.v1 import router as users_router
 from app.config import settings
+from app.domain.auth.services.user_versions import user_versions
+from app.domain.users.density_grid import density_grid
+from app.domain.users.location_coalescer import location_coalescer
+from app.domain.users.nearby_feed import nearby_feed
+from app.domain.users.spatial_index import spatial_index
 from app.exceptions import get_exception_handlers
+from app.infrastructure.services.email_sender import email_sender
+from app.infrastructure.services.email_service import email_service
+from app.infrastructure.services.mediator import Mediator
+from app.infrastructure.services.outbox import outbox
+from app.infrastructure.services.password_hasher import password_hasher
+from app.infrastructure.services.session_service import async_session_maker, engine
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # fails fast if an email template is missing
+    email_service.load_templates()
+    password_hasher.start()
+    email_sender.start()
+    Mediator.start()
+    if settings.AUTH_CLAIMS_ONLY:
+        await user_versions.listen(engine)
+    if settings.GEO_INDEX_ENABLED:
+        await spatial_index.start(async_session_maker)
+    if settings.NEARBY_FEED_ENABLED:
+        await nearby_feed.listen(engine)
+    location_coalescer.start(async_session_maker)
+    density_grid.start(async_session_maker)
+    outbox.start(async_session_maker)
+    yield
+    await outbox.stop(settings.MEDIATOR_DRAIN_SECONDS)
+    await Mediator.drain(settings.MEDIATOR_DRAIN_SECONDS)
+    await email_sender.stop(settings.EMAIL_DRAIN_SECONDS)
+    await density_grid.stop()
+    await location_coalescer.stop(async_session_maker)
+    await nearby_feed.stop()
+    await spatial_index.stop()
+    await user_versions.stop()
+    password_hasher.shutdown()
 
 
 def create_app():
     app = FastAPI(
+        lifespan=lifespan,
         title=settings.PROJECT_NAME,
         description="Fastapi Starter Template",
         version="0.0.1",
@@ -29,6 +72,12 @@ def create_app():
 def add_routers(app: FastAPI):
     app.include_router(users_router, prefix=f"/{settings.API_V1_STR}", tags=["users"])
     app.include_router(auth_router, prefix=f"/{settings.API_V1_STR}", tags=["auth"])
+    app.include_router(
+        internal_router,
+        prefix=f"/{settings.API_V1_STR}",
+        tags=["internal"],
+        include_in_schema=False,
+    )
 
 
 def add_middlewares(app: FastAPI):
@@ -0,0 +1,24 @@
+from sqlalchemy import BigInteger, Column, DateTime, Index, Integer, String, func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.repositories import Base
+
+
+class OutboxEvent(Base):
+    """
+    A domain event written by the transaction raising it, deleted once it is handled
+    """
+
+    __tablename__ = "outbox_events"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    # the name of the event's class, its handlers are looked up from the Mediator
+    event_type = Column(String, nullable=False)
+    payload = Column(JSONB, nullable=False)
+    # dispatchers claim an event by pushing this past the time they need to handle it
+    available_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    attempts = Column(Integer, nullable=False, server_default="0")
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    __table_args__ = (Index("ix_outbox_events_available_at", available_at, id),)
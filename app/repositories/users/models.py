@@ -1,4 +1,14 @@
-from sqlalchemy import Boolean, Column, Date, ForeignKey, Numeric, String
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Date,
+    Float,
+    ForeignKey,
+    Integer,
+    Numeric,
+    SmallInteger,
+    String,
+)
 from sqlalchemy.orm import Mapped, mapped_column, query_expression, relationship
 
 from app.repositories import Base
@@ -14,9 +24,17 @@ class UserLocation(Base):
     )
     latitude = Column(Numeric(precision=8, scale=6), index=True)
     longitude = Column(Numeric(precision=9, scale=6), index=True)
+    # the location on the unit sphere, kept in sync with latitude and longitude on write
+    x = Column(Float, index=True)
+    y = Column(Float, index=True)
+    z = Column(Float, index=True)
+    # C collation so the index serves prefix ranges of the geohash
+    geohash = Column(String(12, collation="C"), index=True)
     user_id: Mapped[int] = mapped_column(
         ForeignKey("users.id"), nullable=False, unique=True, index=True
     )
+    # the GiST index on ll_to_earth(latitude, longitude) is created by migrations only,
+    # where the cube and earthdistance extensions are available, see alembic/env.py
 
 
 class User(Base):
@@ -31,6 +49,8 @@ class User(Base):
     email = Column(String, unique=True)
     password = Column(String)
     is_active = Column(Boolean, default=False)
+    # bumped whenever a field carried in the access token claims changes
+    version = Column(Integer, nullable=False, default=0, server_default="0")
     profile: Mapped["UserProfile"] = relationship(back_populates="user")
     profile_id: Mapped[int] = mapped_column(
         ForeignKey("user_profiles.id"), nullable=False, unique=True, index=True
@@ -51,3 +71,15 @@ class UserProfile(Base):
     last_name = Column(String, nullable=True)
     birthday = Column(Date, nullable=True)
     user: Mapped["User"] = relationship(back_populates="profile")
+
+
+class LocationDensityCell(Base):
+    __tablename__ = "location_density_cells"
+
+    # index of the level in DENSITY_GRID_CELL_DEGREES
+    zoom = Column(SmallInteger, primary_key=True)
+    # row and column of the cell, as numbered by GridCells
+    lat_index = Column(Integer, primary_key=True)
+    lon_index = Column(Integer, primary_key=True)
+    # users located in the cell
+    count = Column(Integer, nullable=False, default=0)
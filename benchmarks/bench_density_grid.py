@@ -0,0 +1,233 @@
+"""
+Users per cell of a box with 1M locations spread over central Europe, read from the density
+grid against aggregating user_locations on the fly, what keeping the grid up to date costs
+PUT /users/{id}/location/ and the coalescer's flushes, and the time of the consistency check.
+
+    pytest benchmarks/bench_density_grid.py -s
+"""
+import asyncio
+import random
+import statistics
+import time
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import func, select, text
+
+from app.domain.auth.services.auth_service import AuthService, TokenTypes
+from app.domain.users.density_grid import cell_columns, density_grid
+from app.domain.users.location_coalescer import LocationCoalescer
+from app.repositories.users.models import UserLocation
+
+pytestmark = pytest.mark.anyio
+
+USERS = 1_000_000
+QUERIES = 20
+# (min_latitude, max_latitude, min_longitude, max_longitude), read at the zoom picked for them
+BOXES = {
+    "city": (50.0, 50.2, 14.3, 14.6),
+    "region": (49.0, 51.0, 13.0, 16.0),
+    "continent": (40.0, 60.0, -10.0, 30.0),
+}
+CONCURRENCY = 16
+SECONDS = 10
+FLUSH_SIZE = 1_000
+
+CREATE_LOCATIONS = """
+WITH profiles AS (
+    INSERT INTO user_profiles (first_name)
+    SELECT 'bench_density' FROM generate_series(1, :count)
+    RETURNING id
+), users AS (
+    INSERT INTO users (username, email, password, is_active, profile_id)
+    SELECT 'bench_density_' || id, 'bench_density_' || id || '@bench.com', '-', true, id
+    FROM profiles
+    RETURNING id
+), points AS (
+    SELECT id, round((45 + random() * 10)::numeric, 6) AS lat,
+        round((5 + random() * 20)::numeric, 6) AS lon
+    FROM users
+)
+INSERT INTO user_locations (user_id, latitude, longitude, x, y, z)
+SELECT id, lat, lon,
+    cos(radians(lat)) * cos(radians(lon)),
+    cos(radians(lat)) * sin(radians(lon)),
+    sin(radians(lat))
+FROM points
+RETURNING user_id
+"""
+
+DELETE_LOCATIONS = """
+WITH located AS (
+    DELETE FROM user_locations USING users
+    WHERE users.id = user_locations.user_id AND users.username LIKE 'bench_density_%'
+    RETURNING users.id
+), deleted AS (
+    DELETE FROM users WHERE id IN (SELECT id FROM located) RETURNING profile_id
+)
+DELETE FROM user_profiles WHERE id IN (SELECT profile_id FROM deleted)
+"""
+
+
+@pytest.fixture()
+async def user_ids(bench_session_maker):
+    async with bench_session_maker() as session:
+        user_ids = (await session.scalars(text(CREATE_LOCATIONS), {"count": USERS})).all()
+        await session.commit()
+    async with bench_session_maker() as session:
+        await session.execute(text("ANALYZE user_locations"))
+    # the locations were inserted behind the grid's back, the check counts them
+    started = time.perf_counter()
+    async with bench_session_maker() as session:
+        await density_grid.check(session)
+    print(f"\nbuilding the grid of {USERS} users: {time.perf_counter() - started:.1f}s")
+    async with bench_session_maker() as session:
+        await session.execute(text("ANALYZE location_density_cells"))
+
+    yield user_ids
+
+    async with bench_session_maker() as session:
+        await session.execute(text(DELETE_LOCATIONS))
+        await session.commit()
+    async with bench_session_maker() as session:
+        await density_grid.check(session)
+
+
+async def _timed(query) -> float:
+    """
+    Median milliseconds of the query
+    """
+    durations = []
+    for _ in range(QUERIES):
+        started = time.perf_counter()
+        await query()
+        durations.append((time.perf_counter() - started) * 1000)
+    return statistics.median(durations)
+
+
+async def test_density_reads(user_ids, bench_session_maker):
+    for box, (lat_min, lat_max, lon_min, lon_max) in BOXES.items():
+        await _compare_reads(bench_session_maker, box, lat_min, lat_max, lon_min, lon_max)
+
+
+async def _compare_reads(bench_session_maker, box, lat_min, lat_max, lon_min, lon_max):
+    zoom = density_grid.zoom_for(lat_min, lat_max, lon_min, lon_max)
+    cells = density_grid.levels[zoom]
+
+    async def from_grid():
+        async with bench_session_maker() as session:
+            return await density_grid.counts(session, lat_min, lat_max, lon_min, lon_max)
+
+    # the whole cells the box touches, a little wider, the cells outside are dropped after
+    degrees = cells.cell_degrees
+    rows = cells.row(lat_min), cells.row(lat_max)
+    columns = cells.column(lon_min), cells.column(lon_max)
+    cells_box = (
+        rows[0] * degrees - 90 - 1e-6,
+        (rows[1] + 1) * degrees - 90 + 1e-6,
+        columns[0] * degrees - 180 - 1e-6,
+        (columns[1] + 1) * degrees - 180 + 1e-6,
+    )
+
+    async def on_the_fly():
+        row, column = cell_columns(cells, UserLocation.latitude, UserLocation.longitude)
+        located = (
+            select(row.label("row"), column.label("column"))
+            .where(
+                UserLocation.latitude.between(cells_box[0], cells_box[1]),
+                UserLocation.longitude.between(cells_box[2], cells_box[3]),
+            )
+            .subquery()
+        )
+        query = select(located.c.row, located.c.column, func.count()).group_by(
+            located.c.row, located.c.column
+        )
+        async with bench_session_maker() as session:
+            return [
+                count
+                for row, column, count in await session.execute(query)
+                if rows[0] <= row <= rows[1] and columns[0] <= column <= columns[1]
+            ]
+
+    density = await from_grid()
+    assert density.total == sum(await on_the_fly())
+    grid_ms, aggregate_ms = await _timed(from_grid), await _timed(on_the_fly)
+    print(
+        f"{box} box, zoom {zoom} ({cells.cell_degrees} degrees), {len(density.cells)} cells "
+        f"of {density.total} users: grid={grid_ms:.2f}ms aggregated={aggregate_ms:.2f}ms"
+    )
+
+
+async def _sustained_puts(bench_client, user_ids) -> int:
+    deadline = time.perf_counter() + SECONDS
+    writes = 0
+
+    async def worker(worker_ids):
+        nonlocal writes
+        headers = {
+            user_id: {
+                "Authorization": "Bearer "
+                + AuthService._create_token(TokenTypes.ACCESS, id=user_id)
+            }
+            for user_id in worker_ids
+        }
+        while time.perf_counter() < deadline:
+            user_id = random.choice(worker_ids)
+            location = {
+                "latitude": f"{45 + random.random() * 10:.6f}",
+                "longitude": f"{5 + random.random() * 20:.6f}",
+            }
+            resp = await bench_client.put(
+                f"api/v1/users/{user_id}/location/", json=location, headers=headers[user_id]
+            )
+            assert resp.status_code == 201, resp.text
+            writes += 1
+
+    # workers move users of their own, a user's moves are never concurrent
+    sample = random.sample(user_ids, CONCURRENCY * 100)
+    await asyncio.gather(*(worker(sample[i::CONCURRENCY]) for i in range(CONCURRENCY)))
+    return writes
+
+
+async def _flush(bench_session_maker, user_ids) -> float:
+    coalescer = LocationCoalescer(flush_seconds=1, batch_size=FLUSH_SIZE, min_distance=0)
+    for user_id in random.sample(user_ids, FLUSH_SIZE):
+        coalescer.submit(
+            user_id,
+            Decimal(f"{45 + random.random() * 10:.6f}"),
+            Decimal(f"{5 + random.random() * 20:.6f}"),
+        )
+    started = time.perf_counter()
+    async with bench_session_maker() as session:
+        await coalescer.flush(session)
+    return (time.perf_counter() - started) * 1000
+
+
+async def test_incremental_updates(user_ids, bench_client, bench_session_maker, monkeypatch):
+    monkeypatch.setattr(density_grid, "enabled", False)
+    without_grid = await _sustained_puts(bench_client, user_ids)
+    flush_without_grid = await _flush(bench_session_maker, user_ids)
+    monkeypatch.setattr(density_grid, "enabled", True)
+    with_grid = await _sustained_puts(bench_client, user_ids)
+    flush_with_grid = await _flush(bench_session_maker, user_ids)
+    print(
+        f"\nPUT /location/ writes/s: without the grid={without_grid / SECONDS:.0f} "
+        f"with it={with_grid / SECONDS:.0f}\n"
+        f"flushing {FLUSH_SIZE} users: without the grid={flush_without_grid:.0f}ms "
+        f"with it={flush_with_grid:.0f}ms"
+    )
+
+    # the moves made without the grid are repaired, the others were counted
+    async with bench_session_maker() as session:
+        await density_grid.check(session)
+    monkeypatch.setattr(density_grid, "enabled", True)
+    await _sustained_puts(bench_client, user_ids)
+    await _flush(bench_session_maker, user_ids)
+    started = time.perf_counter()
+    async with bench_session_maker() as session:
+        results = await density_grid.check(session, repair=False)
+    print(
+        f"checking the grid of {USERS} users: {time.perf_counter() - started:.1f}s, "
+        f"mismatched cells per zoom={[result.mismatched_cells for result in results]}"
+    )
+    assert all(result.mismatched_cells == 0 for result in results)
@@ -0,0 +1,156 @@
+"""
+Emails per second through a local aiosmtpd server, a new FastMail and SMTP connection per
+email (the old behaviour) vs. the EmailSender's pool of persistent connections.
+
+    pytest benchmarks/bench_email_sender.py -s
+"""
+import asyncio
+import multiprocessing
+import socket
+import time
+import warnings
+
+import pytest
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+from fastapi_mail import ConnectionConfig, FastMail, MessageSchema
+
+from app.infrastructure.services.email_sender import EmailSender
+from app.infrastructure.services.email_service import EmailService, EmailTemplate
+
+pytestmark = pytest.mark.anyio
+
+EMAILS = 2_000
+# emails sent at once, as the handlers of a burst of registrations would
+CONCURRENCY = 100
+CONNECTIONS = [1, 2, 4]
+
+
+class SmtpHandler:
+    def __init__(self, received) -> None:
+        self.received = received
+
+    async def handle_DATA(self, server, session, envelope) -> str:
+        with self.received.get_lock():
+            self.received.value += 1
+        return "250 OK"
+
+
+def _serve(port: int, received, stop) -> None:
+    # aiosmtpd warns about its own use of Session.login_data on every login
+    warnings.simplefilter("ignore", DeprecationWarning)
+    controller = Controller(
+        SmtpHandler(received),
+        hostname="127.0.0.1",
+        port=port,
+        authenticator=lambda *args: AuthResult(success=True),
+        auth_require_tls=False,
+    )
+    controller.start()
+    stop.wait()
+    controller.stop()
+
+
+@pytest.fixture()
+def smtp_server():
+    """
+    The port and the emails received by an SMTP server, in a process of its own
+    so it doesn't compete with the senders for the GIL
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    context = multiprocessing.get_context("spawn")
+    received, stop = context.Value("i", 0), context.Event()
+    process = context.Process(target=_serve, args=(port, received, stop))
+    process.start()
+    # wait until it accepts connections
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except ConnectionRefusedError:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    yield port, received
+    stop.set()
+    process.join()
+
+
+async def _send_all(send) -> float:
+    """
+    Emails per second
+    """
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def send_one(i):
+        async with semaphore:
+            await send(f"user{i}@bench.com")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send_one(i) for i in range(EMAILS)))
+    return EMAILS / (time.perf_counter() - started)
+
+
+async def test_email_throughput(smtp_server):
+    port, received = smtp_server
+    template_data = {"user": "user@bench.com", "url": "http://bench.com/confirm-email/token/"}
+
+    async def send_with_fastmail(email_to):
+        config = ConnectionConfig(
+            MAIL_USERNAME="user",
+            MAIL_PASSWORD="pass",
+            MAIL_FROM="sender@bench.com",
+            MAIL_PORT=port,
+            MAIL_SERVER="127.0.0.1",
+            MAIL_SSL_TLS=False,
+            MAIL_STARTTLS=False,
+            USE_CREDENTIALS=True,
+            VALIDATE_CERTS=False,
+            TEMPLATE_FOLDER="app/templates",
+        )
+        message = MessageSchema(
+            subject="Confirmation Email",
+            recipients=[email_to],
+            template_body=template_data,
+            subtype="html",
+        )
+        await FastMail(config).send_message(message, template_name="confirmation.html")
+
+    per_email = await _send_all(send_with_fastmail)
+    print(f"\na connection per email: {per_email:.0f} emails/s")
+
+    for connections in CONNECTIONS:
+        sender = EmailSender(
+            hostname="127.0.0.1",
+            port=port,
+            username="user",
+            password="pass",
+            use_tls=False,
+            start_tls=False,
+            validate_certs=False,
+            suppress_send=False,
+            connections=connections,
+            queue_size=1_000,
+            batch_size=50,
+            timeout=30,
+        )
+        service = EmailService(sender, "sender@bench.com", "app/templates", bytecode_cache=True)
+        sender.start()
+
+        async def send_pooled(email_to):
+            await service.send_email(
+                EmailTemplate.CONFIRMATION, email_to, "Confirmation Email", **template_data
+            )
+
+        pooled = await _send_all(send_pooled)
+        stats = sender.stats()
+        await sender.stop(1)
+        print(
+            f"{connections} persistent connections: {pooled:.0f} emails/s, "
+            f"{stats.connects} connects, "
+            f"mean send={stats.send_latency_ms.sum / stats.send_latency_ms.count:.2f}ms"
+        )
+
+    assert received.value == EMAILS * (1 + len(CONNECTIONS))
@@ -0,0 +1,124 @@
+"""
+Confirmation emails rendered per second: a new environment compiling the template for every
+email, the way fastapi-mail did, vs. EmailService's precompiled templates, rendered inline or
+on a worker thread. Then the longest stall of the event loop while large templates render,
+and the time to load the templates with and without the bytecode cache.
+
+    pytest benchmarks/bench_email_templates.py -s
+"""
+import asyncio
+import shutil
+import time
+
+import pytest
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+from app.config import settings
+from app.infrastructure.services.email_service import EmailService, EmailTemplate
+
+pytestmark = pytest.mark.anyio
+
+RENDERS = 5_000
+CONCURRENCY = 50
+TEMPLATE_DATA = {"user": "user@bench.com", "url": "http://bench.com/confirm-email/token/"}
+# a large email, a table of this many rows
+ROWS = 20_000
+LARGE_RENDERS = 20
+
+
+def _service(template_folder=settings.EMAIL_TEMPLATE_FOLDER, bytecode_cache=False):
+    return EmailService(None, "sender@bench.com", template_folder, bytecode_cache)
+
+
+async def _per_second(render) -> float:
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def render_one():
+        async with semaphore:
+            await render()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(render_one() for _ in range(RENDERS)))
+    return RENDERS / (time.perf_counter() - started)
+
+
+async def test_render_throughput():
+    async def compiled_per_email():
+        environment = Environment(
+            loader=FileSystemLoader(settings.EMAIL_TEMPLATE_FOLDER), autoescape=select_autoescape()
+        )
+        environment.get_template(EmailTemplate.CONFIRMATION.value).render(**TEMPLATE_DATA)
+
+    service = _service()
+    service.load_templates()
+    template = service._templates[EmailTemplate.CONFIRMATION]
+
+    async def precompiled_inline():
+        template.render(**TEMPLATE_DATA)
+
+    async def precompiled_on_a_thread():
+        await service.render(EmailTemplate.CONFIRMATION, **TEMPLATE_DATA)
+
+    print()
+    for render in (compiled_per_email, precompiled_inline, precompiled_on_a_thread):
+        print(f"{render.__name__}: {await _per_second(render):.0f} renders/s")
+
+
+async def _longest_stall(render) -> float:
+    """
+    Milliseconds of the longest gap between the ticks of a task sleeping 1ms at a time
+    """
+    longest, running = 0.0, True
+
+    async def tick():
+        nonlocal longest
+        while running:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            longest = max(longest, (time.perf_counter() - started) * 1000)
+
+    ticker = asyncio.create_task(tick())
+    await asyncio.sleep(0.01)
+    await asyncio.gather(*(render() for _ in range(LARGE_RENDERS)))
+    running = False
+    await ticker
+    return longest
+
+
+async def test_event_loop_stalls(tmp_path):
+    for template in EmailTemplate:
+        shutil.copy(f"{settings.EMAIL_TEMPLATE_FOLDER}/{template.value}", tmp_path)
+    # the confirmation email with a large table appended
+    (tmp_path / EmailTemplate.CONFIRMATION.value).write_text(
+        "<p>{{ user }} {{ url }}</p><table>{% for row in rows %}"
+        "<tr><td>{{ row }}</td><td>{{ user }}</td><td>{{ url }}</td></tr>"
+        "{% endfor %}</table>"
+    )
+    service = _service(str(tmp_path))
+    service.load_templates()
+    template = service._templates[EmailTemplate.CONFIRMATION]
+    data = {**TEMPLATE_DATA, "rows": range(ROWS)}
+
+    async def inline():
+        template.render(**data)
+
+    async def on_a_thread():
+        await service.render(EmailTemplate.CONFIRMATION, **data)
+
+    for render in (inline, on_a_thread):
+        started = time.perf_counter()
+        stall = await _longest_stall(render)
+        print(
+            f"\n{LARGE_RENDERS} emails of {ROWS} rows rendered {render.__name__}: "
+            f"{time.perf_counter() - started:.2f}s, longest event loop stall {stall:.1f}ms"
+        )
+
+
+def test_loading_the_templates():
+    for bytecode_cache in (False, True, True):
+        started = time.perf_counter()
+        _service(bytecode_cache=bytecode_cache).load_templates()
+        print(
+            f"\nloading the templates, bytecode cache={bytecode_cache}: "
+            f"{(time.perf_counter() - started) * 1000:.2f}ms"
+        )
@@ -0,0 +1,114 @@
+"""
+GeoLocationHelper's batch functions on numpy and on their pure python fallback,
+against calling the scalar functions once per point. Doesn't need the database.
+
+    pytest benchmarks/bench_geo_batch.py --benchmark-group-by=group
+"""
+import random
+
+import numpy as np
+import pytest
+
+from app.domain.common import util
+from app.domain.common.util import GeoLocationHelper
+
+POINTS = 10_000
+# the distance matrix is MATRIX_ROWS x POINTS
+MATRIX_ROWS = 100
+DISTANCE = 50
+
+
+@pytest.fixture(scope="module")
+def points():
+    rng = random.Random(0)
+    latitudes = [rng.uniform(-90, 90) for _ in range(POINTS)]
+    longitudes = [rng.uniform(-180, 180) for _ in range(POINTS)]
+    return latitudes, longitudes
+
+
+@pytest.fixture(scope="module")
+def arrays(points):
+    return tuple(np.array(values, dtype=np.float64) for values in points)
+
+
+@pytest.fixture(params=["numpy", "python"])
+def implementation(request, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(util, "np", None)
+    return request.param
+
+
+@pytest.fixture()
+def inputs(implementation, points, arrays):
+    return arrays if implementation == "numpy" else points
+
+
+@pytest.mark.benchmark(group="bounding boxes")
+def test_bounding_boxes_scalar(benchmark, points):
+    benchmark(
+        lambda: [
+            GeoLocationHelper.calculate_bounding_box(latitude, longitude, DISTANCE)
+            for latitude, longitude in zip(*points)
+        ]
+    )
+
+
+@pytest.mark.benchmark(group="bounding boxes")
+def test_bounding_boxes_batch(benchmark, inputs):
+    benchmark(GeoLocationHelper.calculate_bounding_boxes, *inputs, DISTANCE)
+
+
+@pytest.mark.benchmark(group="distances")
+def test_distances_scalar(benchmark, points):
+    benchmark(
+        lambda: [
+            GeoLocationHelper.haversine_distance(10, 20, latitude, longitude)
+            for latitude, longitude in zip(*points)
+        ]
+    )
+
+
+@pytest.mark.benchmark(group="distances")
+def test_distances_batch(benchmark, inputs):
+    benchmark(GeoLocationHelper.haversine_distances, 10, 20, *inputs)
+
+
+@pytest.mark.benchmark(group="distance matrix")
+def test_distance_matrix_scalar(benchmark, points):
+    latitudes, longitudes = points
+    benchmark(
+        lambda: [
+            [
+                GeoLocationHelper.haversine_distance(latitude, longitude, *other)
+                for other in zip(latitudes, longitudes)
+            ]
+            for latitude, longitude in zip(latitudes[:MATRIX_ROWS], longitudes[:MATRIX_ROWS])
+        ]
+    )
+
+
+@pytest.mark.benchmark(group="distance matrix")
+def test_distance_matrix_batch(benchmark, inputs):
+    latitudes, longitudes = inputs
+    benchmark(
+        GeoLocationHelper.haversine_distance_matrix,
+        latitudes[:MATRIX_ROWS],
+        longitudes[:MATRIX_ROWS],
+        latitudes,
+        longitudes,
+    )
+
+
+@pytest.mark.benchmark(group="radius mask")
+def test_radius_mask_scalar(benchmark, points):
+    benchmark(
+        lambda: [
+            GeoLocationHelper.haversine_distance(10, 20, latitude, longitude) <= DISTANCE
+            for latitude, longitude in zip(*points)
+        ]
+    )
+
+
+@pytest.mark.benchmark(group="radius mask")
+def test_radius_mask_batch(benchmark, inputs):
+    benchmark(GeoLocationHelper.within_distance, 10, 20, *inputs, DISTANCE)
@@ -0,0 +1,130 @@
+"""
+Query time of the first page of GET /users/ for every GEO_SEARCH_STRATEGY and for the
+in-memory spatial index, with 100k and 1M locations spread over central Europe.
+
+    pytest benchmarks/bench_geo_search.py -s
+"""
+import statistics
+import time
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import text
+
+from app.config import settings
+from app.domain.users.dtos import UserWithDistanceDto
+from app.domain.users.service import UserService
+from app.domain.users.spatial_index import spatial_index
+from app.infrastructure.dtos import CountStrategy
+from app.infrastructure.services.paginator import Paginator
+
+pytestmark = pytest.mark.anyio
+
+STRATEGIES = ["great_circle", "earthdistance", "unit_vector"]
+DISTANCES = [10, 100]
+QUERIES = 20
+
+CREATE_LOCATIONS = """
+WITH profiles AS (
+    INSERT INTO user_profiles (first_name)
+    SELECT 'bench_geo' FROM generate_series(1, :count)
+    RETURNING id
+), users AS (
+    INSERT INTO users (username, email, password, is_active, profile_id)
+    SELECT 'bench_geo_' || id, 'bench_geo_' || id || '@bench.com', '-', true, id FROM profiles
+    RETURNING id
+), points AS (
+    SELECT id, round((45 + random() * 10)::numeric, 6) AS lat,
+        round((5 + random() * 20)::numeric, 6) AS lon
+    FROM users
+)
+INSERT INTO user_locations (user_id, latitude, longitude, x, y, z)
+SELECT id, lat, lon,
+    cos(radians(lat)) * cos(radians(lon)),
+    cos(radians(lat)) * sin(radians(lon)),
+    sin(radians(lat))
+FROM points
+"""
+
+DELETE_LOCATIONS = """
+WITH located AS (
+    DELETE FROM user_locations USING users
+    WHERE users.id = user_locations.user_id AND users.username LIKE 'bench_geo_%'
+    RETURNING users.id
+), deleted AS (
+    DELETE FROM users WHERE id IN (SELECT id FROM located) RETURNING profile_id
+)
+DELETE FROM user_profiles WHERE id IN (SELECT profile_id FROM deleted)
+"""
+
+
+@pytest.fixture(params=[100_000, 1_000_000], ids=["100k", "1M"])
+async def locations(request, bench_session_maker):
+    async with bench_session_maker() as session:
+        await session.execute(text(CREATE_LOCATIONS), {"count": request.param})
+        await session.commit()
+    async with bench_session_maker() as session:
+        await session.execute(text("ANALYZE user_locations"))
+        await session.execute(text("ANALYZE users"))
+        await session.execute(text("ANALYZE user_profiles"))
+
+    yield request.param
+
+    async with bench_session_maker() as session:
+        await session.execute(text(DELETE_LOCATIONS))
+        await session.commit()
+
+
+@pytest.mark.parametrize("distance", DISTANCES)
+async def test_geo_search(locations, distance, bench_session_maker, monkeypatch):
+    lat, lon = Decimal("50.000000"), Decimal("15.000000")
+    service = UserService(_session=None)
+
+    for strategy in STRATEGIES:
+        monkeypatch.setattr(settings, "GEO_SEARCH_STRATEGY", strategy)
+        # the searching user doesn't need to exist
+        query, sort_keys, within = service._nearby_users_query(lat, lon, distance, exclude=0)
+        timings = []
+        async with bench_session_maker() as session:
+            for _ in range(QUERIES):
+                started = time.perf_counter()
+                page = await Paginator.get_paginated_response(
+                    session,
+                    query.where(*within),
+                    serializer=UserWithDistanceDto,
+                    sort_keys=sort_keys,
+                    count=CountStrategy.WINDOW,
+                )
+                timings.append((time.perf_counter() - started) * 1000)
+        print(
+            f"\n{locations} locations, {distance}km, {strategy}: "
+            f"median={statistics.median(timings):.1f}ms total={page.total}"
+        )
+
+
+@pytest.mark.parametrize("distance", DISTANCES)
+async def test_spatial_index_search(locations, distance, bench_session_maker):
+    async with bench_session_maker() as session:
+        await spatial_index.rebuild(session)
+    stats = spatial_index.stats()
+    print(
+        f"\n{locations} locations, rebuilt in {stats.rebuild_seconds:.2f}s, "
+        f"{stats.memory_bytes / 2**20:.1f}MiB in {stats.cells} cells"
+    )
+
+    service = UserService(_session=bench_session_maker())
+    timings = []
+    try:
+        for _ in range(QUERIES):
+            started = time.perf_counter()
+            # the searching user doesn't need to exist
+            page = await service._search_users_in_index(
+                (50.0, 15.0), exclude=0, page=1, page_size=100, distance=distance, cursor=None
+            )
+            timings.append((time.perf_counter() - started) * 1000)
+    finally:
+        spatial_index.clear()
+    print(
+        f"{locations} locations, {distance}km, spatial index: "
+        f"median={statistics.median(timings):.1f}ms total={page.total}"
+    )
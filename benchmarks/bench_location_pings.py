@@ -0,0 +1,182 @@
+"""
+Sustained location pings per second, a PUT /users/{id}/location/ transaction per ping
+against POST /users/me/locations/ batches coalesced and flushed by the LocationCoalescer,
+and the flush itself, one multi-row upsert against a statement per row.
+
+Devices walk a few meters between pings, so part of them is under the minimum distance.
+
+    pytest benchmarks/bench_location_pings.py -s
+"""
+import asyncio
+import random
+import time
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import text
+
+from app.config import settings
+from app.domain.auth.services.auth_service import AuthService, TokenTypes
+from app.domain.users import service as user_service
+from app.domain.users.location_coalescer import LocationCoalescer
+
+pytestmark = pytest.mark.anyio
+
+USERS = 1_000
+CONCURRENCY = 16
+SECONDS = 10
+PINGS_PER_REQUEST = 10
+# meters a device moves between two pings, at most
+STEP = 20
+
+CREATE_USERS = """
+WITH profiles AS (
+    INSERT INTO user_profiles (first_name)
+    SELECT 'bench_ping' FROM generate_series(1, :count)
+    RETURNING id
+)
+INSERT INTO users (username, email, password, is_active, profile_id)
+SELECT 'bench_ping_' || id, 'bench_ping_' || id || '@bench.com', '-', true, id FROM profiles
+RETURNING id
+"""
+
+DELETE_USERS = """
+WITH located AS (
+    DELETE FROM user_locations USING users
+    WHERE users.id = user_locations.user_id AND users.username LIKE 'bench_ping_%'
+), deleted AS (
+    DELETE FROM users WHERE username LIKE 'bench_ping_%' RETURNING profile_id
+)
+DELETE FROM user_profiles WHERE id IN (SELECT profile_id FROM deleted)
+"""
+
+
+class Device:
+    def __init__(self, user_id: int) -> None:
+        self.user_id = user_id
+        self.headers = {
+            "Authorization": f"Bearer {AuthService._create_token(TokenTypes.ACCESS, id=user_id)}"
+        }
+        self.latitude = random.uniform(45, 55)
+        self.longitude = random.uniform(5, 25)
+
+    def ping(self) -> dict:
+        # ~111km per degree
+        self.latitude += random.uniform(-STEP, STEP) / 111_000
+        self.longitude += random.uniform(-STEP, STEP) / 111_000
+        return {"latitude": f"{self.latitude:.6f}", "longitude": f"{self.longitude:.6f}"}
+
+
+@pytest.fixture()
+async def devices(bench_session_maker):
+    async with bench_session_maker() as session:
+        user_ids = (await session.scalars(text(CREATE_USERS), {"count": USERS})).all()
+        await session.commit()
+
+    yield [Device(user_id) for user_id in user_ids]
+
+    async with bench_session_maker() as session:
+        await session.execute(text(DELETE_USERS))
+        await session.commit()
+
+
+@pytest.fixture()
+def location_coalescer(monkeypatch):
+    coalescer = LocationCoalescer(
+        flush_seconds=settings.LOCATION_FLUSH_SECONDS,
+        batch_size=settings.LOCATION_FLUSH_BATCH_SIZE,
+        min_distance=settings.LOCATION_MIN_DISTANCE_METERS,
+    )
+    monkeypatch.setattr(user_service, "location_coalescer", coalescer)
+    return coalescer
+
+
+async def _sustained(send) -> int:
+    """
+    Runs CONCURRENCY workers sending for SECONDS, returns the number of pings sent
+    """
+    deadline = time.perf_counter() + SECONDS
+    sent = 0
+
+    async def worker():
+        nonlocal sent
+        while time.perf_counter() < deadline:
+            pings = await send(random.randrange(USERS))
+            sent += pings
+
+    await asyncio.gather(*(worker() for _ in range(CONCURRENCY)))
+    return sent
+
+
+async def test_put_pings(bench_client, devices):
+    async def put(i):
+        device = devices[i]
+        resp = await bench_client.put(
+            f"api/v1/users/{device.user_id}/location/", json=device.ping(), headers=device.headers
+        )
+        assert resp.status_code == 201, resp.text
+        return 1
+
+    pings = await _sustained(put)
+    print(f"\nPUT /location/, a ping per request: pings/s={pings / SECONDS:.0f}")
+
+
+async def test_bulk_pings(bench_client, bench_session_maker, devices, location_coalescer):
+    async def post(i):
+        device = devices[i]
+        pings = [device.ping() for _ in range(PINGS_PER_REQUEST)]
+        resp = await bench_client.post(
+            "api/v1/users/me/locations/", json=pings, headers=device.headers
+        )
+        assert resp.status_code == 202, resp.text
+        return len(pings)
+
+    location_coalescer.start(bench_session_maker)
+    try:
+        pings = await _sustained(post)
+    finally:
+        await location_coalescer.stop(bench_session_maker)
+    stats = location_coalescer.stats()
+    assert stats.pending == stats.failed_flushes == 0
+    print(
+        f"\nPOST /me/locations/, {PINGS_PER_REQUEST} pings per request: "
+        f"pings/s={pings / SECONDS:.0f} dropped={stats.dropped} coalesced={stats.coalesced} "
+        f"written={stats.written} in {stats.flushes} flushes, "
+        f"last flush {stats.last_flush_seconds * 1000:.1f}ms"
+    )
+
+
+async def test_flush(bench_session_maker, devices, location_coalescer):
+    def submit_all():
+        for device in devices:
+            ping = device.ping()
+            location_coalescer.submit(
+                device.user_id, Decimal(ping["latitude"]), Decimal(ping["longitude"])
+            )
+
+    # the first flush inserts, the measured ones update
+    location_coalescer.min_distance = 0
+    submit_all()
+    async with bench_session_maker() as session:
+        await location_coalescer.flush(session)
+
+    submit_all()
+    started = time.perf_counter()
+    async with bench_session_maker() as session:
+        written = await location_coalescer.flush(session)
+    multi_row = written / (time.perf_counter() - started)
+
+    submit_all()
+    batch_size = location_coalescer.batch_size
+    location_coalescer.batch_size = 1
+    started = time.perf_counter()
+    try:
+        async with bench_session_maker() as session:
+            written = await location_coalescer.flush(session)
+    finally:
+        location_coalescer.batch_size = batch_size
+    single_row = written / (time.perf_counter() - started)
+    print(
+        f"\nflushing {USERS} users: multi-row upsert rows/s={multi_row:.0f}, "
+        f"upsert per row rows/s={single_row:.0f}"
+    )
@@ -0,0 +1,82 @@
+"""
+Memory of WORKERS processes searching 1M locations, each loading its own spatial index grid
+vs. all of them mapping the same location snapshot. RSS counts the shared pages in every
+process, PSS splits them between the processes that map them. Doesn't need the database.
+
+    pytest benchmarks/bench_location_snapshot.py -s
+"""
+import multiprocessing
+
+import numpy as np
+
+from app.domain.users.location_snapshot import LocationSnapshot, write_location_snapshot
+
+LOCATIONS = 1_000_000
+WORKERS = 4
+CELL_DEGREES = 1.0
+
+
+def _points():
+    rng = np.random.default_rng(0)
+    # spread over central Europe
+    return (
+        np.arange(1, LOCATIONS + 1, dtype=np.int64),
+        rng.uniform(45, 55, LOCATIONS),
+        rng.uniform(5, 25, LOCATIONS),
+    )
+
+
+def _memory_kb():
+    with open("/proc/self/smaps_rollup") as smaps:
+        fields = dict(line.split(":", 1) for line in smaps if ":" in line)
+    return int(fields["Rss"].split()[0]), int(fields["Pss"].split()[0])
+
+
+def _worker(mode, path, barrier, results):
+    from app.domain.users.spatial_index import _Grid
+
+    rss, pss = _memory_kb()
+    if mode == "per-process":
+        locations = _Grid(CELL_DEGREES)
+        for user_id, latitude, longitude in zip(*(column.tolist() for column in _points())):
+            locations.set(user_id, latitude, longitude)
+    else:
+        locations = LocationSnapshot(path, CELL_DEGREES)
+        locations.open()
+    # search all over the area, so every location was read at least once
+    for latitude in range(45, 56):
+        for longitude in range(5, 26):
+            locations.search(latitude, longitude, 100, exclude=0)
+
+    # measure once every worker holds its locations
+    barrier.wait()
+    loaded_rss, loaded_pss = _memory_kb()
+    results.put((loaded_rss - rss, loaded_pss - pss))
+    barrier.wait()
+
+
+def _run(mode, path):
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(WORKERS)
+    results = context.Queue()
+    workers = [
+        context.Process(target=_worker, args=(mode, path, barrier, results)) for _ in range(WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    measured = [results.get(timeout=600) for _ in workers]
+    for worker in workers:
+        worker.join()
+    rss = sum(rss for rss, _ in measured) / WORKERS / 1024
+    pss = sum(pss for _, pss in measured) / WORKERS / 1024
+    print(f"\n{mode}: {WORKERS} workers, per worker rss={rss:.1f}MiB pss={pss:.1f}MiB")
+    return pss
+
+
+def test_snapshot_memory_per_worker(tmp_path):
+    path = str(tmp_path / "locations.snapshot")
+    write_location_snapshot(path, *_points(), cell_degrees=CELL_DEGREES, started_at=0)
+
+    per_process = _run("per-process", path)
+    shared = _run("snapshot", path)
+    assert shared < per_process
@@ -0,0 +1,216 @@
+"""
+Database queries per minute of subscribers keeping their nearby users fresh, polling
+GET /users/ against holding a GET /users/feed/ stream, while other users keep moving.
+The queries of the moves themselves are measured first and left out.
+Runs the app on a local uvicorn server, the test client can't stream responses.
+
+    pytest benchmarks/bench_nearby_feed.py -s
+"""
+import asyncio
+import random
+import socket
+import time
+from collections import Counter
+from typing import List
+
+import httpx
+import pytest
+import uvicorn
+from sqlalchemy import event, text
+
+from app.domain.auth.services.auth_service import AuthService, TokenTypes
+from app.main import app
+
+pytestmark = pytest.mark.anyio
+
+SUBSCRIBERS = 100
+MOVERS = 200
+# location updates per second, all movers together
+MOVES_PER_SECOND = 10
+POLL_SECONDS = 10
+SECONDS = 30
+DISTANCE = 10
+
+CREATE_USERS = """
+WITH profiles AS (
+    INSERT INTO user_profiles (first_name)
+    SELECT 'bench_feed' FROM generate_series(1, :count)
+    RETURNING id
+), users AS (
+    INSERT INTO users (username, email, password, is_active, profile_id)
+    SELECT 'bench_feed_' || id, 'bench_feed_' || id || '@bench.com', '-', true, id FROM profiles
+    RETURNING id
+), points AS (
+    SELECT id, round((50 + random() * 0.2)::numeric, 6) AS lat,
+        round((10 + random() * 0.3)::numeric, 6) AS lon
+    FROM users
+)
+INSERT INTO user_locations (user_id, latitude, longitude, x, y, z)
+SELECT id, lat, lon,
+    cos(radians(lat)) * cos(radians(lon)),
+    cos(radians(lat)) * sin(radians(lon)),
+    sin(radians(lat))
+FROM points
+RETURNING user_id
+"""
+
+DELETE_USERS = """
+WITH located AS (
+    DELETE FROM user_locations USING users
+    WHERE users.id = user_locations.user_id AND users.username LIKE 'bench_feed_%'
+), deleted AS (
+    DELETE FROM users WHERE username LIKE 'bench_feed_%' RETURNING profile_id
+)
+DELETE FROM user_profiles WHERE id IN (SELECT profile_id FROM deleted)
+"""
+
+
+def _headers(user_id: int) -> dict:
+    return {"Authorization": f"Bearer {AuthService._create_token(TokenTypes.ACCESS, id=user_id)}"}
+
+
+@pytest.fixture()
+async def users(bench_session_maker):
+    async with bench_session_maker() as session:
+        user_ids = (
+            await session.scalars(text(CREATE_USERS), {"count": SUBSCRIBERS + MOVERS})
+        ).all()
+        await session.commit()
+    async with bench_session_maker() as session:
+        await session.execute(text("ANALYZE user_locations"))
+
+    yield user_ids[:SUBSCRIBERS], user_ids[SUBSCRIBERS:]
+
+    async with bench_session_maker() as session:
+        await session.execute(text(DELETE_USERS))
+        await session.commit()
+
+
+@pytest.fixture()
+async def server(bench_client):
+    # bench_client points the app at the test database
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(app, port=port, lifespan="off", log_level="warning", access_log=False)
+    )
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{port}/api/v1/", limits=limits, timeout=None
+    ) as client:
+        yield client
+
+    server.should_exit = True
+    await task
+
+
+@pytest.fixture()
+def queries(bench_session_maker):
+    """
+    Counts the statements sent to the test database
+    """
+    engine = bench_session_maker.kw["bind"].sync_engine
+    counter = {"count": 0}
+
+    def count(*args):
+        counter["count"] += 1
+
+    event.listen(engine, "before_cursor_execute", count)
+    yield counter
+    event.remove(engine, "before_cursor_execute", count)
+
+
+async def _move(client: httpx.AsyncClient, movers, deadline: float) -> int:
+    headers = {user_id: _headers(user_id) for user_id in movers}
+
+    async def move(user_id):
+        location = {
+            "latitude": f"{50 + random.random() * 0.2:.6f}",
+            "longitude": f"{10 + random.random() * 0.3:.6f}",
+        }
+        resp = await client.put(
+            f"users/{user_id}/location/", json=location, headers=headers[user_id]
+        )
+        assert resp.status_code == 201, resp.text
+
+    # at a steady rate, however long the moves take
+    moves = []
+    while time.perf_counter() < deadline:
+        moves.append(asyncio.create_task(move(random.choice(movers))))
+        await asyncio.sleep(1 / MOVES_PER_SECOND)
+    await asyncio.gather(*moves)
+    return len(moves)
+
+
+async def _poll(client: httpx.AsyncClient, user_id: int, deadline: float) -> int:
+    headers = _headers(user_id)
+    polls = 0
+    await asyncio.sleep(random.random() * POLL_SECONDS)
+    while time.perf_counter() < deadline:
+        resp = await client.get(f"users/?distance={DISTANCE}", headers=headers)
+        assert resp.status_code == 200, resp.text
+        polls += 1
+        await asyncio.sleep(POLL_SECONDS)
+    return polls
+
+
+async def _subscribe(
+    client: httpx.AsyncClient, user_id: int, subscribed: asyncio.Event, events: Counter
+) -> None:
+    headers = _headers(user_id)
+    # subscribes again after a resync, until cancelled
+    while True:
+        url = f"users/feed/?distance={DISTANCE}"
+        async with client.stream("GET", url, headers=headers) as resp:
+            assert resp.status_code == 200
+            async for line in resp.aiter_lines():
+                if line.startswith("event: "):
+                    events[line.removeprefix("event: ")] += 1
+                    subscribed.set()
+
+
+async def _subscribe_all(client, subscribers, events: Counter) -> List[asyncio.Task]:
+    subscribed = [asyncio.Event() for _ in subscribers]
+    tasks = [
+        asyncio.create_task(_subscribe(client, user_id, event, events))
+        for user_id, event in zip(subscribers, subscribed)
+    ]
+    await asyncio.gather(*(event.wait() for event in subscribed))
+    return tasks
+
+
+async def test_nearby_users_freshness(server, users, queries):
+    subscribers, movers = users
+
+    started, deadline = queries["count"], time.perf_counter() + SECONDS
+    moves = await _move(server, movers, deadline)
+    per_move = (queries["count"] - started) / moves
+    print(f"\n{moves} moves in {SECONDS}s, {per_move:.1f} queries each")
+
+    started, deadline = queries["count"], time.perf_counter() + SECONDS
+    moves, *polls = await asyncio.gather(
+        _move(server, movers, deadline),
+        *(_poll(server, user_id, deadline) for user_id in subscribers),
+    )
+    per_minute = (queries["count"] - started - moves * per_move) * 60 / SECONDS
+    print(f"polling every {POLL_SECONDS}s: queries/min={per_minute:.0f} polls={sum(polls)}")
+
+    started, events = queries["count"], Counter()
+    subscriptions = await _subscribe_all(server, subscribers, events)
+    subscribing = queries["count"] - started
+
+    started, deadline = queries["count"], time.perf_counter() + SECONDS
+    moves = await _move(server, movers, deadline)
+    per_minute = (queries["count"] - started - moves * per_move) * 60 / SECONDS
+    for subscription in subscriptions:
+        subscription.cancel()
+    await asyncio.gather(*subscriptions, return_exceptions=True)
+    print(
+        f"feed: queries/min={per_minute:.0f} events={dict(events)}, "
+        f"{subscribing} queries to subscribe"
+    )
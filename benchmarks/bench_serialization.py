@@ -0,0 +1,106 @@
+"""
+CPU cost of turning a 100 row page of GET /users/ into a response body, ORM objects validated
+one by one and then revalidated against the response model vs. row mappings validated at once.
+Doesn't need the database.
+
+    pytest benchmarks/bench_serialization.py -s
+"""
+import datetime
+import timeit
+
+import pytest
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app.domain.users.dtos import UserWithDistanceDto
+from app.infrastructure.dtos import CountStrategy, PaginationDto
+from app.infrastructure.responses import ModelResponse
+from app.infrastructure.services.paginator import list_adapter
+from app.repositories.users.models import User, UserProfile
+
+pytestmark = pytest.mark.anyio
+
+ROWS = 100
+ROUNDS = 200
+# the fast path must at least be this many times faster
+MIN_SPEEDUP = 1.5
+
+
+def _mappings():
+    return [
+        {
+            "id": i,
+            "username": f"user{i}",
+            "email": f"user{i}@mail.com",
+            "is_active": True,
+            "profile": {
+                "id": i,
+                "first_name": "first",
+                "last_name": "last",
+                "birthday": "1990-01-01",
+            },
+            "distance": i / 3,
+            "cursor_key_0": i / 3,
+            "cursor_key_1": i,
+        }
+        for i in range(ROWS)
+    ]
+
+
+def _orm_objects():
+    users = []
+    for mapping in _mappings():
+        profile = mapping["profile"]
+        user = User(
+            id=mapping["id"],
+            username=mapping["username"],
+            email=mapping["email"],
+            is_active=True,
+            profile=UserProfile(
+                id=profile["id"],
+                first_name=profile["first_name"],
+                last_name=profile["last_name"],
+                birthday=datetime.date(1990, 1, 1),
+            ),
+        )
+        user.distance = mapping["distance"]
+        users.append(user)
+    return users
+
+
+async def test_page_serialization():
+    mappings = _mappings()
+    response_field = create_response_field(
+        name="response", type_=PaginationDto[UserWithDistanceDto]
+    )
+
+    async def orm_path():
+        # building the ORM objects stands in for SQLAlchemy loading them from the rows
+        results = [UserWithDistanceDto.model_validate(obj) for obj in _orm_objects()]
+        page = PaginationDto(total=ROWS, page=1, size=ROWS, results=results)
+        content = await serialize_response(field=response_field, response_content=page)
+        return JSONResponse(content).body
+
+    async def mapping_path():
+        results = list_adapter(UserWithDistanceDto).validate_python(mappings)
+        page = PaginationDto(
+            total=ROWS, total_strategy=CountStrategy.WINDOW, page=1, size=ROWS, results=results
+        )
+        return ModelResponse(page).body
+
+    async def measure(path) -> float:
+        timer = timeit.default_timer
+        started = timer()
+        for _ in range(ROUNDS):
+            await path()
+        return (timer() - started) / ROUNDS * 1000
+
+    # warm up the cached adapters
+    await orm_path()
+    await mapping_path()
+    orm_ms = await measure(orm_path)
+    mapping_ms = await measure(mapping_path)
+
+    print(f"\n{ROWS} rows: orm objects {orm_ms:.2f}ms, row mappings {mapping_ms:.2f}ms")
+    assert orm_ms / mapping_ms >= MIN_SPEEDUP
@@ -0,0 +1,81 @@
+"""
+Writes per second of the single statement write endpoints, register, location and profile.
+Registering includes hashing the password on the password hashing pool.
+
+    pytest benchmarks/bench_writes.py -s
+"""
+import asyncio
+import time
+import uuid
+
+import pytest
+from sqlalchemy import delete, select
+
+from app.repositories.users.models import User, UserLocation, UserProfile
+
+pytestmark = pytest.mark.anyio
+
+CONCURRENCY = 16
+REQUESTS = 1_000
+
+
+async def _writes_per_second(send) -> float:
+    queue = iter(range(REQUESTS))
+
+    async def worker():
+        for i in queue:
+            resp = await send(i)
+            assert resp.status_code == 201, resp.text
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(CONCURRENCY)))
+    return REQUESTS / (time.perf_counter() - started)
+
+
+async def test_register_writes(bench_client, bench_session_maker):
+    prefix = f"bench_{uuid.uuid4().hex[:8]}"
+
+    async def register(i):
+        payload = {
+            "username": f"{prefix}_{i}",
+            "email": f"{prefix}_{i}@bench.com",
+            "password": "pw",
+        }
+        return await bench_client.post("api/v1/register/", json=payload)
+
+    try:
+        print(f"\nPOST /register/ writes/s={await _writes_per_second(register):.0f}")
+    finally:
+        async with bench_session_maker() as session:
+            users = select(User.profile_id).where(User.username.startswith(prefix))
+            profile_ids = (await session.scalars(users)).all()
+            await session.execute(delete(User).where(User.username.startswith(prefix)))
+            await session.execute(delete(UserProfile).where(UserProfile.id.in_(profile_ids)))
+            await session.commit()
+
+
+async def test_location_writes(bench_client, bench_session_maker, bench_user):
+    headers = {"Authorization": f"Bearer {bench_user.access_token}"}
+
+    async def update_location(i):
+        location = {"latitude": f"{i % 90}.000000", "longitude": f"{i % 180}.000000"}
+        return await bench_client.put(
+            f"api/v1/users/{bench_user.id}/location/", json=location, headers=headers
+        )
+
+    try:
+        print(f"\nPUT /location/ writes/s={await _writes_per_second(update_location):.0f}")
+    finally:
+        async with bench_session_maker() as session:
+            await session.execute(delete(UserLocation).where(UserLocation.user_id == bench_user.id))
+            await session.commit()
+
+
+async def test_profile_writes(bench_client, bench_user):
+    headers = {"Authorization": f"Bearer {bench_user.access_token}"}
+
+    async def update_profile(i):
+        profile = {"first_name": f"first {i}", "last_name": f"last {i}", "birthday": "1990-01-01"}
+        return await bench_client.put("api/v1/users/me/profile/", json=profile, headers=headers)
+
+    print(f"\nPUT /me/profile/ writes/s={await _writes_per_second(update_profile):.0f}")
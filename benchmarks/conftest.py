@@ -0,0 +1,82 @@
+import dataclasses
+
+import pytest
+from httpx import AsyncClient
+from mimesis import Locale, Person
+from passlib.hash import pbkdf2_sha256
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.config import settings
+from app.infrastructure.services.session_service import SessionMaker
+from app.main import app
+from app.repositories.users.models import User, UserProfile
+
+person = Person(Locale.EN)
+
+# unlike the test fixtures, benchmarks commit their data and use a real connection pool,
+# concurrent requests can't share the single connection the tests are bound to
+engine = create_async_engine(str(settings.TEST_DATABASE_URI), pool_size=20, max_overflow=0)
+
+async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+class BenchSessionMaker(SessionMaker):
+    def _create_session(self) -> AsyncSession:
+        return async_session_maker()
+
+
+@dataclasses.dataclass
+class BenchUser:
+    id: int
+    username: str
+    password: str
+    access_token: str
+
+
+@pytest.fixture()
+async def bench_client():
+    app.dependency_overrides[SessionMaker] = BenchSessionMaker
+
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        yield client
+
+    del app.dependency_overrides[SessionMaker]
+
+
+@pytest.fixture()
+def bench_session_maker():
+    return async_session_maker
+
+
+@pytest.fixture()
+async def bench_user(bench_client):
+    password = person.password()
+    async with async_session_maker() as session:
+        user = User(
+            username=person.username(),
+            email=person.email(),
+            password=pbkdf2_sha256.hash(password),
+            is_active=True,
+        )
+        user.profile = UserProfile()
+        session.add(user)
+        await session.commit()
+
+    resp = await bench_client.post(
+        "api/v1/login/", json={"username": user.username, "password": password}
+    )
+    assert resp.status_code == 200
+
+    yield BenchUser(
+        id=user.id,
+        username=user.username,
+        password=password,
+        access_token=resp.json()["access_token"],
+    )
+
+    async with async_session_maker() as session:
+        await session.execute(delete(User).where(User.id == user.id))
+        await session.execute(delete(UserProfile).where(UserProfile.id == user.profile_id))
+        await session.commit()